@@ -14,7 +14,6 @@ import logging.handlers
 import subprocess
 import functools
 import collections
-import multiprocessing
 import datetime
 import traceback
 
@@ -25,7 +24,7 @@ import diribeoutils
 
 
 from diribeomodel import Series, Episode, Season, MovieClipAssociation, MergePolicy, PlacementPolicy
-from diribeoworkers import SeriesSearchWorker, ModelFiller, MultipleMovieClipAssociator, ThumbnailGenerator, ThumbnailGatherer, MultipleAssignerThread, MovieUpdater, VersionChecker, HOMEPAGE_URL
+from diribeoworkers import LibraryLoader, SeriesSearchWorker, ModelFiller, MultipleMovieClipAssociator, ThumbnailGenerator, ThumbnailGatherer, ChecksumCalculator, MultipleAssignerThread, MovieUpdater, VersionChecker, HOMEPAGE_URL, scoring_pool
 
 
 from PyQt4 import QtGui
@@ -135,15 +134,19 @@ class EpisodeTableModel(QtCore.QAbstractTableModel):
     def __init__(self, series, parent=None):
         QtCore.QAbstractTableModel.__init__(self, parent)
         self.series = series        
-        self.episodes = self.series.episodes
         self.filled = False
         
         self.row_lookup = lambda episode: ["", episode.title, episode.seen_it, episode.date, episode.plot]
         self.column_lookup = ["", "Title", "Seen it?", "Date", "Plot Summary"]      
         
 
+    @property
+    def episodes(self):
+        # Not kept as an attribute, the episodes of the series might not have been loaded yet
+        return self.series.episodes
+
     def insert_episode(self, episode):
-        self.episodes.append(episode)
+        self.series.add_episode(episode)
 
     def rowCount(self, index):
         return len(self.episodes)
@@ -194,6 +197,18 @@ class EpisodeTableModel(QtCore.QAbstractTableModel):
     
     def refresh_row(self, row):
         self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.column_lookup)-1))
+
+    def get_row(self, episode):
+        for row, existing_episode in enumerate(self.episodes):
+            if existing_episode is episode:
+                return row
+        return None
+
+    def refresh_episodes(self, episodes):
+        rows = dict((id(episode), row) for row, episode in enumerate(self.episodes))
+        for episode in episodes:
+            if id(episode) in rows:
+                self.refresh_row(rows[id(episode)])
     
     def setData(self, index, value, role = Qt.EditRole):
         if role == Qt.CheckStateRole:
@@ -201,6 +216,7 @@ class EpisodeTableModel(QtCore.QAbstractTableModel):
             if value == Qt.Checked:
                 boolean_value = True
             self.episodes[index.row()].seen_it = boolean_value 
+            self.episodes[index.row()].changed()
             self.dataChanged.emit(index, index)
             return True
         if role == Qt.EditRole and False: # TODO: double clicking deletes this 
@@ -255,11 +271,14 @@ class LocalTreeWidget(QtGui.QTreeWidget):
         if isinstance(movie, Series):
             for episode in movie.episodes:
                 episode.seen_it = seen
+            movie.changed()
         elif isinstance(movie, Season):
             for episode in movie.episodes:
                 episode.seen_it = seen
+                episode.changed()
         elif isinstance(movie, Episode):
             movie.seen_it = seen
+            movie.changed()
         
         mainwindow.tableview.model().refresh_table()
         mainwindow.seriesinfo.reload()
@@ -295,6 +314,7 @@ class LocalSearch(QtGui.QFrame):
         self.localseriestree.setHeaderLabels(["Series"])        
         self.localseriestree.setAnimated(True)
         self.localseriestree.setHeaderHidden(True)
+        self.localseriestree.itemExpanded.connect(self.expand_series)
         self.toplevel_items = []
         self.initial_build_tree()
         
@@ -326,13 +346,22 @@ class LocalSearch(QtGui.QFrame):
 
     def initial_build_tree(self):
         for series in series_list:                 
-            parent_series = QtGui.QTreeWidgetItem([series.title])
-            self.toplevel_items.append(parent_series)
-            parent_series.movie = series
-            self.build_subtree(parent_series)
+            self.append_series(series)
+
+    def append_series(self, series):
+        parent_series = QtGui.QTreeWidgetItem([series.title])
+        self.toplevel_items.append(parent_series)
+        parent_series.movie = series
+        self.build_subtree(parent_series)
 
 
     def build_subtree(self, parent_series):
+        if not parent_series.movie.is_loaded():
+            # The episodes are loaded once the series is expanded for the first time
+            parent_series.setChildIndicatorPolicy(QtGui.QTreeWidgetItem.ShowIndicator)
+            self.localseriestree.addTopLevelItem(parent_series)
+            return
+
         seasons = parent_series.movie.get_seasons()
         for seasonnumber in seasons:
             child_season = QtGui.QTreeWidgetItem(parent_series,["Season " + str('%0.2d' % seasonnumber)])
@@ -342,6 +371,12 @@ class LocalSearch(QtGui.QFrame):
                 child_episode.movie = episode
         self.localseriestree.addTopLevelItem(parent_series)
 
+    def expand_series(self, item):
+        if item.parent() is None and item.childCount() == 0:
+            item.setChildIndicatorPolicy(QtGui.QTreeWidgetItem.DontShowIndicatorWhenChildless)
+            item.movie.load_episodes()
+            self.build_subtree(item)
+
 
     def update_tree(self, series):    
         for toplevelitem in self.toplevel_items:
@@ -394,6 +429,7 @@ class MoviePicture(QtGui.QWidget):
     
     def delete_all(self):
         self.movie.pictures = []
+        self.movie.changed()
         self.delete_all_button.setVisible(False)
         self.load_picture()    
     
@@ -413,6 +449,7 @@ class MoviePicture(QtGui.QWidget):
         
     def dropEvent(self, event):
         self.setPicture(event.mimeData().text())
+        self.movie.changed()
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasFormat('application/x-fridgemagnet'):
@@ -1109,9 +1146,14 @@ class SeriesInformationWidget(QtGui.QWidget):
         
     def save_seen_it(self):
         self.movie.seen_it = self.seenit.content.checkState()
+        self.movie.changed()
     
     def save_plot(self):
-        self.movie.plot = self.plot.content.toPlainText()
+        plot = self.plot.content.toPlainText()
+        # textChanged is also emitted when the information is loaded
+        if plot != self.movie.plot:
+            self.movie.plot = plot
+            self.movie.changed()
  
     def clear_all_info(self):
         self.stacked_widget.setCurrentWidget(self.nothing_to_see_here_widget)
@@ -1161,7 +1203,7 @@ class SeriesInformationWidget(QtGui.QWidget):
             begin_date, end_date = movie.get_series().get_episode_date_range()
             series = movie.get_series()
             episodes = [movie]
-            goto_row = self.movie.number-1       
+            goto_row = mainwindow.get_table_model(series).get_row(movie)
         
         # Handle the title
         try: 
@@ -1211,7 +1253,7 @@ class SeriesInformationWidget(QtGui.QWidget):
         if self.stacked_widget.currentWidget() != self.tableview:
             self.stacked_widget.setCurrentWidget(self.main_widget)
         
-        if position_table:
+        if position_table and goto_row is not None:
             goto_index = active_table_models[series].index(goto_row, 0)            
             mainwindow.tableview.scrollTo(goto_index, QtGui.QAbstractItemView.PositionAtTop)
        
@@ -1350,6 +1392,7 @@ class MultipleAssociationTableModel(QtCore.QAbstractTableModel):
         self.column_lookup = ["Filename", "Message", "Skip?", "Placement Policy", "Association", ]
         self.movieclipassociation_messages = {MovieClipAssociation.ASSOCIATION_FOUND : "Association found",
                                               MovieClipAssociation.ASSOCIATION_GUESSED : "Guessed episode",
+                                              MovieClipAssociation.ASSOCIATION_PARSED : "Episode found in the file name",
                                               MovieClipAssociation.INVALID_FILE : "Invalid file"}
      
     
@@ -1838,6 +1881,10 @@ class DebuggingSettings(QtGui.QWidget):
         movieclips.reset()
         settings.reset()
         series_list.__init__()
+        diribeomodel.identifier_index.clear()
+        diribeomodel.title_index.invalidate()
+        diribeomodel.series_journal.reset()
+        diribeomodel.movieclips_journal.reset()
         self.main_settings_window.hide()
         
         
@@ -1882,6 +1929,29 @@ class GeneralSettings(QtGui.QWidget):
         self.hash_movieclips_checkbox.setChecked(settings.get("hash_movieclips"))
         self.hash_movieclips_checkbox.setToolTip("When ticked newly added movie clips are associated with an unique hash value. It is recommended that you leave this unticked")
         
+        self.verify_copies_checkbox = QtGui.QCheckBox()
+        self.verify_copies_checkbox.setChecked(bool(settings.get("verify_copies")))
+        self.verify_copies_checkbox.setToolTip("When ticked copied movie clips are read back and compared with the original, provided that they are hashed")
+        
+        self.journal_changes_checkbox = QtGui.QCheckBox()
+        self.journal_changes_checkbox.setChecked(settings.get("journal_changes"))
+        self.journal_changes_checkbox.setToolTip("When ticked only the changes since the last save are written to disk, which makes saving large libraries a lot faster")
+        
+        self.database_checkbox = QtGui.QCheckBox()
+        self.database_checkbox.setChecked(settings.uses_database())
+        self.database_checkbox.setToolTip("When ticked the library is stored in a SQLite database instead of JSON files. This is recommended for large libraries")
+        
+        self.snapshot_compression_combobox = QtGui.QComboBox()
+        self.snapshot_compression_combobox.addItems(["none"] + diribeomodel.get_compressions())
+        self.snapshot_compression_combobox.setToolTip("Defines how the library files are compressed. Compressed files are smaller, which helps if the settings directory is on a network share")
+        index = self.snapshot_compression_combobox.findText(settings.get("snapshot_compression") or "none")
+        self.snapshot_compression_combobox.setCurrentIndex(max(index, 0))
+        
+        self.checksum_algorithm_combobox = QtGui.QComboBox()
+        self.checksum_algorithm_combobox.addItems(diribeomodel.get_checksum_algorithms())
+        self.checksum_algorithm_combobox.setToolTip("Defines how newly added movie clips are hashed. The checksums of existing movie clips stay valid. New libraries use md5, libraries of former versions keep using sha224")
+        self.checksum_algorithm_combobox.setCurrentIndex(max(self.checksum_algorithm_combobox.findText(settings.get_checksum_algorithm()), 0))
+        
         
         self.number_of_thumbnails_edit = QtGui.QLineEdit(str(settings.get("number_of_thumbnails")))
         self.number_of_thumbnails_edit.setToolTip("Defines the number of thumbnails generated")
@@ -1894,6 +1964,11 @@ class GeneralSettings(QtGui.QWidget):
         self.form_layout.addRow("Show all movieclips", self.show_all_movieclips_checkbox)
         self.form_layout.addRow("Normalize names", self.normalize_names_checkbox)
         self.form_layout.addRow("Hash movieclips", self.hash_movieclips_checkbox)
+        self.form_layout.addRow("Checksum algorithm", self.checksum_algorithm_combobox)
+        self.form_layout.addRow("Verify copied movieclips", self.verify_copies_checkbox)
+        self.form_layout.addRow("Only save changes", self.journal_changes_checkbox)
+        self.form_layout.addRow("Store library in a database", self.database_checkbox)
+        self.form_layout.addRow("Compress library files", self.snapshot_compression_combobox)
         self.form_layout.addRow("Number of thumbnails created", self.number_of_thumbnails_edit)
         self.form_layout.addRow("Deployment folder", self.deployment_folder_edit)
         
@@ -2038,6 +2113,28 @@ class SettingsEditor(QtGui.QDialog):
         settings["show_all_movieclips"] = self.general_settings.show_all_movieclips_checkbox.checkState()
         settings["normalize_names"] = self.general_settings.normalize_names_checkbox.checkState()
         settings["hash_movieclips"] = self.general_settings.hash_movieclips_checkbox.checkState()
+        settings["checksum_algorithm"] = str(self.general_settings.checksum_algorithm_combobox.currentText())
+        settings["verify_copies"] = self.general_settings.verify_copies_checkbox.isChecked()
+        settings["journal_changes"] = self.general_settings.journal_changes_checkbox.checkState()
+        
+        if self.general_settings.database_checkbox.isChecked() != settings.uses_database():
+            # The other storage doesn't contain the latest changes, so it has to be rewritten completely
+            diribeomodel.series_journal.compaction_required = True
+            diribeomodel.movieclips_journal.compaction_required = True
+        if self.general_settings.database_checkbox.isChecked():
+            settings["storage_backend"] = "sqlite"
+        else:
+            settings["storage_backend"] = "json"
+        
+        snapshot_compression = str(self.general_settings.snapshot_compression_combobox.currentText())
+        if snapshot_compression != settings.get("snapshot_compression"):
+            # Snapshots are read whatever their compression, this only makes sure the next save
+            # writes them again, including the shards of the series which haven't been changed
+            for series in series_list:
+                series.dirty = True
+            diribeomodel.series_journal.compaction_required = True
+            diribeomodel.movieclips_journal.compaction_required = True
+        settings["snapshot_compression"] = snapshot_compression
         try:
             settings["number_of_thumbnails"] = int(self.general_settings.number_of_thumbnails_edit.text())
         except ValueError:
@@ -2102,7 +2199,29 @@ class MainWindow(QtGui.QMainWindow):
 
     def load_all_series_into_their_table(self):
         for series in series_list:
-            self.load_existing_series_into_table(series) 
+            self.get_table_model(series)
+
+    def load_library(self, series_iterator):
+        ''' Shows the series while they are still being read '''
+        job = LibraryLoader(series_iterator)
+        job.series_loaded.connect(self.insert_loaded_series, Qt.QueuedConnection)
+        job.finished.connect(self.library_loaded, Qt.QueuedConnection)
+        self.jobs.append(job)
+        job.start()
+
+    def insert_loaded_series(self, series):
+        # The loader only reads the series, they are added to the library by the GUI thread
+        self.show_loaded_series(diribeomodel.context.add_loaded_series(series))
+
+    def library_loaded(self):
+        self.show_loaded_series(diribeomodel.context.finish_loading())
+        log.debug("Loaded library in %.3f seconds" % diribeomodel.context.load_duration)
+
+    def show_loaded_series(self, series_list):
+        for series in series_list:
+            # The table keeps showing the series the user has selected
+            self.local_search.append_series(series)
+            self.get_table_model(series)
             
     def build_menu_bar(self):
         menubar = self.menuBar()
@@ -2140,11 +2259,12 @@ class MainWindow(QtGui.QMainWindow):
         self.setCentralWidget(self.episode_overview_widget)
 
     def save_settings(self):
-        settings.save_configs()
+        autosave.request_save()
     
     def closeEvent(self, event):
         self.hide()
-        self.save_settings()
+        autosave.stop()
+        scoring_pool.close()
     
     def start_about(self):
         about = About(self.jobs, parent=self)        
@@ -2170,7 +2290,7 @@ class MainWindow(QtGui.QMainWindow):
     def update_movie(self, movie):
         job = MovieUpdater(movie)        
         job.finished.connect(functools.partial(self.seriesinfo.load_information, movie))
-        job.finished.connect(functools.partial(self.rebuild_after_update, movie))
+        job.updated.connect(functools.partial(self.rebuild_after_update, movie))
         job.download_error.connect(diribeomessageboxes.download_error)
         self.jobs.append(job)
         job.start()
@@ -2217,7 +2337,7 @@ class MainWindow(QtGui.QMainWindow):
         # series might be none. Treat series as a hint
         if len(series_list) > 0:
             if len(filepath_dir_list) > 0:
-                job = MultipleAssignerThread(filepath_dir_list, series, pool)
+                job = MultipleAssignerThread(filepath_dir_list, series)
                 job.result.connect(self.start_multiple_association_wizard, Qt.QueuedConnection)
                 self.jobs.append(job)
                 job.start()
@@ -2238,15 +2358,26 @@ class MainWindow(QtGui.QMainWindow):
         job.filesystem_error.connect(diribeomessageboxes.filesystem_error_warning, Qt.QueuedConnection)
         if settings.get("automatic_thumbnail_creation"):
             job.generate_thumbnails.connect(self.generate_thumbnails)
+        if settings.get("hash_movieclips"):
+            job.finished.connect(self.calculate_missing_checksums)
+        self.jobs.append(job)
+        job.start()
+
+    def calculate_missing_checksums(self, episode = None, movieclip = None):
+        job = ChecksumCalculator()
+        job.hashing_error.connect(diribeomessageboxes.hashing_error_warning, Qt.QueuedConnection)
         self.jobs.append(job)
         job.start()
 
-    def rebuild_after_update(self, movie):
+    def rebuild_after_update(self, movie, diff):
         if isinstance(movie, Series):
             self.local_search.update_tree(movie)
-            active_table_models[movie].refresh_table()
+            if diff is None or diff.inserted:
+                active_table_models[movie].refresh_table()
+            else:
+                active_table_models[movie].refresh_episodes(diff.changed)
         else:
-            active_table_models[movie.get_series()].refresh_row(movie.number-1)
+            active_table_models[movie.get_series()].refresh_episodes([movie])
         
     def delete_series(self, series=None):
         if series is None or not isinstance(series,Series):
@@ -2261,6 +2392,7 @@ class MainWindow(QtGui.QMainWindow):
             for i, available_series in enumerate(series_list):
                 if series == available_series:
                     del series_list[i]       
+            series.deleted()
                     
             # Delete the series's table model
             del active_table_models[series] 
@@ -2306,13 +2438,17 @@ class MainWindow(QtGui.QMainWindow):
             self.seriesinfo.load_information(self.existing_series[index.row()], position_table=False)
                  
 
-    def load_existing_series_into_table(self, series):
-        self.existing_series = series
+    def get_table_model(self, series):
         try:
-            self.tableview.setModel(active_table_models[series]) 
+            return active_table_models[series]
         except KeyError:
             active_table_models[series] = model = EpisodeTableModel(series)
             model.filled = True
+            return model
+
+    def load_existing_series_into_table(self, series):
+        self.existing_series = series
+        self.tableview.setModel(self.get_table_model(series))
             
             
     def load_items_into_table(self, series_items):
@@ -2330,6 +2466,7 @@ class MainWindow(QtGui.QMainWindow):
             if existing_series is None: 
                 current_series = Series(downloaded_series.title, identifier=identifier)
                 series_list.append(current_series)
+                diribeomodel.identifier_index.add_series(current_series)
                 active_table_models[current_series] = model = EpisodeTableModel(current_series)
                 self.tableview.setModel(model)
                 
@@ -2466,18 +2603,29 @@ if __name__ == "__main__":
     library = diribeowrapper.library
     active_table_models = {}
 
-    pool = multiprocessing.Pool()
     pixmap_cache = PixmapCache()
 
-    settings = diribeomodel.settings     
-    series_list = diribeomodel.series_list
-    movieclips = diribeomodel.movieclips    
+    # The settings and the movie clips are read right away, the series while the window is shown
+    series_iterator = diribeomodel.context.load_incrementally()
+    settings = diribeomodel.context.settings     
+    series_list = diribeomodel.context.series_list
+    movieclips = diribeomodel.context.movieclips    
+
+    autosave = diribeomodel.AutosaveThread(settings)
+    autosave.start()
+    # Only this process evicts, not the hashing processes
+    settings.get_checksum_cache().evict_in_background()
+    # The snapshots are taken by the GUI thread, which is the one changing the library
+    autosave_timer = QtCore.QTimer()
+    autosave_timer.timeout.connect(autosave.poll)
+    autosave_timer.start(int(autosave.POLL_INTERVAL * 1000))
     
     settings.update_implementations(library.implementations)
 
     log.debug("Building main window")
     mainwindow = MainWindow()
     mainwindow.show()
+    mainwindow.load_library(series_iterator)
     log.debug("Finished building main window")
     
     app.exec_()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+''' Micro benchmarks for the parts of Diribeo which have to cope with large libraries.
+    Run this module directly, e.g. "python diribeobenchmarks.py" '''
+
+import sys
+import time
+import datetime
+import json
+import subprocess
+import os
+import tempfile
+import shutil
+import random
+import cPickle
+
+from diribeomodel import Episode, Series, SlottedObject, SeriesCodec, SeriesOrganizerEncoder, SeriesOrganizerDecoder
+from diribeomodel import compress, get_compressions, open_library_file, write_atomically, get_checksum_algorithms, TitleIndex
+from diribeomodel import parse_release_name
+from diribeoworkers import HashingPipeline, calculate_digest, calculate_digests, dameraulevenshtein, EpisodeMatcher, ScoreStatistics, get_title_table
+
+
+class LegacyEpisode(object):
+    ''' The former per instance dictionary layout of an episode, used as the baseline '''
+    def __init__(self, title, descriptor, series, date, plot, identifier, number):
+        self.title = title
+        self.descriptor = descriptor
+        self.series = series
+        self.plot = plot
+        self.date = date
+        self.identifier = identifier
+        self.rating = []
+        self.pictures = []
+        self.director = ""
+        self.runtime = ""
+        self.genre = ""
+        self.seen_it = False
+        self.number = number
+
+
+def deep_size(root):
+    ''' Returns the number of bytes used by the given object and everything reachable from it.
+        Objects which are referenced several times are only counted once.
+    '''
+    seen = set()
+    stack = [root]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (bool, type)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, SlottedObject):
+            stack.extend(obj.__getstate__().values())
+        elif hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+    return size
+
+
+def create_episode_arguments(count, episodes_per_season = 20):
+    ''' Creates the arguments the way the JSON decoder delivers them, i.e. each episode
+        has its own copy of the series reference and identifier '''
+    for number in xrange(count):
+        yield dict(title = u"Episode %s" % number,
+                   descriptor = [number / episodes_per_season + 1, number % episodes_per_season + 1],
+                   series = [u"Benchmark Series", {u"imdb" : u"0000001"}],
+                   date = datetime.date(2000, 1, 1) + datetime.timedelta(days = number),
+                   plot = u"",
+                   identifier = {u"imdb" : unicode(number)},
+                   number = number)
+
+
+def benchmark_episode_memory(count = 50000):
+    legacy = [LegacyEpisode(**arguments) for arguments in create_episode_arguments(count)]
+    legacy_size = deep_size(legacy)
+    del legacy
+
+    compact = [Episode(**arguments) for arguments in create_episode_arguments(count)]
+    compact_size = deep_size(compact)
+
+    print "Episode memory (%s episodes)" % count
+    print "  per instance dictionary: %8.1f bytes per episode" % (float(legacy_size) / count)
+    print "  slots, shared references: %7.1f bytes per episode" % (float(compact_size) / count)
+
+
+def time_python(statement, repetitions = 5):
+    ''' Runs the statement in a fresh interpreter and returns the best wall clock time '''
+    timings = []
+    for repetition in range(repetitions):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", statement])
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def benchmark_startup():
+    baseline = time_python("pass")
+    lazy = time_python("import diribeomodel")
+    loaded = time_python("import diribeomodel; diribeomodel.context.load()")
+
+    print "Startup (interpreter start subtracted)"
+    print "  import diribeomodel:           %6.3f s" % (lazy - baseline)
+    print "  import and load the library:   %6.3f s" % (loaded - baseline)
+
+
+def create_series_list(count, episodes_per_series = 100):
+    series_list = []
+    for number, arguments in enumerate(create_episode_arguments(count)):
+        if number % episodes_per_series == 0:
+            series = Series(u"Series %s" % number, identifier = {u"imdb" : u"s%s" % number})
+            series_list.append(series)
+        arguments["series"] = (series.title, series.identifier)
+        series.episodes.append(Episode(**arguments))
+    return series_list
+
+
+def best_time(function, repetitions = 3):
+    timings = []
+    for repetition in range(repetitions):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def benchmark_library_codec(counts = (1000, 10000, 100000)):
+    print "Library file codec (seconds, former indented format / compact format)"
+    codec = SeriesCodec()
+    for count in counts:
+        series_list = create_series_list(count)
+        legacy_contents = json.dumps(series_list, sort_keys = True, indent = 4, cls = SeriesOrganizerEncoder, encoding = "utf-8")
+        compact_contents = codec.dumps(series_list)
+
+        legacy_save = best_time(lambda: json.dumps(series_list, sort_keys = True, indent = 4, cls = SeriesOrganizerEncoder, encoding = "utf-8"))
+        compact_save = best_time(lambda: codec.dumps(series_list))
+        legacy_load = best_time(lambda: json.loads(legacy_contents, object_hook = SeriesOrganizerDecoder, encoding = "utf-8"))
+        compact_load = best_time(lambda: codec.loads(compact_contents))
+
+        print "  %6s episodes: save %6.3f / %6.3f  load %6.3f / %6.3f  size %5.1f / %5.1f MB" % (count, legacy_save, compact_save,
+                legacy_load, compact_load, len(legacy_contents) / 1e6, len(compact_contents) / 1e6)
+
+
+def benchmark_snapshot_compression(count = 100000, plot = u"A rather long plot which is repeated in many episodes. " * 8):
+    print "Snapshot compression (%s episodes)" % count
+    codec = SeriesCodec()
+    series_list = create_series_list(count)
+    for series in series_list:
+        for episode in series.episodes:
+            episode.plot = plot
+    filecontents = codec.dumps(series_list)
+
+    directory = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(directory, "series.json")
+        for compression in ["none"] + get_compressions():
+            def save():
+                write_atomically(filepath, compress(codec.dumps(series_list), compression))
+            def load():
+                with open_library_file(filepath) as f:
+                    codec.build(codec.iter_load(f))
+
+            save_time = best_time(save)
+            load_time = best_time(load)
+            print "  %-5s save %6.3f s  load %6.3f s  size %6.2f MB (%5.1f %%)" % (compression, save_time, load_time,
+                    os.path.getsize(filepath) / 1e6, 100.0 * os.path.getsize(filepath) / len(filecontents))
+    finally:
+        shutil.rmtree(directory)
+
+
+def create_sparse_files(directory, count, filesize):
+    filepaths = []
+    for number in range(count):
+        filepath = os.path.join(directory, "clip%s.avi" % number)
+        with open(filepath, "wb") as f:
+            f.truncate(filesize)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def benchmark_hashing(count = 8, filesize = 256 * 1024 * 1024):
+    print "Hashing %s sparse files of %s MB" % (count, filesize / 1024 / 1024)
+    directory = tempfile.mkdtemp()
+    try:
+        filepaths = create_sparse_files(directory, count, filesize)
+        total = count * filesize / 1e6
+
+        def sequential(blocksize):
+            for filepath in filepaths:
+                calculate_digest(filepath, blocksize = blocksize)
+
+        def pipeline(limit):
+            hashing_pipeline = HashingPipeline()
+            hashing_pipeline.DEVICE_LIMIT = hashing_pipeline.ROTATIONAL_DEVICE_LIMIT = limit
+            hashing_pipeline.run(filepaths, lambda filepath, callback: calculate_digest(filepath, callback = callback))
+
+        for description, function in (("one after another, 4 KiB reads", lambda: sequential(4096)),
+                                       ("one after another, 1 MiB reads", lambda: sequential(1024 * 1024)),
+                                       ("pipeline, 1 thread per device", lambda: pipeline(1)),
+                                       ("pipeline, 4 threads per device", lambda: pipeline(4))):
+            print "  %-32s %7.1f MB/s" % (description, total / best_time(function, repetitions = 1))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_checksum_algorithms(filesize = 256 * 1024 * 1024):
+    print "Checksum algorithms (%s MB sparse file, read from the page cache)" % (filesize / 1024 / 1024)
+    directory = tempfile.mkdtemp()
+    try:
+        filepath, = create_sparse_files(directory, 1, filesize)
+        calculate_digest(filepath) # fills the page cache
+        for algorithms in [[algorithm] for algorithm in get_checksum_algorithms()] + [get_checksum_algorithms()[:2]]:
+            elapsed = best_time(lambda: calculate_digests(filepath, algorithms))
+            print "  %-12s %7.1f MB/s" % (" + ".join(algorithms), filesize / 1e6 / elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+def create_filenames(count, seed = 0):
+    random_generator = random.Random(seed)
+    return [u"Series %s S%02dE%02d %s.720p.HDTV.x264" % (random_generator.randint(0, 200), random_generator.randint(1, 10),
+            random_generator.randint(1, 20), random_generator.choice([u"Pilot", u"The Return", u"Episode"])) for number in range(count)]
+
+
+def benchmark_edit_distance(count = 20000, filenames = 3, candidates = 20, shortlist_size = 300):
+    print "Guessing the episode of a file name (%s episodes)" % count
+    series_list = create_series_list(count)
+    episodes = [episode for series in series_list for episode in series.episodes]
+    filenames = create_filenames(filenames)
+
+    def legacy():
+        for filename in filenames:
+            [[episode, min(dameraulevenshtein(title, filename) for title in episode.get_alternative_titles() + [episode.get_normalized_name()])]
+             for episode in episodes]
+
+    def bit_parallel():
+        matcher = EpisodeMatcher(episodes)
+        for filename in filenames:
+            matcher.score(filename)
+
+    matcher = EpisodeMatcher(episodes)
+    def complete():
+        for filename in filenames:
+            sorted(matcher.score(filename), key = lambda episode_score: episode_score[1])
+
+    def bounded():
+        for filename in filenames:
+            matcher.best(filename, candidates, ScoreStatistics())
+
+    title_index = TitleIndex()
+    build_time = best_time(lambda: title_index.build(series_list), repetitions = 1)
+    def shortlisted():
+        for filename in filenames:
+            EpisodeMatcher(title_index.get_candidates(filename, shortlist_size)).best(filename, candidates, ScoreStatistics())
+
+    legacy_time = best_time(legacy, repetitions = 1) / len(filenames)
+    bit_parallel_time = best_time(bit_parallel, repetitions = 1) / len(filenames)
+    print "  dynamic programming: %7.3f s per file name" % legacy_time
+    print "  bit-parallel:        %7.3f s per file name (compiling the titles included)" % bit_parallel_time
+    print "  all scores, sorted:  %7.3f s per file name" % (best_time(complete) / len(filenames))
+    print "  best %s, bounded:    %7.3f s per file name" % (candidates, best_time(bounded) / len(filenames))
+    print "  trigram shortlist:   %7.3f s per file name (building the index once: %.3f s)" % (best_time(shortlisted) / len(filenames), build_time)
+
+
+def benchmark_pool_transfer(count = 20000, shortlist_size = 300):
+    print "Data sent to the process pool (%s episodes)" % count
+    series_list = create_series_list(count)
+    episodes = [episode for series in series_list for episode in series.episodes]
+    title_index = TitleIndex()
+    title_index.build(series_list)
+    filename = create_filenames(1)[0]
+    task = (filename, title_index.get_candidate_positions(filename, shortlist_size), 20)
+    print "  episodes, for every file name:   %9.1f KB" % (len(cPickle.dumps(episodes, cPickle.HIGHEST_PROTOCOL)) / 1e3)
+    print "  title table, once per process:   %9.1f KB" % (len(cPickle.dumps(get_title_table(episodes), cPickle.HIGHEST_PROTOCOL)) / 1e3)
+    print "  file name and shortlist:         %9.1f KB" % (len(cPickle.dumps(task, cPickle.HIGHEST_PROTOCOL)) / 1e3)
+
+
+def benchmark_release_names(count = 100000):
+    print "Parsing release names (%s file names)" % count
+    random_generator = random.Random(0)
+    formats = [u"Series.%s.S%02dE%02d.720p.HDTV.x264-GROUP", u"Series %s - %dx%02d - Title", u"[Group] Series %s - %d%02d [1080p]",
+               u"Series.%s.%02d.%02d.Unparsable.720p"]
+    filenames = [random_generator.choice(formats) % (random_generator.randint(0, 200), random_generator.randint(1, 10), random_generator.randint(1, 24))
+                 for number in range(count)]
+    elapsed = best_time(lambda: [parse_release_name(filename) for filename in filenames])
+    print "  %8.0f file names per second, %.0f %% parsed" % (count / elapsed,
+            100.0 * sum(parse_release_name(filename) is not None for filename in filenames) / count)
+
+
+if __name__ == "__main__":
+    benchmark_episode_memory()
+    benchmark_startup()
+    benchmark_library_codec()
+    benchmark_snapshot_compression()
+    benchmark_hashing()
+    benchmark_checksum_algorithms()
+    benchmark_edit_distance()
+    benchmark_pool_transfer()
+    benchmark_release_names()
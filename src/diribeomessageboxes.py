@@ -50,6 +50,14 @@ def filesystem_error_warning(filepath):
     messagebox.setDetailedText(filepath)
     messagebox.exec_()
 
+def hashing_error_warning(errors):
+    messagebox = QtGui.QMessageBox(QtGui.QMessageBox.Warning, "Error while calculating checksums", "")
+    messagebox.setText("The checksums of %s movie clips couldn't be calculated." % len(errors))
+    messagebox.setInformativeText("Make sure that the movie clips are available, e.g. that their drive is connected.")
+    messagebox.setStandardButtons(QtGui.QMessageBox.Ok)
+    messagebox.setDetailedText("\n".join("%s: %s" % (filepath, error) for filepath, error in sorted(errors.items())))
+    messagebox.exec_()
+
 def download_error():
     messagebox = QtGui.QMessageBox(QtGui.QMessageBox.Warning, "Error while downloading series information", "")
     messagebox.setText("There has been an error while downloading the series.")
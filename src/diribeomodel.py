@@ -6,14 +6,119 @@ import shutil
 import collections
 import os
 import sys
+import threading
+import itertools
+import heapq
+import re
+import hashlib
+import time
+import sqlite3
+import contextlib
+import ctypes
+import functools
+import gzip
+import zlib
+import bz2
+import StringIO
+import copy
+import logging
+
+try:
+    import lzma
+except ImportError:
+    # Only part of the standard library from Python 3.3 on
+    lzma = None
 
 from PyQt4 import QtCore
 
+log = logging.getLogger("Diribeo Logger")
 
 def iter_attributes(obj):
     return ((n, getattr(obj, n)) for n in dir(obj) if (not n.startswith('_') and not n.startswith('to_string')))
 
 
+interned_values = {} # emptied whenever a library is loaded, see clear_interned_values
+
+def clear_interned_values():
+    ''' Forgets the shared values, e.g. those of series which have been deleted or renamed '''
+    interned_values.clear()
+
+def forget_series_reference(title, identifier):
+    interned_values.pop(("series", title, identifier_key(identifier)), None)
+
+def intern_value(value):
+    ''' Returns a shared instance of the given (hashable) value '''
+    return interned_values.setdefault(value, value)
+
+def intern_identifier(identifier):
+    ''' Returns a copy of the identifier dictionary whose keys are shared between all identifiers '''
+    if not identifier:
+        return identifier
+    return dict((intern_value(implementation), key) for implementation, key in identifier.items())
+
+def intern_series_reference(series):
+    ''' Episodes refer to their series by a (title, identifier) pair. The pair is shared by all
+        episodes of a series instead of being duplicated for each of them.
+    '''
+    try:
+        title, identifier = series
+        key = ("series", title, identifier_key(identifier))
+    except (TypeError, ValueError, AttributeError):
+        return series
+    try:
+        return interned_values[key]
+    except KeyError:
+        return interned_values.setdefault(key, (title, intern_identifier(identifier)))
+
+
+class SlottedObject(object):
+    ''' Base class for the objects which exist in large numbers. They store their attributes
+        in slots instead of a per instance dictionary.
+    '''
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                try:
+                    state[name] = getattr(self, name)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def snapshot(self):
+        ''' Returns a copy, see copy_value. Every slot of the class has to be set. '''
+        cls = type(self)
+        duplicate = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(duplicate, name, copy_value(getattr(self, name)))
+        return duplicate
+
+
+def copy_value(value):
+    ''' Copies an attribute of an object, so the copy of the object can be encoded by the autosave
+        thread while the object is changed. Only lists and dictionaries are copied, other values are
+        replaced instead of being changed.
+    '''
+    if type(value) is list:
+        return list(value)
+    elif isinstance(value, dict):
+        return copy.copy(value)
+    return value
+
+
+def take_snapshot(movie):
+    ''' Returns a copy of a series, episode, movie clip or identifier, see copy_value '''
+    if hasattr(movie, "snapshot"):
+        return movie.snapshot()
+    return copy_value(movie)
+
+
 class MergePolicy(object):
     OVERWRITE, MORE_INFO = range(2)
     
@@ -42,13 +147,27 @@ class PlacementPolicy(object):
     
 
 
-class MovieClip(object):
-    def __init__(self, filepath, old_filepath = None, identifier = None, filesize = None, checksum = None, thumbnails = None, duration = None, dimensions = None):
+LEGACY_CHECKSUM_ALGORITHM = "sha224"
+DEFAULT_CHECKSUM_ALGORITHM = "md5"
+
+
+def get_checksum_algorithms():
+    ''' Returns the names of the checksum algorithms which are available with this Python version '''
+    available = getattr(hashlib, "algorithms_guaranteed", getattr(hashlib, "algorithms", ()))
+    return [algorithm for algorithm in ("md5", "sha1", "sha224", "sha256", "sha512") if algorithm in available]
+
+
+class MovieClip(SlottedObject):
+    __slots__ = ("filepath", "old_filepath", "identifier", "checksum", "checksum_algorithm", "fingerprint", "duration", "dimensions", "filesize", "thumbnails")
+
+    def __init__(self, filepath, old_filepath = None, identifier = None, filesize = None, checksum = None, thumbnails = None, duration = None, dimensions = None, fingerprint = None, checksum_algorithm = None):
         
         self.filepath = filepath # the current file path of the movie clip 
         self.old_filepath = old_filepath # the former file path containing the old filename                   
-        self.identifier = identifier 
+        self.identifier = intern_identifier(identifier)
         self.checksum = checksum
+        self.checksum_algorithm = checksum_algorithm # None for the checksums calculated before the algorithm could be chosen
+        self.fingerprint = fingerprint # hash of the file size and a few chunks, see calculate_fingerprint
         self.duration = duration # in seconds
         self.dimensions = dimensions # [width, height]
             
@@ -63,6 +182,9 @@ class MovieClip(object):
     
     def get_filename(self):
         return os.path.basename(self.filepath)
+
+    def get_checksum_algorithm(self):
+        return self.checksum_algorithm or LEGACY_CHECKSUM_ALGORITHM
     
     def get_filesize(self):
         """This function calculates the file size in bytes of the given file and returns the result"""
@@ -95,6 +217,10 @@ class MovieClip(object):
             
         self.thumbnails = []
     
+    def changed(self):
+        ''' Records that the movie clip has been modified since the last save '''
+        movieclips_journal.record("update_movieclip", self, id(self))
+
     def __eq__(self, other):
         if self.checksum == other.checksum and self.filesize == other.filesize:
             return True
@@ -105,6 +231,8 @@ class MovieClip(object):
 
 class NoInternetConnectionAvailable(Exception): pass
 class DownloadError(Exception): pass
+class LibraryNotAvailable(Exception): pass
+class BlobNotAvailable(IOError): pass
 
 
 class DownloadedSeries(object):
@@ -114,7 +242,7 @@ class DownloadedSeries(object):
         self.identifier = identifier
         
 class MovieClipAssociation(object):
-    INVALID_FILE, ASSOCIATION_FOUND, ASSOCIATION_GUESSED, ALREADY_EXISTS = range(4)
+    INVALID_FILE, ASSOCIATION_FOUND, ASSOCIATION_GUESSED, ALREADY_EXISTS, ASSOCIATION_PARSED = range(5)
     
     def __init__(self, filepath):
         self.filepath = filepath
@@ -122,7 +250,7 @@ class MovieClipAssociation(object):
         self.movieclip = None
         self.episode_scores_list = None
         self.episode_scores_list_reference = 0
-        self.placement_policy = settings.get("placement_policy")
+        self.placement_policy = context.settings.get("placement_policy")
         self.episode_score_information = {"mean" : 0, "median" : 0}
         self.message = None
 
@@ -140,13 +268,17 @@ def SeriesOrganizerDecoder(dct):
         return datetime.date.fromordinal(dct["ordinal"])
 
     if '__episode__' in dct:
-        return Episode(title = dct["title"], descriptor = dct["descriptor"], series = dct["series"], plot = dct['plot'], pictures = dct['pictures'], date = dct["date"], identifier = dct["identifier"], rating = dct["rating"], director = dct["director"], genre = dct["genre"], runtime = dct["runtime"], seen_it = dct["seen_it"], number = dct["number"])
+        episode = Episode(title = dct["title"], descriptor = dct["descriptor"], series = dct["series"], pictures = dct['pictures'], date = dct["date"], identifier = dct["identifier"], rating = dct["rating"], director = dct["director"], genre = dct["genre"], runtime = dct["runtime"], seen_it = dct["seen_it"], number = dct["number"])
+        Episode.plot.decode(episode, dct["plot"])
+        return episode
 
     if '__series__' in dct:
-        return Series(dct["title"], identifier = dct["identifier"], plot = dct["plot"], episodes = dct["episodes"], rating = dct["rating"], director = dct["director"], genre = dct["genre"], pictures = dct['pictures'], date = dct["date"])
+        series = Series(dct["title"], identifier = dct["identifier"], episodes = dct["episodes"], rating = dct["rating"], director = dct["director"], genre = dct["genre"], pictures = dct['pictures'], date = dct["date"])
+        Series.plot.decode(series, dct["plot"])
+        return series
 
     if '__movieclip__' in dct:        
-        return MovieClip(dct['filepath'], old_filepath=dct['old_filepath'], identifier = dct['identifier'], filesize = dct['filesize'], checksum = dct['checksum'], thumbnails = dct["thumbnails"], duration = dct["duration"], dimensions = dct["dimensions"])
+        return MovieClip(dct['filepath'], old_filepath=dct['old_filepath'], identifier = dct['identifier'], filesize = dct['filesize'], checksum = dct['checksum'], thumbnails = dct["thumbnails"], duration = dct["duration"], dimensions = dct["dimensions"], fingerprint = dct.get("fingerprint"), checksum_algorithm = dct.get("checksum_algorithm"))
     
     if '__movieclips__' in dct:        
         return MovieClipManager(dictionary = dct['dictionary'])
@@ -162,34 +294,1193 @@ def SeriesOrganizerDecoder(dct):
 
 class SeriesOrganizerEncoder(json.JSONEncoder):
     def default(self, obj):
-        
-        if isinstance(obj, Episode):
-            return { "__episode__" : True, "title" : obj.title, "descriptor" : obj.descriptor, "series" : obj.series, "plot" : obj.plot, "pictures" : obj.pictures, "date" : obj.date, "identifier" : obj.identifier, "rating" : obj.rating, "director" : obj.director, "runtime" : obj.runtime, "genre" : obj.genre, "seen_it" : obj.seen_it, "number" : obj.number}
+        # Look the encoder up by type, only unknown types (e.g. subclasses) walk the table
+        try:
+            encode = self.dispatch[type(obj)]
+        except KeyError:
+            for cls, encode in self.dispatch.items():
+                if isinstance(obj, cls):
+                    self.dispatch[type(obj)] = encode
+                    break
+            else:
+                return json.JSONEncoder.default(self, obj)
+        return encode(obj)
+
+    @staticmethod
+    def encode_episode(obj):
+        return { "__episode__" : True, "title" : obj.title, "descriptor" : obj.descriptor, "series" : obj.series, "plot" : Episode.plot.encode(obj), "pictures" : obj.pictures, "date" : obj.date, "identifier" : obj.identifier, "rating" : obj.rating, "director" : obj.director, "runtime" : obj.runtime, "genre" : obj.genre, "seen_it" : obj.seen_it, "number" : obj.number}
 
-        if isinstance(obj, datetime.date):
-            return { "__date__" : True, "ordinal" : obj.toordinal()}
+    @staticmethod
+    def encode_date(obj):
+        return { "__date__" : True, "ordinal" : obj.toordinal()}
 
-        if isinstance(obj, Series):
-            return { "__series__" : True, "title" : obj.title, "plot" : obj.plot, "episodes" : obj.episodes, "identifier" : obj.identifier, "pictures" : obj.pictures,  "rating" : obj.rating,  "director" : obj.director, "genre" : obj.genre, "date" : obj.date}
+    @staticmethod
+    def encode_series(obj):
+        return { "__series__" : True, "title" : obj.title, "plot" : Series.plot.encode(obj), "episodes" : obj.episodes, "identifier" : obj.identifier, "pictures" : obj.pictures,  "rating" : obj.rating,  "director" : obj.director, "genre" : obj.genre, "date" : obj.date}
 
-        if isinstance(obj, MovieClip):
-            return { "__movieclip__" : True, "filepath" : obj.filepath, "old_filepath" : obj.old_filepath, "filesize" : obj.filesize, "checksum" : obj.checksum, "identifier" : obj.identifier, "thumbnails" : obj.thumbnails, "duration" : obj.duration, "dimensions" : obj.dimensions}        
-        
-        if isinstance(obj, Settings):
-            return { "__settings__" : True, "settings" : obj.settings} 
+    @staticmethod
+    def encode_movieclip(obj):
+        return { "__movieclip__" : True, "filepath" : obj.filepath, "old_filepath" : obj.old_filepath, "filesize" : obj.filesize, "checksum" : obj.checksum, "identifier" : obj.identifier, "thumbnails" : obj.thumbnails, "duration" : obj.duration, "dimensions" : obj.dimensions, "fingerprint" : obj.fingerprint, "checksum_algorithm" : obj.checksum_algorithm}        
+
+    @staticmethod
+    def encode_settings(obj):
+        return { "__settings__" : True, "settings" : obj.settings} 
+
+    @staticmethod
+    def encode_movieclips(obj):
+        return { "__movieclips__" : True, "dictionary" : obj.dictionary}                
+
+    @staticmethod
+    def encode_set(obj):
+        return { "__set__" : True, "contents" : list(obj)}
+
+    @staticmethod
+    def encode_string(obj):
+        return unicode(obj)
+
+    # Filled after all the classes have been defined
+    dispatch = {}
+
+
+def restore_value(value):
+    ''' Restores the dates and sets inside of a value which has been decoded without object hook '''
+    if isinstance(value, dict):
+        return SeriesOrganizerDecoder(dict((key, restore_value(item)) for key, item in value.iteritems()))
+    if isinstance(value, list):
+        return [restore_value(item) for item in value]
+    return value
+
+def date_to_ordinal(date):
+    if isinstance(date, datetime.date):
+        return date.toordinal()
+    return date
+
+def ordinal_to_date(ordinal):
+    if isinstance(ordinal, (int, long)):
+        return datetime.date.fromordinal(ordinal)
+    return restore_value(ordinal)
+
+
+class LibraryCodec(object):
+    ''' Compact, versioned format of the library files. The first line is a header, every
+        following line holds one record as a JSON list whose fields are given by position.
+        Files in the former format, a single indented JSON document, are still read.
+    '''
+
+    KIND = None
+    VERSION = 2 # long plots are stored in the blob store from version 2 on
+    HEADER_PREFIX = '{"__library__"'
+
+    def __init__(self):
+        self.encoder = SeriesOrganizerEncoder(separators = (",", ":"))
+
+    def accepts(self, filecontents):
+        return filecontents.startswith(self.HEADER_PREFIX)
+
+    def snapshot(self, contents):
+        ''' Returns a copy of the contents which dumps can encode in another thread '''
+        return [movie.snapshot() for movie in contents]
+
+    def dumps(self, contents):
+        lines = [json.dumps({"__library__" : self.KIND, "version" : self.VERSION}, sort_keys = True)]
+        for record in self.iter_records(contents):
+            lines.append(self.encoder.encode(record))
+        return "\n".join(lines) + "\n"
+
+    def loads(self, filecontents):
+        return self.build(self.iter_load(filecontents.splitlines()))
+
+    def iter_load(self, lines):
+        ''' Yields the decoded records one at a time, lines can e.g. be an open file '''
+        lines = iter(lines)
+        first_line = next(lines, "")
+        header = json.loads(first_line)
+        if header.get("__library__") != self.KIND or header.get("version") > self.VERSION:
+            raise ValueError("Unsupported library file %s" % first_line)
+        for line in lines:
+            if line.strip():
+                yield self.parse_record(json.loads(line))
+
+
+class SeriesCodec(LibraryCodec):
+    ''' Every series is one line. Its episodes are stored as positional records which
+        only contain their series reference if it differs from the series itself.
+    '''
+
+    KIND = "series"
+
+    def encode_fields(self, series):
+        return [series.title, Series.plot.encode(series), series.identifier, series.pictures, series.rating,
+                series.director, series.genre, series.date]
+
+    def encode_episodes(self, series):
+        reference = (series.title, series.identifier)
+        return [[episode.title, episode.descriptor, Episode.plot.encode(episode), episode.pictures, date_to_ordinal(episode.date),
+                 episode.identifier, episode.rating, episode.director, episode.runtime, episode.genre,
+                 episode.seen_it, episode.number, None if tuple(episode.series) == reference else episode.series]
+                for episode in series.episodes]
+
+    def iter_records(self, series_list):
+        for series in series_list:
+            yield self.encode_fields(series) + [self.encode_episodes(series)]
+
+    def decode_fields(self, fields):
+        title, plot, identifier, pictures, rating, director, genre, date = fields
+        series = Series(title, identifier = identifier, rating = restore_value(rating), director = director,
+                        genre = genre, pictures = restore_value(pictures), date = restore_value(date))
+        Series.plot.decode(series, plot)
+        return series
+
+    def decode_episodes(self, fields, episodes):
+        reference = (fields[0], fields[2])
+        decoded = []
+        for (episode_title, descriptor, episode_plot, episode_pictures, episode_date, episode_identifier,
+             episode_rating, episode_director, runtime, episode_genre, seen_it, number, series) in episodes:
+            episode = Episode(title = episode_title, descriptor = descriptor, series = reference if series is None else series,
+                              pictures = restore_value(episode_pictures), date = ordinal_to_date(episode_date),
+                              identifier = episode_identifier, rating = restore_value(episode_rating), director = episode_director,
+                              runtime = runtime, genre = episode_genre, seen_it = seen_it, number = number)
+            Episode.plot.decode(episode, episode_plot)
+            decoded.append(episode)
+        return decoded
+
+    def parse_record(self, record):
+        series = self.decode_fields(record[:-1])
+        series.episodes = self.decode_episodes(record[:-1], record[-1])
+        return series
+
+    def build(self, records):
+        return list(records)
+
+
+class SeriesManifestCodec(SeriesCodec):
+    ''' Lists the series of a sharded library together with the name of their shard.
+        The episodes are only stored in the shards.
+    '''
+
+    KIND = "series-manifest"
+
+    def snapshot(self, series_list):
+        return [series.snapshot(episodes = False) for series in series_list]
+
+    def iter_records(self, series_list):
+        for series in series_list:
+            yield [series.shard] + self.encode_fields(series)
+
+    def parse_record(self, record):
+        series = self.decode_fields(record[1:])
+        series.shard = record[0]
+        return series
+
+
+class MovieClipCodec(LibraryCodec):
+    ''' Every movie clip is one line, the manager is rebuilt from their identifiers '''
+
+    KIND = "movieclips"
+
+    def iter_records(self, movieclip_manager):
+        for movieclip in movieclip_manager:
+            yield [movieclip.filepath, movieclip.old_filepath, movieclip.identifier, movieclip.filesize,
+                   movieclip.checksum, movieclip.thumbnails, movieclip.duration, movieclip.dimensions, movieclip.fingerprint,
+                   movieclip.checksum_algorithm]
+
+    def parse_record(self, record):
+        # Fields which have been added later on are missing in older files
+        filepath, old_filepath, identifier, filesize, checksum, thumbnails, duration, dimensions, fingerprint, checksum_algorithm = (record + [None] * 10)[:10]
+        return MovieClip(filepath, old_filepath = old_filepath, identifier = identifier, filesize = filesize, checksum = checksum,
+                         thumbnails = thumbnails, duration = duration, dimensions = dimensions, fingerprint = fingerprint,
+                         checksum_algorithm = checksum_algorithm)
+
+    def build(self, records):
+        dictionary = {}
+        for movieclip in records:
+            implementation, key = movieclip.identifier.items()[0]
+            dictionary.setdefault(implementation, {}).setdefault(key, []).append(movieclip)
+        return MovieClipManager(dictionary = dictionary)
+
+
+def compress_gzip(filecontents):
+    buffer = StringIO.StringIO()
+    with contextlib.closing(gzip.GzipFile(fileobj = buffer, mode = "wb")) as f:
+        f.write(filecontents)
+    return buffer.getvalue()
+
+
+# Compression name: (magic bytes, compress function, file class used for reading)
+COMPRESSIONS = {"gzip" : ("\x1f\x8b", compress_gzip, gzip.GzipFile),
+                "bz2" : ("BZh", bz2.compress, bz2.BZ2File)}
+# Raised when a compressed file has been truncated or damaged
+DECOMPRESSION_ERRORS = (IOError, EOFError, zlib.error)
+if lzma is not None:
+    COMPRESSIONS["lzma"] = ("\xfd7zXZ\x00", lzma.compress, lzma.LZMAFile)
+    DECOMPRESSION_ERRORS += (lzma.LZMAError,)
+
+
+def get_compressions():
+    ''' Returns the names of the compressions which are available with this Python version '''
+    return sorted(COMPRESSIONS)
+
+
+def compress(filecontents, compression):
+    ''' Compresses the given file contents, unknown compressions leave them unchanged '''
+    if compression not in COMPRESSIONS:
+        return filecontents
+    if isinstance(filecontents, unicode):
+        filecontents = filecontents.encode("utf-8")
+    return COMPRESSIONS[compression][1](filecontents)
+
+
+def open_library_file(filepath):
+    ''' Opens a library file for reading. The compression is detected by the first bytes
+        of the file, so snapshots written with any of them can be read.
+    '''
+    with open(filepath, "rb") as f:
+        magic = f.read(6)
+    for signature, compress_function, file_class in COMPRESSIONS.values():
+        if magic.startswith(signature):
+            return contextlib.closing(file_class(filepath))
+    return open(filepath, "r")
+
+
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+# Errors of a save which is retried later on
+SAVE_ERRORS = (IOError, OSError, RuntimeError, sqlite3.Error)
+
+def write_atomically(filepath, filecontents):
+    ''' Writes to a temporary file first and renames it afterwards, so the file is never
+        left half written if the application crashes while saving
+    '''
+    temporary_filepath = filepath + ".tmp"
+    with open(temporary_filepath, "wb") as f:
+        f.write(filecontents)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(temporary_filepath, filepath)
+
+
+def replace_file(source, destination):
+    ''' Renames source to destination, replacing it in a single step if it exists '''
+    if sys.platform == "win32":
+        # os.rename doesn't replace existing files on Windows, but MoveFileEx does
+        if isinstance(source, unicode):
+            move_file = ctypes.windll.kernel32.MoveFileExW
+        else:
+            move_file = ctypes.windll.kernel32.MoveFileExA
+        if not move_file(source, destination, MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(source, destination)
+
+
+class BlobStore(object):
+    ''' Content addressed storage for long texts like plots. Every blob is a file named after
+        the SHA-1 of its contents, so identical texts are only stored once and a blob never
+        changes once written. The most recently read blobs are kept in a small LRU cache.
+    '''
+
+    MINIMUM_SIZE = 128 # shorter texts are stored inline
+
+    def __init__(self, directory = None, cache_size = 256):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def open(self, directory):
+        with self.lock:
+            self.directory = directory
+            self.cache.clear()
+
+    def accepts(self, text):
+        return self.directory is not None and text is not None and len(text) >= self.MINIMUM_SIZE
+
+    def get_filepath(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, text):
+        ''' Stores the text and returns the key it can be read with '''
+        data = text.encode("utf-8") if isinstance(text, unicode) else text
+        key = hashlib.sha1(data).hexdigest()
+        filepath = self.get_filepath(key)
+        if not os.path.exists(filepath):
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            write_atomically(filepath, data)
+        return key
+
+    def get(self, key):
+        ''' Returns the text stored under the key or raises BlobNotAvailable '''
+        with self.lock:
+            try:
+                text = self.cache.pop(key)
+            except KeyError:
+                try:
+                    with open(self.get_filepath(key), "rb") as f:
+                        text = f.read().decode("utf-8")
+                except (IOError, TypeError, AttributeError, UnicodeDecodeError), e:
+                    # The blob is gone, e.g. the library is on a drive which isn't mounted, or the
+                    # library isn't available in this process
+                    raise BlobNotAvailable("The text %s can't be read: %s" % (key, e))
+                if len(self.cache) >= self.cache_size:
+                    self.cache.popitem(last = False)
+            self.cache[key] = text
+            return text
+
+
+class ExternalText(object):
+    ''' A text attribute which may be kept in the blob store instead of memory. Objects read
+        from a library file only hold the key of the blob, the text is read when it is accessed.
+    '''
+
+    def __init__(self, text_attribute, key_attribute):
+        self.text_attribute = text_attribute
+        self.key_attribute = key_attribute
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return self.read(obj)
+        except BlobNotAvailable, e:
+            # Only shown as empty, the key is kept and written back on save
+            log.warning(str(e))
+            return u""
+
+    def read(self, obj):
+        ''' Returns the text, raises BlobNotAvailable if its blob can't be read '''
+        key = getattr(obj, self.key_attribute)
+        if key is None:
+            return getattr(obj, self.text_attribute)
+        return blob_store.get(key)
+
+    def __set__(self, obj, value):
+        # The order matters to the autosave thread, see encode
+        setattr(obj, self.text_attribute, value)
+        setattr(obj, self.key_attribute, None)
+
+    def encode(self, obj):
+        ''' Returns what is written to the library file in place of the text. Long texts are
+            stored in the blob store and referred to by a list holding their key.
+        '''
+        key = getattr(obj, self.key_attribute)
+        if key is None:
+            text = getattr(obj, self.text_attribute)
+            if not blob_store.accepts(text):
+                return text
+            key = blob_store.put(text)
+        return [key]
+
+    def decode(self, obj, value):
+        if isinstance(value, list):
+            setattr(obj, self.text_attribute, None)
+            setattr(obj, self.key_attribute, value[0])
+        else:
+            self.__set__(obj, value)
+
+
+def copy_and_hash(source, destination, algorithms, verify = False, blocksize = 1024 * 1024):
+    ''' Copies the contents of the file and returns {algorithm : checksum} of them, so the source
+        is read only once. If verify is set, the copy is read back and compared with the source.
+    '''
+    hashers = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    with open(source, "rb") as source_file:
+        with open(destination, "wb") as destination_file:
+            for block in iter(functools.partial(source_file.read, blocksize), ""):
+                for algorithm, hasher in hashers:
+                    hasher.update(block)
+                destination_file.write(block)
+    checksums = dict((algorithm, hasher.hexdigest()) for algorithm, hasher in hashers)
+
+    if verify:
+        algorithm, hasher = algorithms[0], hashlib.new(algorithms[0])
+        with open(destination, "rb") as destination_file:
+            for block in iter(functools.partial(destination_file.read, blocksize), ""):
+                hasher.update(block)
+        if hasher.hexdigest() != checksums[algorithm]:
+            os.remove(destination)
+            raise IOError("The copy of %s differs from the original" % source)
+    return checksums
+
+
+def identifier_key(identifier):
+    ''' Converts an identifier dictionary into a hashable key '''
+    return tuple(sorted(identifier.items()))
+
+
+class ChangeJournal(object):
+    ''' Collects the changes made to one of the library files. Instead of rewriting
+        the whole file on every save, the changed objects are appended to a journal
+        which is replayed on top of the last snapshot when the file is loaded.
+    '''
+
+    COMPACTION_THRESHOLD = 1000 # number of records after which a new snapshot is written
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = collections.OrderedDict() # changes which haven't been written yet
+        self.length = 0 # number of records in the journal file
+        self.compaction_required = False
+        self.replay_state = threading.local() # the changes made by replaying are only ignored in the replaying thread
+        self.lock = threading.Lock() # changes are also recorded by the worker threads
+        self.first_change = None # time of the oldest pending change
+        self.last_change = None # time of the latest change
+
+    def record(self, operation, movie, key):
+        ''' Remembers the given change. Multiple changes of the same object are coalesced
+            into a single record, which is encoded when the journal is flushed.
+        '''
+        if getattr(self.replay_state, "replaying", False):
+            return
+        with self.lock:
+            self.pending.pop((operation, key), None)
+            self.pending[(operation, key)] = movie
+            self.last_change = self.clock()
+            if self.first_change is None:
+                self.first_change = self.last_change
+
+    def can_append(self):
+        return not self.compaction_required and self.length + len(self.pending) <= self.COMPACTION_THRESHOLD
+
+    def get_filepath(self, directory):
+        return os.path.join(directory, self.filename)
+
+    def take_pending(self):
+        ''' Returns the pending changes as a list of ((operation, key), movie) tuples and forgets them '''
+        with self.lock:
+            pending = self.pending.items()
+            self.pending.clear()
+            self.first_change = None
+        return pending
+
+    def take_snapshot(self):
+        ''' Like take_pending, but the changed objects are copied, so another thread can encode them '''
+        return [(change, take_snapshot(movie)) for change, movie in self.take_pending()]
+
+    def flush(self, directory):
+        ''' Appends the pending changes to the journal file '''
+        self.append(directory, self.encode(self.take_pending()))
+
+    def encode(self, pending):
+        ''' Returns the changes returned by take_pending or take_snapshot as lines of the journal file '''
+        try:
+            return [json.dumps({"operation" : operation, "movie" : movie}, cls = SeriesOrganizerEncoder, encoding = "utf-8") + "\n" for (operation, key), movie in pending]
+        except RuntimeError:
+            # The changes are lost for the journal, so fall back to a complete snapshot
+            self.compaction_required = True
+            raise
+
+    def append(self, directory, lines):
+        ''' Appends lines returned by encode to the journal file '''
+        if len(lines) == 0:
+            return
+
+        try:
+            with open(self.get_filepath(directory), "a") as f:
+                f.writelines(lines)
+        except IOError:
+            self.compaction_required = True
+            raise
+
+        self.length += len(lines)
+
+    def discard_pending(self):
+        with self.lock:
+            self.pending.clear()
+            self.first_change = None
+
+    def get_change_times(self):
+        ''' Returns the times of the oldest pending and of the latest change, or None if nothing is pending '''
+        with self.lock:
+            if self.first_change is None:
+                return None
+            return self.first_change, self.last_change
+
+    def clear(self, directory):
+        ''' Removes the journal file. This is called after a new snapshot has been written '''
+        filepath = self.get_filepath(directory)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        self.length = 0
+
+    def reset(self):
+        ''' Forgets every pending change and forces a new snapshot on the next save '''
+        self.discard_pending()
+        self.compaction_required = True
+
+    def read_records(self, directory):
+        ''' Returns the records of the journal file as a list of (operation, movie) tuples '''
+        filepath = self.get_filepath(directory)
+        self.length = 0
+        records = []
+        if not os.path.exists(filepath):
+            return records
+
+        with open(filepath, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line, object_hook = SeriesOrganizerDecoder, encoding = "utf-8")
+                except ValueError:
+                    # The last record might be incomplete if the application crashed while saving
+                    self.compaction_required = True
+                    break
+                records.append((record["operation"], record["movie"]))
+        self.length = len(records)
+        return records
+
+    def apply_records(self, contents, records):
+        self.replay_state.replaying = True
+        try:
+            for operation, movie in records:
+                getattr(self, "replay_" + operation)(contents, movie)
+        finally:
+            self.replay_state.replaying = False
+
+    def replay(self, contents, directory):
+        ''' Applies the records of the journal file to the given snapshot contents '''
+        self.apply_records(contents, self.read_records(directory))
+
+    def get_series_key(self, operation, movie):
+        ''' Returns the key of the series a record of the series journal belongs to '''
+        if operation == "series":
+            return identifier_key(movie.identifier)
+        elif operation == "delete_series":
+            return identifier_key(movie)
+        try:
+            return identifier_key(movie.series[1])
+        except (IndexError, AttributeError):
+            return None
+
+    def start_incremental_replay(self, directory):
+        ''' Reads the journal file and returns an IncrementalReplay of its records '''
+        return IncrementalReplay(self, self.read_records(directory))
+
+    def replay_series(self, series_list, series):
+        for index, existing_series in enumerate(series_list):
+            if existing_series.identifier == series.identifier:
+                series_list[index] = series
+                return
+        series_list.append(series)
+
+    def replay_delete_series(self, series_list, identifier):
+        for index, existing_series in enumerate(series_list):
+            if existing_series.identifier == identifier:
+                del series_list[index]
+                return
+
+    def replay_episode(self, series_list, episode):
+        for series in series_list:
+            if series.identifier == episode.series[1]:
+                for index, existing_episode in enumerate(series.episodes):
+                    if existing_episode.identifier == episode.identifier:
+                        series.episodes[index] = episode
+                        series.invalidate_seasons()
+                        series.dirty = True
+                        return
+
+    def find_movieclip(self, movieclip_manager, movieclip, filepaths = None):
+        if filepaths is None:
+            filepaths = [movieclip.filepath]
+        bucket = movieclip_manager[movieclip.identifier.items()[0]]
+        if not any(movieclip_manager.get_owner_by_filepath(filepath) is not None for filepath in filepaths):
+            return bucket, None
+        for index, existing_movieclip in enumerate(bucket):
+            if existing_movieclip.filepath in filepaths:
+                return bucket, index
+        return bucket, None
+
+    def replay_add_movieclip(self, movieclip_manager, movieclip):
+        bucket, index = self.find_movieclip(movieclip_manager, movieclip)
+        if index is None:
+            movieclip_manager.add(movieclip)
+
+    def replay_remove_movieclip(self, movieclip_manager, movieclip):
+        bucket, index = self.find_movieclip(movieclip_manager, movieclip)
+        if index is not None:
+            movieclip_manager.unindex_movieclip(bucket.pop(index))
+
+    def replay_update_movieclip(self, movieclip_manager, movieclip):
+        # The movie clip might have been moved since the last save
+        bucket, index = self.find_movieclip(movieclip_manager, movieclip, filepaths = [movieclip.filepath, movieclip.old_filepath])
+        if index is not None:
+            movieclip_manager.unindex_movieclip(bucket[index])
+            bucket[index] = movieclip
+            movieclip_manager.index_movieclip(movieclip)
+
+
+class IncrementalReplay(object):
+    ''' Like ChangeJournal.replay, but for series which arrive one at a time. Every series gets
+        the records which belong to it, the series which have been added since the snapshot was
+        written are returned by finish.
+    '''
+
+    def __init__(self, journal, records):
+        self.journal = journal
+        self.records = records
+        self.keys = [journal.get_series_key(operation, movie) for operation, movie in records]
+        self.records_by_key = collections.defaultdict(list)
+        for key, record in zip(self.keys, records):
+            self.records_by_key[key].append(record)
+
+    def apply(self, series):
+        ''' Returns the series with its records applied, the list is empty if it has been deleted '''
+        contents = [series]
+        self.journal.apply_records(contents, self.records_by_key.pop(identifier_key(series.identifier), []))
+        return contents
+
+    def finish(self):
+        contents = []
+        self.journal.apply_records(contents, [record for key, record in zip(self.keys, self.records) if key in self.records_by_key])
+        self.records_by_key.clear()
+        return contents
+
+
+class SeriesShardStorage(object):
+    ''' Stores every series in a file of its own and their order and details in a manifest.
+        Only the series which have been changed are written on save. The episodes of a
+        series are read from its shard when they are accessed for the first time.
+    '''
+
+    MANIFEST = "manifest.json"
+
+    lock = threading.RLock() # guards the loading of the episodes, shared by all instances
+
+    def __init__(self, directory, compression = None):
+        self.directory = directory
+        self.compression = compression
+        self.codec = SeriesCodec()
+        self.manifest_codec = SeriesManifestCodec()
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.directory, self.MANIFEST))
+
+    def read(self, filename):
+        with open_library_file(os.path.join(self.directory, filename)) as f:
+            return f.read()
+
+    def write(self, filename, filecontents):
+        write_atomically(os.path.join(self.directory, filename), compress(filecontents, self.compression))
+
+    def load_series(self):
+        ''' Returns the series listed in the manifest without their episodes or None
+            if there is no usable manifest.
+        '''
+        try:
+            series_list = self.manifest_codec.loads(self.read(self.MANIFEST))
+        except (ValueError,) + DECOMPRESSION_ERRORS:
+            return None
+
+        for series in series_list:
+            series.set_episode_loader(self.load_episodes)
+            series.dirty = False
+        return series_list
+
+    def parse_shard(self, series):
+        try:
+            record = json.loads(self.read(series.shard).splitlines()[1])
+            return self.codec.decode_episodes(record[:-1], record[-1])
+        except (ValueError, IndexError, TypeError) + DECOMPRESSION_ERRORS:
+            # The shard is missing or damaged, the series stays unloaded so it isn't overwritten
+            return None
+
+    def assign_episodes(self, series, episodes):
+        with self.lock:
+            if episodes is not None and not series.is_loaded():
+                series.episodes = episodes
+                identifier_index.add_series(series)
+
+    def load_episodes(self, series):
+        with self.lock:
+            if not series.is_loaded():
+                self.assign_episodes(series, self.parse_shard(series))
+
+    def load_all(self, series_list, number_of_threads = 4):
+        ''' Loads the shards of all the given series which haven't been loaded yet, reading
+            several of them in parallel
+        '''
+        pending = collections.deque(series for series in series_list if not series.is_loaded() and series.shard is not None)
+
+        def load_pending():
+            while True:
+                try:
+                    series = pending.popleft()
+                except IndexError:
+                    return
+                if not series.is_loaded():
+                    self.assign_episodes(series, self.parse_shard(series))
+
+        threads = [threading.Thread(target = load_pending) for number in range(min(number_of_threads, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # e.g. the series of a database which has been read before switching to shards
+        for series in series_list:
+            series.load_episodes()
+
+    def get_shard_name(self, series, used_names):
+        name = hashlib.md5(json.dumps(identifier_key(series.identifier))).hexdigest()
+        candidate = name + ".json"
+        counter = 1
+        while candidate in used_names:
+            candidate = "%s-%s.json" % (name, counter)
+            counter += 1
+        return candidate
+
+    def save_series(self, series_list):
+        ''' Writes the changed series and the manifest and removes the shards of deleted series '''
+        self.prepare_series(series_list)()
+
+    def prepare_series(self, series_list):
+        ''' Copies the changed series and the manifest and returns a function which encodes and
+            writes them and removes the shards of deleted series
+        '''
+        shards = []
+        used_names = set()
+        for series in series_list:
+            if series.shard is None or series.shard in used_names:
+                series.load_episodes()
+                if series.is_loaded():
+                    series.shard = self.get_shard_name(series, used_names)
+                    series.dirty = True
+            used_names.add(series.shard)
+
+            if series.dirty:
+                # e.g. every series after the compression has been changed
+                series.load_episodes()
+            # A shard which couldn't be read is kept instead of being replaced by an empty one
+            if series.dirty and series.is_loaded():
+                shards.append((series, series.shard, self.codec.snapshot([series])))
+                series.dirty = False
+
+        manifest = self.manifest_codec.snapshot(series_list)
+
+        def write():
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                for series, shard, contents in shards:
+                    self.write(shard, self.codec.dumps(contents))
+            except SAVE_ERRORS:
+                # The series are written again on the next save
+                for series, shard, contents in shards:
+                    series.dirty = True
+                raise
+
+            self.write(self.MANIFEST, self.manifest_codec.dumps(manifest))
+
+            for filename in os.listdir(self.directory):
+                if filename != self.MANIFEST and filename not in used_names:
+                    os.remove(os.path.join(self.directory, filename))
+
+        return write
+
+
+class SQLiteStorage(object):
+    ''' Stores the series, episodes and movie clips in a SQLite database. Unlike the JSON files
+        the episodes of a series are only read when they are accessed for the first time and
+        changes can be written row by row.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS library_info (name TEXT PRIMARY KEY, value TEXT);
+
+        CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, position INTEGER, implementation TEXT, key TEXT,
+                                           identifier TEXT, title TEXT, plot TEXT, rating TEXT, director TEXT,
+                                           genre TEXT, date TEXT, pictures TEXT);
+        CREATE INDEX IF NOT EXISTS series_identifier ON series (implementation, key);
+
+        CREATE TABLE IF NOT EXISTS episodes (id INTEGER PRIMARY KEY, series_id INTEGER, position INTEGER,
+                                             implementation TEXT, key TEXT, identifier TEXT, series TEXT,
+                                             title TEXT, descriptor TEXT, number INTEGER, airdate INTEGER, date TEXT,
+                                             plot TEXT, rating TEXT, pictures TEXT, director TEXT, runtime TEXT,
+                                             genre TEXT, seen_it INTEGER);
+        CREATE INDEX IF NOT EXISTS episodes_identifier ON episodes (implementation, key);
+        CREATE INDEX IF NOT EXISTS episodes_series ON episodes (series_id, position);
+        CREATE INDEX IF NOT EXISTS episodes_airdate ON episodes (airdate);
+
+        CREATE TABLE IF NOT EXISTS movieclips (id INTEGER PRIMARY KEY, implementation TEXT, key TEXT, identifier TEXT,
+                                               filepath TEXT, old_filepath TEXT, filesize INTEGER, checksum TEXT,
+                                               thumbnails TEXT, duration REAL, dimensions TEXT, fingerprint TEXT,
+                                               checksum_algorithm TEXT);
+        CREATE INDEX IF NOT EXISTS movieclips_identifier ON movieclips (implementation, key);
+        CREATE INDEX IF NOT EXISTS movieclips_checksum ON movieclips (checksum);
+        CREATE INDEX IF NOT EXISTS movieclips_filepath ON movieclips (filepath);
+    '''
+
+    EPISODE_COLUMNS = "series_id, position, implementation, key, identifier, series, title, descriptor, number, airdate, date, plot, rating, pictures, director, runtime, genre, seen_it"
+    MOVIECLIP_COLUMNS = "implementation, key, identifier, filepath, old_filepath, filesize, checksum, thumbnails, duration, dimensions, fingerprint, checksum_algorithm"
+
+    # Turn the object of a pending change into the values its apply method expects
+    CHANGE_ENCODERS = {"series" : "series_record", "delete_series" : "encode", "episode" : "episode_values",
+                       "add_movieclip" : "movieclip_row", "remove_movieclip" : "movieclip_row", "update_movieclip" : "movieclip_row"}
+
+    # (table, column, type) of the columns which have been added after the first release of the schema
+    ADDED_COLUMNS = [("movieclips", "fingerprint", "TEXT"), ("movieclips", "checksum_algorithm", "TEXT")]
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def exists(self):
+        return os.path.isfile(self.filepath)
+
+    @contextlib.contextmanager
+    def connect(self):
+        ''' Opens a new connection for every transaction, so the storage can be used from any thread '''
+        connection = sqlite3.connect(self.filepath)
+        try:
+            connection.executescript(self.SCHEMA)
+            self.add_columns(connection)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def add_columns(self, connection):
+        ''' Adds the columns which are missing in databases created by a former version '''
+        for table, column, column_type in self.ADDED_COLUMNS:
+            if column not in [row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)]:
+                connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
+
+    def encode(self, value):
+        return json.dumps(value, cls = SeriesOrganizerEncoder, encoding = "utf-8")
+
+    def decode(self, text):
+        return json.loads(text, object_hook = SeriesOrganizerDecoder, encoding = "utf-8")
+
+    def placeholders(self, columns):
+        return ", ".join("?" for column in columns.split(", "))
+
+    def assignments(self, columns):
+        return ", ".join(column + " = ?" for column in columns.split(", "))
+
+    def split_identifier(self, identifier):
+        try:
+            return identifier.items()[0]
+        except (AttributeError, IndexError):
+            return None, None
+
+    def is_populated(self, connection, name):
+        return connection.execute("SELECT 1 FROM library_info WHERE name = ?", (name,)).fetchone() is not None
+
+    def set_populated(self, connection, name):
+        connection.execute("INSERT OR REPLACE INTO library_info (name, value) VALUES (?, ?)", (name, "1"))
+
+    # Conversion between rows and objects
+
+    def series_record(self, series):
+        ''' Returns the values of the series row and of its episode rows '''
+        implementation, key = self.split_identifier(series.identifier)
+        return ((implementation, key, self.encode(series.identifier), series.title, Series.plot.read(series), self.encode(series.rating),
+                 series.director, series.genre, self.encode(series.date), self.encode(series.pictures)),
+                [self.episode_values(episode) for episode in series.episodes])
+
+    def episode_values(self, episode):
+        ''' Returns the values of an episode row except for its series id and position '''
+        implementation, key = self.split_identifier(episode.identifier)
+        airdate = None
+        if isinstance(episode.date, datetime.date):
+            airdate = episode.date.toordinal()
+        return (implementation, key, self.encode(episode.identifier), self.encode(episode.series),
+                episode.title, self.encode(episode.descriptor), episode.number, airdate, self.encode(episode.date),
+                Episode.plot.read(episode), self.encode(episode.rating), self.encode(episode.pictures), episode.director,
+                episode.runtime, episode.genre, bool(episode.seen_it))
+
+    def row_to_episode(self, row):
+        (series_id, position, implementation, key, identifier, series, title, descriptor, number, airdate, date,
+         plot, rating, pictures, director, runtime, genre, seen_it) = row
+        return Episode(title = title, descriptor = self.decode(descriptor), series = self.decode(series), plot = plot,
+                       pictures = self.decode(pictures), date = self.decode(date), identifier = self.decode(identifier),
+                       rating = self.decode(rating), director = director, genre = genre, runtime = runtime,
+                       seen_it = bool(seen_it), number = number)
+
+    def movieclip_row(self, movieclip):
+        implementation, key = self.split_identifier(movieclip.identifier)
+        return (implementation, key, self.encode(movieclip.identifier), movieclip.filepath, movieclip.old_filepath,
+                movieclip.filesize, movieclip.checksum, self.encode(movieclip.thumbnails), movieclip.duration,
+                self.encode(movieclip.dimensions), movieclip.fingerprint, movieclip.checksum_algorithm)
+
+    def row_to_movieclip(self, row):
+        implementation, key, identifier, filepath, old_filepath, filesize, checksum, thumbnails, duration, dimensions, fingerprint, checksum_algorithm = row
+        return MovieClip(filepath, old_filepath = old_filepath, identifier = self.decode(identifier), filesize = filesize,
+                         checksum = checksum, thumbnails = self.decode(thumbnails), duration = duration,
+                         dimensions = self.decode(dimensions), fingerprint = fingerprint, checksum_algorithm = checksum_algorithm)
+
+    # Series and episodes
+
+    def insert_series(self, connection, record, position):
+        series_values, episode_values = record
+        cursor = connection.execute("INSERT INTO series (position, implementation, key, identifier, title, plot, rating, director, genre, date, pictures) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (position,) + series_values)
+        series_id = cursor.lastrowid
+        connection.executemany("INSERT INTO episodes (%s) VALUES (%s)" % (self.EPISODE_COLUMNS, self.placeholders(self.EPISODE_COLUMNS)),
+                               ((series_id, index) + values for index, values in enumerate(episode_values)))
+
+    def delete_series(self, connection, identifier):
+        ''' Deletes the series with the given identifier and returns its position '''
+        implementation, key = self.split_identifier(identifier)
+        for series_id, position, stored_identifier in connection.execute("SELECT id, position, identifier FROM series WHERE implementation = ? AND key = ?", (implementation, key)).fetchall():
+            if self.decode(stored_identifier) == identifier:
+                connection.execute("DELETE FROM episodes WHERE series_id = ?", (series_id,))
+                connection.execute("DELETE FROM series WHERE id = ?", (series_id,))
+                return position
+
+    def load_series(self):
+        ''' Returns the series without their episodes or None if the database hasn't been filled yet '''
+        with self.connect() as connection:
+            if not self.is_populated(connection, "series"):
+                return None
+
+            series_list = []
+            for series_id, identifier, title, plot, rating, director, genre, date, pictures in connection.execute("SELECT id, identifier, title, plot, rating, director, genre, date, pictures FROM series ORDER BY position"):
+                series = Series(title, identifier = self.decode(identifier), plot = plot, rating = self.decode(rating),
+                                director = director, genre = genre, pictures = self.decode(pictures), date = self.decode(date))
+                # The row id stays valid until the series is written again, which requires its episodes
+                series.set_episode_loader(functools.partial(self.load_episodes, series_id))
+                series_list.append(series)
+            return series_list
+
+    def load_episodes(self, series_id, series):
+        with SeriesShardStorage.lock:
+            if series.is_loaded():
+                return
+            with self.connect() as connection:
+                series.episodes = [self.row_to_episode(row) for row in connection.execute("SELECT %s FROM episodes WHERE series_id = ? ORDER BY position" % self.EPISODE_COLUMNS, (series_id,))]
+            identifier_index.add_series(series)
+
+    def save_series(self, series_list, journal, complete = False):
+        ''' Writes the pending changes of the journal to the database. The complete series list
+            is only written if requested, the journal demands it or the database is still empty.
+        '''
+        self.prepare_series(series_list, journal, complete)()
+
+    def prepare_series(self, series_list, journal, complete = False):
+        ''' Same as save_series, but only copies the changes and returns a function which writes them '''
+        if complete or journal.compaction_required:
+            # The episodes which haven't been read yet are about to be deleted
+            for series in series_list:
+                series.load_episodes()
+                if not series.is_loaded():
+                    raise IOError("The episodes of %s couldn't be read" % series.title)
+            journal.discard_pending()
+            journal.compaction_required = False
+            series_list = [series.snapshot() for series in series_list]
+
+            def write(connection):
+                records = [self.series_record(series) for series in series_list]
+                connection.execute("DELETE FROM episodes")
+                connection.execute("DELETE FROM series")
+                for position, record in enumerate(records):
+                    self.insert_series(connection, record, position)
+                self.set_populated(connection, "series")
+            return self.prepare_transaction(write, journal)
+
+        return self.prepare_changes(journal, "series")
+
+    def prepare_changes(self, journal, name):
+        ''' Copies the pending changes of the journal and returns a function which applies them.
+            If the complete library hasn't been written yet, the next save has to do it instead.
+        '''
+        pending = journal.take_snapshot()
+
+        def write(connection):
+            changes = [(operation, getattr(self, self.CHANGE_ENCODERS[operation])(movie)) for (operation, key), movie in pending]
+            if not self.is_populated(connection, name):
+                journal.compaction_required = True
+                return
+            for operation, values in changes:
+                getattr(self, "apply_" + operation)(connection, values)
+        return self.prepare_transaction(write, journal)
+
+    def prepare_transaction(self, write, journal):
+        ''' Returns a function which calls write with a connection within a single transaction '''
+        def write_transaction():
+            try:
+                with self.connect() as connection:
+                    write(connection)
+            except Exception:
+                # The changes are only in memory, so the next save has to write everything
+                journal.compaction_required = True
+                raise
+        return write_transaction
+
+    def apply_series(self, connection, record):
+        position = self.delete_series(connection, self.decode(record[0][2]))
+        if position is None:
+            position = connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM series").fetchone()[0]
+        self.insert_series(connection, record, position)
+
+    def apply_delete_series(self, connection, identifier):
+        self.delete_series(connection, self.decode(identifier))
+
+    def apply_episode(self, connection, values):
+        implementation, key = values[:2]
+        for episode_id, series_id, position in connection.execute("SELECT id, series_id, position FROM episodes WHERE implementation = ? AND key = ?", (implementation, key)).fetchall():
+            connection.execute("UPDATE episodes SET %s WHERE id = ?" % self.assignments(self.EPISODE_COLUMNS),
+                               (series_id, position) + values + (episode_id,))
+
+    # Movie clips
+
+    def load_movieclips(self):
+        ''' Returns the movie clip manager or None if the database hasn't been filled yet '''
+        dictionary = collections.defaultdict(dict)
+        with self.connect() as connection:
+            if not self.is_populated(connection, "movieclips"):
+                return None
+            for row in connection.execute("SELECT %s FROM movieclips ORDER BY id" % self.MOVIECLIP_COLUMNS):
+                implementation, key = row[0], row[1]
+                dictionary[implementation].setdefault(key, []).append(self.row_to_movieclip(row))
+        return MovieClipManager(dictionary = dictionary)
+
+    def insert_movieclip(self, connection, row):
+        connection.execute("INSERT INTO movieclips (%s) VALUES (%s)" % (self.MOVIECLIP_COLUMNS, self.placeholders(self.MOVIECLIP_COLUMNS)), row)
+
+    def save_movieclips(self, movieclips, journal, complete = False):
+        ''' Same as save_series, but for the movie clip manager '''
+        self.prepare_movieclips(movieclips, journal, complete)()
+
+    def prepare_movieclips(self, movieclips, journal, complete = False):
+        if complete or journal.compaction_required:
+            journal.discard_pending()
+            journal.compaction_required = False
+            movieclips = [movieclip.snapshot() for movieclip in movieclips]
+
+            def write(connection):
+                rows = [self.movieclip_row(movieclip) for movieclip in movieclips]
+                connection.execute("DELETE FROM movieclips")
+                for row in rows:
+                    self.insert_movieclip(connection, row)
+                self.set_populated(connection, "movieclips")
+            return self.prepare_transaction(write, journal)
+
+        return self.prepare_changes(journal, "movieclips")
+
+    # The values of a movie clip row start with implementation, key, identifier, filepath and old_filepath
+
+    def apply_add_movieclip(self, connection, row):
+        if connection.execute("SELECT 1 FROM movieclips WHERE implementation = ? AND key = ? AND filepath = ?", (row[0], row[1], row[3])).fetchone() is None:
+            self.insert_movieclip(connection, row)
+
+    def apply_remove_movieclip(self, connection, row):
+        connection.execute("DELETE FROM movieclips WHERE implementation = ? AND key = ? AND filepath = ?", (row[0], row[1], row[3]))
+
+    def apply_update_movieclip(self, connection, row):
+        connection.execute("UPDATE movieclips SET %s WHERE implementation = ? AND key = ? AND filepath IN (?, ?)" % self.assignments(self.MOVIECLIP_COLUMNS),
+                           row + (row[0], row[1], row[3], row[4]))
+
+
+class ChecksumCache(object):
+    ''' Remembers the checksums and fingerprints of files, so files which haven't changed don't
+        have to be read again. An entry is only used as long as the device, inode, size and
+        modification time of the file are the same. Entries of files which have vanished or
+        changed are evicted by a background thread when the application starts.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS checksums (filepath TEXT, kind TEXT, device INTEGER, inode INTEGER, size INTEGER,
+                                              mtime INTEGER, digest TEXT, PRIMARY KEY (filepath, kind));
+        CREATE INDEX IF NOT EXISTS checksums_inode ON checksums (device, inode, size, mtime, kind);
+    '''
+
+    TIMEOUT = 10 # seconds to wait for the writes of other threads and processes
+
+    schema_lock = threading.Lock()
+    created = set() # the cache files whose schema has been created by this process
+    local = threading.local() # the connections of the current thread by file path
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def connect(self):
+        ''' Returns the connection of the current thread, so every thread opens the cache only once '''
+        connections = self.local.__dict__.setdefault("connections", {})
+        connection = connections.get(self.filepath)
+        if connection is None:
+            connection = sqlite3.connect(self.filepath, timeout = self.TIMEOUT)
+            with self.schema_lock:
+                if self.filepath not in self.created:
+                    connection.executescript(self.SCHEMA)
+                    self.created.add(self.filepath)
+            connections[self.filepath] = connection
+        return connection
+
+    def get_file_key(self, filepath):
+        ''' Returns (device, inode, size, modification time in nanoseconds) of the file '''
+        stat = os.stat(filepath)
+        mtime = getattr(stat, "st_mtime_ns", None)
+        if mtime is None:
+            mtime = int(stat.st_mtime * 1000000000)
+        return stat.st_dev, stat.st_ino, stat.st_size, mtime
+
+    def get(self, filepath, kind, file_key = None):
+        if file_key is None:
+            file_key = self.get_file_key(filepath)
+        device, inode, size, mtime = file_key
+        # A cache which can't be read is treated like a miss
+        try:
+            connection = self.connect()
+            if inode:
+                # Also finds files which have been moved or renamed on the same device
+                row = connection.execute("SELECT digest FROM checksums WHERE device = ? AND inode = ? AND size = ? AND mtime = ? AND kind = ?",
+                                         (device, inode, size, mtime, kind)).fetchone()
+            else:
+                # Some platforms don't have inode numbers
+                row = connection.execute("SELECT digest FROM checksums WHERE filepath = ? AND size = ? AND mtime = ? AND kind = ?",
+                                         (filepath, size, mtime, kind)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is not None:
+            return row[0]
+
+    def put(self, filepath, kind, digest, file_key):
+        device, inode, size, mtime = file_key
+        try:
+            connection = self.connect()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO checksums (filepath, kind, device, inode, size, mtime, digest) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (filepath, kind, device, inode, size, mtime, digest))
+        except sqlite3.Error:
+            # e.g. still locked by another process after the timeout, the digest is calculated again next time
+            pass
+
+    def evict(self):
+        ''' Removes the entries of files which have vanished or changed. Checking the files can take
+            long, e.g. if they are on a network drive, so the cache isn't locked meanwhile.
+        '''
+        try:
+            connection = self.connect()
+            entries = connection.execute("SELECT filepath, device, inode, size, mtime FROM checksums").fetchall()
+            invalid = []
+            for filepath, device, inode, size, mtime in entries:
+                try:
+                    valid = self.get_file_key(filepath) == (device, inode, size, mtime)
+                except OSError:
+                    valid = False
+                if not valid:
+                    invalid.append((filepath, device, inode, size, mtime))
+            with connection:
+                # Entries which have been replaced in the meantime are kept
+                connection.executemany("DELETE FROM checksums WHERE filepath = ? AND device = ? AND inode = ? AND size = ? AND mtime = ?", invalid)
+        except sqlite3.Error:
+            # The entries are evicted the next time instead
+            pass
+
+    def evict_in_background(self):
+        ''' Evicts the entries in a daemon thread, which is returned '''
+        thread = threading.Thread(target = self.evict, name = "Checksum cache eviction")
+        thread.daemon = True
+        thread.start()
+        return thread
 
-        if isinstance(obj, MovieClipManager):
-            return { "__movieclips__" : True, "dictionary" : obj.dictionary}                
-        
-        if isinstance(obj, set):
-            return { "__set__" : True, "contents" : list(obj)}
-        
-        if isinstance(obj, QtCore.QString):
-            return unicode(obj)        
-        
-        return json.JSONEncoder.default(self, obj)
 
 class Settings(object):
+
+    save_lock = threading.RLock() # the library is saved by the autosave thread as well
+
     def __init__(self, settings=None, implementations=None):
         
         if implementations is None:
@@ -208,11 +1499,17 @@ class Settings(object):
                              "sources" : self.get_sources(),
                              "merge_policy_series" : MergePolicy.OVERWRITE,
                              "merge_policy_episode" : MergePolicy.OVERWRITE,
+                             "journal_changes" : True,
+                             "storage_backend" : "json",
+                             "snapshot_compression" : "none",
+                             "checksum_algorithm" : DEFAULT_CHECKSUM_ALGORITHM,
+                             "verify_copies" : False,
                              }
         else:
             self.settings = settings
 
         self.valid_extensions = ("mkv", "avi", "mpgeg", "mpg", "wmv", "mp4", "mov")
+        self.saved_settings = None # the contents of settings.json when it was read or written
 
     def __str__(self):
         return str(self.settings)
@@ -321,9 +1618,10 @@ class Settings(object):
         return os.path.join(self.settings["deployment_folder"], episode.series[0], "Season " + str(episode.descriptor[0]), filename)
 
 
-    def move_file_to_folder_structure(self, episode, filepath, placementpolicy, new_filename=None):
+    def move_file_to_folder_structure(self, episode, filepath, placementpolicy, new_filename=None, algorithms=None):
         ''' This method is responsible for moving the given file, specified via filepath, to the calculated destination.
             It is also possible to define a new filename with the help of the new_filename parameter.
+            If algorithms are given, a copied file is hashed while it is copied and {algorithm : checksum} is returned.
         '''
         
         if new_filename is not None:
@@ -341,6 +1639,8 @@ class Settings(object):
         
         # Copy / Move movie clip
         if placementpolicy == PlacementPolicy.COPY:            
+            if algorithms:
+                return copy_and_hash(filepath, destination, algorithms, verify = self.get("verify_copies"))
             shutil.copyfile(filepath, destination)
         elif placementpolicy == PlacementPolicy.MOVE:
             shutil.move(filepath, destination)
@@ -350,48 +1650,255 @@ class Settings(object):
         self.__init__(implementations=self.implementations)
     
     def save_configs(self):        
-        self.save_movieclips()
-        self.save_series()
-        self.save_settings()
+        self.prepare_save()()
+
+    def prepare_save(self):
+        ''' Takes a snapshot of the changes of the library and returns a function which encodes
+            and writes them. Only the thread which changes the library may take the snapshot, the
+            returned function can be called by any thread, e.g. the autosave thread.
+            Taking the snapshot only copies objects, encoding them, e.g. their plots, happens in the
+            returned function. Usually only the changed objects are copied, but a new snapshot of
+            the movie clips or of the database copies all of them.
+        '''
+        writers = []
+        errors = []
+        for prepare in (self.prepare_movieclips, self.prepare_series, self.prepare_settings):
+            try:
+                writers.append(prepare())
+            except SAVE_ERRORS, e:
+                errors.append(e)
+
+        def write():
+            with self.save_lock:
+                for writer in writers:
+                    try:
+                        writer()
+                    except SAVE_ERRORS, e:
+                        # The journals make sure that the next save writes what is missing
+                        errors.append(e)
+            if errors:
+                raise errors[0]
+        return write
     
     
+    def get_storage(self):
+        return SQLiteStorage(os.path.join(self.get_settings_dir(), "library.sqlite"))
+
+    def get_checksum_algorithm(self):
+        algorithm = self.get("checksum_algorithm")
+        if algorithm is None:
+            # The settings of a former version, which hashed every movie clip with SHA-224
+            return LEGACY_CHECKSUM_ALGORITHM
+        if algorithm not in get_checksum_algorithms():
+            return DEFAULT_CHECKSUM_ALGORITHM
+        return algorithm
+
+    def get_checksum_cache(self):
+        return ChecksumCache(os.path.join(self.get_settings_dir(), "checksums.sqlite"))
+
+    def uses_database(self):
+        return self.get("storage_backend") == "sqlite"
+
+    def get_series_shards(self):
+        return SeriesShardStorage(os.path.join(self.get_settings_dir(), "series"), self.get("snapshot_compression"))
+
+    def get_blob_directory(self):
+        return os.path.join(self.get_settings_dir(), "blobs")
+
+    def load_all_series(self, series_list):
+        ''' Makes sure the episodes of all series have been loaded '''
+        self.get_series_shards().load_all(series_list)
+
     def load_series(self):
-        return self.load_file("series.json", list)    
-        
+        series_iterator, replay = self.iter_series()
+        series_list = [replayed_series for series in series_iterator for replayed_series in replay.apply(series)]
+        return series_list + replay.finish()
+
+    def iter_series(self):
+        ''' Returns an iterator which reads the series of the library one at a time and the
+            IncrementalReplay of the journal, which has to be applied to them
+        '''
+        if self.uses_database():
+            series_list = self.get_storage().load_series()
+            if series_list is not None:
+                # Changes are written to the database right away
+                return iter(series_list), IncrementalReplay(series_journal, [])
+            # The database hasn't been filled yet, the library is imported on the next save
+            series_journal.compaction_required = True
+
+        replay = series_journal.start_incremental_replay(self.get_settings_dir())
+        series_list = self.get_series_shards().load_series()
+        if series_list is not None:
+            return iter(series_list), replay
+
+        # Libraries which haven't been split into shards yet are split on the next snapshot
+        return self.iter_file("series.json", SeriesCodec(), series_journal), replay
+
     def load_movieclips(self):
-        return self.load_file("movieclips.json", MovieClipManager)
-    
-    def save_series(self):
-        self.save_file("series.json", series_list)
-    
-    def save_movieclips(self):
-        self.save_file("movieclips.json", movieclips)
-    
+        if self.uses_database():
+            movieclips = self.get_storage().load_movieclips()
+            if movieclips is not None:
+                return movieclips
+            movieclips_journal.compaction_required = True
+        return self.load_file("movieclips.json", MovieClipManager, journal = movieclips_journal, codec = MovieClipCodec())
+
+    def prepare_series(self):
+        if self.uses_database() and not (context.loading and series_journal.compaction_required):
+            # While the series are being read, only the single changes can be written
+            complete = not (self.get("journal_changes") or context.loading)
+            return self.get_storage().prepare_series(list(context.series_list), series_journal, complete = complete)
+        elif context.loading:
+            # A snapshot would miss the series which haven't been read yet. The journal is
+            # replayed on top of the shards, which are read until the database has been filled.
+            return self.prepare_journal(series_journal)
+        elif self.get("journal_changes") and series_journal.can_append():
+            return self.prepare_journal(series_journal)
+
+        # Every pending change is part of the shards which are about to be written
+        series_journal.discard_pending()
+        series_journal.compaction_required = False
+        write_shards = self.get_series_shards().prepare_series(list(context.series_list))
+        directory = self.get_settings_dir()
+
+        def write():
+            try:
+                write_shards()
+            except SAVE_ERRORS:
+                series_journal.compaction_required = True
+                raise
+            series_journal.clear(directory)
+
+            legacy_filepath = os.path.join(directory, "series.json")
+            if os.path.isfile(legacy_filepath):
+                os.remove(legacy_filepath)
+        return write
+
+    def prepare_movieclips(self):
+        if self.uses_database():
+            return self.get_storage().prepare_movieclips(context.movieclips, movieclips_journal, complete = not self.get("journal_changes"))
+        return self.prepare_file("movieclips.json", context.movieclips, MovieClipCodec(), journal = movieclips_journal)
+
     def load_settings(self):
-        return self.load_file("settings.json", Settings)
-    
-    def save_settings(self):
-        self.save_file("settings.json", self)
-    
-    def save_file(self, filename, contents):
-        with open(os.path.join(self.get_settings_dir(), filename), "w") as f:
-            f.write(json.dumps(contents, sort_keys = True, indent = 4, cls = SeriesOrganizerEncoder, encoding = "utf-8"))
-        f.close()     
-    
-    def load_file(self, filename, default_value): 
-        filepath = os.path.join(self.get_settings_dir(), filename)  
+        settings = self.load_file("settings.json", Settings)
+        if os.path.isfile(os.path.join(self.get_settings_dir(), "settings.json")):
+            settings.saved_settings = settings.encode_settings()
+        return settings
+
+    def encode_settings(self):
+        return json.dumps(self, sort_keys = True, indent = 4, cls = SeriesOrganizerEncoder, encoding = "utf-8")
+
+    def prepare_settings(self):
+        ''' The settings are only written if they have been changed since they were read or written '''
+        filecontents = self.encode_settings()
+        filepath = os.path.join(self.get_settings_dir(), "settings.json")
+
+        def write():
+            if filecontents != self.saved_settings:
+                write_atomically(filepath, filecontents)
+                self.saved_settings = filecontents
+        return write
+
+    def prepare_journal(self, journal):
+        pending = journal.take_snapshot()
+        directory = self.get_settings_dir()
+
+        def write():
+            journal.append(directory, journal.encode(pending))
+        return write
+
+    def prepare_file(self, filename, contents, codec, journal = None):
+        ''' Copies the given contents and returns a function which encodes and writes them to the
+            settings directory, compressed as chosen in the settings. If a journal is given and
+            journaling is enabled, only the pending changes are appended to the journal until it
+            is time to compact it into a new snapshot.
+        '''
+        if journal is not None and self.get("journal_changes") and journal.can_append():
+            return self.prepare_journal(journal)
+
+        if journal is not None:
+            # Every pending change is part of the new snapshot. Until it has been written,
+            # they are only in memory, so a failed attempt has to be followed by a snapshot.
+            journal.discard_pending()
+            journal.compaction_required = False
+
+        contents = codec.snapshot(contents)
+        compression = self.get("snapshot_compression")
+        directory = self.get_settings_dir()
+
+        def write():
+            try:
+                write_atomically(os.path.join(directory, filename), compress(codec.dumps(contents), compression))
+            except SAVE_ERRORS:
+                if journal is not None:
+                    journal.compaction_required = True
+                raise
+            if journal is not None:
+                journal.clear(directory)
+        return write
+
+    def load_file(self, filename, default_value, journal = None, codec = None):
+        filepath = os.path.join(self.get_settings_dir(), filename)
+        contents = None
         if os.path.exists(filepath):
-            with open(filepath, "r") as f:
-                filecontents = f.read()
-            f.close() 
+            with open_library_file(filepath) as f:
+                try:
+                    first_line = f.readline()
+                    if codec is not None and codec.accepts(first_line):
+                        contents = codec.build(codec.iter_load(itertools.chain([first_line], f)))
+                    else:
+                        contents = json.loads(first_line + f.read(), object_hook = SeriesOrganizerDecoder, encoding = "utf-8")
+                except (ValueError,) + DECOMPRESSION_ERRORS:
+                    pass
+
+        if contents is None:
+            contents = default_value()
+            if journal is not None:
+                # There is no usable snapshot, so the next save has to write one
+                journal.compaction_required = True
+
+        if journal is not None:
+            journal.replay(contents, self.get_settings_dir())
+
+        return contents
+
+    def iter_file(self, filename, codec, journal):
+        ''' Yields the records of a library file one at a time. Files in the former format
+            can't be read incrementally, they are decoded at once.
+        '''
+        filepath = os.path.join(self.get_settings_dir(), filename)
+        if not os.path.exists(filepath):
+            journal.compaction_required = True
+            return
+
+        with open_library_file(filepath) as f:
             try:
-                return json.loads(filecontents, object_hook = SeriesOrganizerDecoder, encoding = "utf-8")
-            except ValueError:
-                return default_value()
-        
-        return default_value() 
+                first_line = f.readline()
+                if codec.accepts(first_line):
+                    records = codec.iter_load(itertools.chain([first_line], f))
+                else:
+                    records = iter(json.loads(first_line + f.read(), object_hook = SeriesOrganizerDecoder, encoding = "utf-8"))
+                for record in records:
+                    yield record
+            except (ValueError,) + DECOMPRESSION_ERRORS:
+                journal.compaction_required = True
+
+class SeriesDiff(object):
+    ''' The result of merging a series. Episodes which aren't listed by the source anymore
+        are only reported as removed, they are kept together with their movie clips.
+    '''
+    def __init__(self):
+        self.inserted = []
+        self.changed = []
+        self.removed = []
+
+    def __repr__(self):
+        return "<SeriesDiff: %s inserted, %s changed, %s removed>" % (len(self.inserted), len(self.changed), len(self.removed))
+
 
 class Series(object):
+
+    plot = ExternalText("plot_text", "plot_key")
+
     def __init__(self, title, plot = None, identifier = None, episodes = None, rating = None, pictures = None, director = "", genre = "", date = ""):
 
         if episodes == None:
@@ -403,7 +1910,10 @@ class Series(object):
         if pictures == None:
             pictures = []
 
-        self.episodes = episodes
+        self.episode_loader = None # loads the episodes of a series which has been read from a manifest
+        self.episode_list = episodes
+        self.shard = None # the file name of the series in a sharded library
+        self.dirty = True # the series has to be written on the next save
         self.title = title
         self.rating = rating
         self.identifier = identifier
@@ -412,7 +1922,7 @@ class Series(object):
         self.date = date
         self.pictures = pictures
         self.plot = plot
-        self.season = {}
+        self.invalidate_seasons()
     
     
     def __getitem__(self, key):
@@ -426,27 +1936,155 @@ class Series(object):
     def __repr__(self):
         return "S(" + self.title + " E: " + str(len(self.episodes)) + ")"
 
-
-    def merge(self, new_series, merge_policy = MergePolicy.MORE_INFO):        
-        if merge_policy == MergePolicy.MORE_INFO:
-            pass
-        elif merge_policy == MergePolicy.OVERWRITE:
+    @property
+    def episodes(self):
+        if self.episode_list is None:
+            self.load_episodes()
+            if self.episode_list is None:
+                # The episodes couldn't be read, they are read again on the next access
+                return []
+        return self.episode_list
+
+    @episodes.setter
+    def episodes(self, episodes):
+        self.episode_list = episodes
+        self.episode_loader = None
+        self.invalidate_seasons()
+
+    def set_episode_loader(self, episode_loader):
+        ''' The episodes are loaded by calling episode_loader with the series on first access '''
+        self.episode_list = None
+        self.episode_loader = episode_loader
+
+    def load_episodes(self):
+        # The storages assign the episodes under the same lock, e.g. from their loading threads
+        with SeriesShardStorage.lock:
+            if self.episode_list is None and self.episode_loader is not None:
+                self.episode_loader(self)
+
+    def is_loaded(self):
+        return self.episode_list is not None
+
+    def snapshot(self, episodes = True):
+        ''' Returns a copy of the series, see copy_value. The copy never loads its episodes, they
+            are copied as well if they have been loaded and episodes is set.
+        '''
+        duplicate = Series.__new__(Series)
+        for name, value in self.__dict__.items():
+            if name != "episode_list":
+                duplicate.__dict__[name] = copy_value(value)
+        duplicate.episode_loader = None
+        duplicate.episode_list = None
+        if episodes and self.episode_list is not None:
+            duplicate.episode_list = [episode.snapshot() for episode in self.episode_list]
+        duplicate.invalidate_seasons()
+        return duplicate
+
+
+    def merge(self, new_series, merge_policy = MergePolicy.MORE_INFO):
+        ''' Merges the information of a freshly downloaded series. The episodes are paired by
+            their identifier, or by their descriptor if the identifiers don't match, so an
+            inserted episode doesn't affect the others. Returns a SeriesDiff.
+        '''
+        fields = (self.title, self.rating, self.identifier, self.director, self.genre, self.date)
+        if merge_policy == MergePolicy.OVERWRITE:
             self.title = new_series.title
             self.rating = new_series.rating
             self.identifier = new_series.identifier
             self.director = new_series.director
             self.genre = new_series.genre
             self.date = new_series.date
-        
-        for index, new_episode in enumerate(new_series.episodes):
-            try:
-                self.episodes[index].merge(new_episode, merge_policy = merge_policy)
-            except IndexError:
-                self.episodes.append(new_episode)
+
+        diff = SeriesDiff()
+        by_identifier = {}
+        by_descriptor = {}
+        for episode in self.episodes:
+            by_identifier.setdefault(identifier_key(episode.identifier), episode)
+            if episode.descriptor is not None:
+                by_descriptor.setdefault(tuple(episode.descriptor), episode)
+
+        # New episodes are inserted after the episode which precedes them in the new listing
+        matched = set()
+        inserted_after = collections.defaultdict(list)
+        previous = None
+        for new_episode in new_series.episodes:
+            episode = by_identifier.get(identifier_key(new_episode.identifier))
+            if episode is None and new_episode.descriptor is not None:
+                episode = by_descriptor.get(tuple(new_episode.descriptor))
+            if episode is None or id(episode) in matched:
+                inserted_after[id(previous)].append(new_episode)
+                diff.inserted.append(new_episode)
+                continue
+
+            matched.add(id(episode))
+            previous = episode
+            if episode.merge(new_episode, merge_policy = merge_policy):
+                diff.changed.append(episode)
+
+        diff.removed = [episode for episode in self.episodes if id(episode) not in matched]
+
+        if diff.inserted:
+            episodes = list(inserted_after[id(None)])
+            for episode in self.episodes:
+                episodes.append(episode)
+                episodes.extend(inserted_after[id(episode)])
+            # The numbers count the episodes of the series, e.g. for release names which use them.
+            # The episodes in front of the first inserted one keep their numbers.
+            inserted = set(id(episode) for episode in diff.inserted)
+            start = min(index for index, episode in enumerate(episodes) if id(episode) in inserted)
+            number = episodes[start - 1].number + 1 if start > 0 else 1
+            for episode in episodes[start:]:
+                episode.number = number
+                number += 1
+            self.episodes = episodes
+        elif diff.changed:
+            # The descriptors might have changed
+            self.invalidate_seasons()
+
+        if diff.inserted or diff.changed:
+            title_index.invalidate()
+        if diff.inserted or fields != (self.title, self.rating, self.identifier, self.director, self.genre, self.date):
+            # The identifier and the episodes might have changed
+            identifier_index.add_series(self)
+            self.changed()
+        return diff
+
+    def add_episode(self, episode):
+        self.episodes.append(episode)
+        identifier_index.add_episode(episode, self)
+        title_index.add_episode(episode)
+        self.invalidate_seasons()
+
+    def changed(self):
+        ''' Records that the series or its episodes have been modified since the last save '''
+        self.dirty = True
+        series_journal.record("series", self, identifier_key(self.identifier))
+
+    def deleted(self):
+        ''' Records that the series has been removed from the library '''
+        identifier_index.remove_series(self)
+        title_index.invalidate()
+        forget_series_reference(self.title, self.identifier)
+        series_journal.record("delete_series", self.identifier, identifier_key(self.identifier))
     
+    def invalidate_seasons(self):
+        ''' Discards the cached seasons, they are rebuilt on the next access '''
+        self.seasons = None
+        self.season_offsets = None
+
     def get_seasons(self):
-        ''' Returns a dictionary of seasons. Each season contains a list of episodes '''
+        ''' Returns a dictionary of seasons. Each season contains a list of episodes.
+            The dictionary is cached and must not be modified by the caller.
+        '''
+        # Episodes which have been appended to the list directly are noticed by the length
+        if self.seasons is None or self.seasons_episode_count != len(self.episodes):
+            self.build_seasons()
+        return self.seasons
+
+    def build_seasons(self):
         self.seasons = {}
+        self.season_offsets = {}
+        self.seasons_episode_count = len(self.episodes)
 
         for episode in self.episodes:
             try:
@@ -455,20 +2093,20 @@ class Series(object):
                 self.seasons[episode.descriptor[0]] = Season(self, episode.descriptor[0])
                 self.seasons[episode.descriptor[0]].append(episode)
 
-        return self.seasons
+        accumulated_sum = 0
+        for seasonnumber in sorted(self.seasons):
+            self.season_offsets[seasonnumber] = accumulated_sum
+            accumulated_sum += len(self.seasons[seasonnumber])
 
     def accumulate_episode_count(self, season):
         ''' This function adds all the preceding episodes of the given season
         and returns the accumulated value '''
 
-        seasons = self.get_seasons()        
-        accumulated_sum = 0
-        for seasonnumber in seasons:
-            if seasonnumber == season:
-                break
-            accumulated_sum += len(seasons[seasonnumber])
-
-        return accumulated_sum
+        self.get_seasons()
+        try:
+            return self.season_offsets[season]
+        except KeyError:
+            return len(self.episodes)
 
     def get_movieclips(self):
         accumulated_movieclips =  [bucket for bucket in [episode.get_movieclips() for episode in self.episodes]]
@@ -497,7 +2135,9 @@ class Series(object):
             return datetime.date.today(), datetime.date.today()
 
         
-class Season(object):
+class Season(SlottedObject):
+    __slots__ = ("series", "episodes", "pictures", "plot", "seen_it", "season_number")
+
     def __init__(self, series, season_number):
         self.series = series
         self.episodes = []
@@ -517,6 +2157,10 @@ class Season(object):
     
     def append(self, episode):
         self.episodes.append(episode)
+
+    def changed(self):
+        ''' Seasons are built from the episodes of a series and aren't stored on their own '''
+        pass
     
     def get_date_range(self):
         pass
@@ -527,7 +2171,11 @@ class Season(object):
     def __cmp__(self, other):
         return cmp(self.season_number, other.season_number)
     
-class Episode(object):
+class Episode(SlottedObject):
+    __slots__ = ("title", "descriptor", "series", "plot_text", "plot_key", "date", "identifier", "rating", "pictures", "director", "runtime", "genre", "seen_it", "number")
+
+    plot = ExternalText("plot_text", "plot_key")
+
     def __init__(self, title = "", descriptor = None, series = "", date = None, plot = "", identifier = None, rating = None, pictures = None, director = "", runtime = "", genre = "", seen_it = False, number = 0):
         
         if pictures == None:
@@ -535,10 +2183,10 @@ class Episode(object):
             
         self.title = title
         self.descriptor = descriptor
-        self.series = series
+        self.series = intern_series_reference(series)
         self.plot = plot
         self.date = date
-        self.identifier = identifier
+        self.identifier = intern_identifier(identifier)
         self.rating = rating
         self.pictures = pictures
         self.director = director
@@ -555,7 +2203,11 @@ class Episode(object):
         return "E(" + str(self.series[0]) + " - " + str(self.title) + " " + str(self.descriptor[0]) + "x" + str(self.descriptor[1]) +  " " + str(self.date) + ")"  
     
     def get_series(self):
-        for series in series_list:
+        series = identifier_index.get_series_of_episode(self)
+        if series is not None:
+            return series
+
+        for series in context.series_list:
             if series.identifier == self.series[1]:
                 return series
     
@@ -571,7 +2223,7 @@ class Episode(object):
     
     def get_movieclips(self):
         try:
-            return movieclips[self.get_identifier()]
+            return context.movieclips[self.get_identifier()]
         except KeyError:
             return [] #return an empty list    
     
@@ -588,7 +2240,12 @@ class Episode(object):
     def get_implementation_identifier(self):
         return self.identifier.items()[0][0]
     
-    def merge(self, new_episode, merge_policy = MergePolicy.MORE_INFO):        
+    MERGED_ATTRIBUTES = ("title", "descriptor", "plot", "date", "rating", "director", "runtime", "genre", "seen_it")
+
+    def merge(self, new_episode, merge_policy = MergePolicy.MORE_INFO):
+        ''' Returns whether the episode has been changed '''
+        former_values = [getattr(self, name) for name in self.MERGED_ATTRIBUTES]
+
         # Don't overwrite series, identifier and the number, since the new episode might not have this info           
         if merge_policy == MergePolicy.MORE_INFO:
             if len(self.plot) < len(new_episode.plot):
@@ -607,6 +2264,25 @@ class Episode(object):
             self.seen_it = new_episode.seen_it
         else:
             pass
+
+        current_values = [getattr(self, name) for name in self.MERGED_ATTRIBUTES]
+        if former_values == current_values:
+            return False
+        if former_values[:2] != current_values[:2]:
+            # The seasons and the title index are built from the titles and descriptors
+            series = self.get_series()
+            if series is not None:
+                series.invalidate_seasons()
+            title_index.invalidate()
+        self.changed()
+        return True
+
+    def changed(self):
+        ''' Records that the episode has been modified since the last save '''
+        series = self.get_series()
+        if series is not None:
+            series.dirty = True
+        series_journal.record("episode", self, identifier_key(self.identifier))
             
     
     def get_ratings(self):
@@ -623,6 +2299,7 @@ class MovieClipManager(object):
             self.dictionary = collections.defaultdict(lambda:{})
         else:            
             self.dictionary = collections.defaultdict(lambda:{}, dictionary)
+        self.rebuild_index()
 
     def __getitem__(self, identifier):
        
@@ -642,20 +2319,51 @@ class MovieClipManager(object):
         
         episode_dict = {} # episode are keys, movieclips are values
         
-        for implementation in self.dictionary:
-            for key in self.dictionary[implementation]:
-                for movieclip in self.dictionary[implementation][key]:
-                    if movieclip.checksum == checksum:
-                        episode_dict[self.from_movieclip_to_episode(movieclip)] = movieclip 
+        for movieclip in self.checksums.get(checksum, []):
+            episode_dict[self.from_movieclip_to_episode(movieclip)] = movieclip 
                        
         return episode_dict
+
+    def get_episode_dict_with_matching_fingerprints(self, fingerprint):
+        ''' Same as get_episode_dict_with_matching_checksums, but for the fingerprint '''
+        episode_dict = {}
+        for movieclip in self.fingerprints.get(fingerprint, []):
+            episode_dict[self.from_movieclip_to_episode(movieclip)] = movieclip
+        return episode_dict
+
+    def get_unconfirmed_matches(self, movieclip):
+        ''' Returns the movie clips which can't be told apart from the given one by their
+            fingerprints, i.e. which have the same file size and the same or no fingerprint.
+            Only the full checksum can show whether they are identical.
+        '''
+        return [candidate for candidate in self.filesizes.get(movieclip.filesize, [])
+                if candidate is not movieclip and candidate.fingerprint in (None, movieclip.fingerprint)]
+
+    def set_checksum(self, movieclip, checksum, checksum_algorithm):
+        self.unindex_movieclip(movieclip)
+        movieclip.checksum = checksum
+        movieclip.checksum_algorithm = checksum_algorithm
+        self.index_movieclip(movieclip)
+        movieclip.changed()
+
+    def get_matching_movieclips(self, movieclip):
+        ''' Returns the movie clips which are equal to the given one, i.e. which have the same checksum and file size '''
+        if movieclip.checksum is not None:
+            candidates = self.checksums.get(movieclip.checksum, [])
+        else:
+            candidates = self.filesizes.get(movieclip.filesize, [])
+        return [candidate for candidate in candidates if candidate == movieclip]
     
     
     def from_movieclip_to_episode(self, movieclip):
         ''' This function searches through the series_list and returns the 
             first episode which is associated to the given movie clip
         '''        
-        for series in series_list:
+        episode = identifier_index.get_episode(movieclip.identifier)
+        if episode is not None:
+            return episode
+
+        for series in context.series_list:
             for episode in series.episodes:
                 if episode.identifier == movieclip.identifier:
                     return episode
@@ -666,12 +2374,25 @@ class MovieClipManager(object):
             Returns true if unique false otherwise
         '''
         
-        implementation, key = identifier
-        for another_key in self.dictionary[implementation]:
-            if another_key != key:
-                if movieclip in self.dictionary[implementation][another_key]:
-                    return False
+        if movieclip.checksum is None and movieclip.fingerprint is not None:
+            # The full checksum is only calculated if the fingerprint matches another movie clip
+            owners = self.fingerprint_owners.get(movieclip.fingerprint, {})
+        else:
+            owners = self.owners.get((movieclip.checksum, movieclip.filesize), {})
+        for another_implementation, another_key in owners:
+            if another_implementation == identifier[0] and another_key != identifier[1]:
+                return False
         return True
+
+    def get_owner_by_filepath(self, filepath):
+        ''' Returns the (implementation, key) identifier of the episode the file belongs to or None '''
+        for movieclip in self.filepaths.get(filepath, []):
+            return movieclip.identifier.items()[0]
+
+    def set_filepath(self, movieclip, filepath):
+        self.unindex_movieclip(movieclip)
+        movieclip.filepath = filepath
+        self.index_movieclip(movieclip)
         
     def add(self, movieclip):
         implementation, key = movieclip.identifier.items()[0]       
@@ -680,17 +2401,73 @@ class MovieClipManager(object):
         except KeyError:           
             self.dictionary[implementation][key] = []
             self.dictionary[implementation][key].append(movieclip) 
+        self.index_movieclip(movieclip)
+        movieclips_journal.record("add_movieclip", movieclip, id(movieclip))
 
     def remove(self, movieclip):
         for implementation in movieclip.identifier:
-            self.dictionary[implementation][movieclip.identifier[implementation]].remove(movieclip)
+            bucket = self.dictionary[implementation][movieclip.identifier[implementation]]
+            # Prefer the very same object over one which merely compares equal
+            for index, existing_movieclip in enumerate(bucket):
+                if existing_movieclip is movieclip:
+                    break
+            else:
+                index = bucket.index(movieclip)
+            self.unindex_movieclip(bucket.pop(index))
+        movieclips_journal.record("remove_movieclip", movieclip, id(movieclip))
+
+    def rebuild_index(self):
+        ''' Builds the checksum and file size lookup tables from scratch '''
+        self.checksums = collections.defaultdict(list) # checksum -> movie clips
+        self.filesizes = collections.defaultdict(list) # file size -> movie clips
+        self.fingerprints = collections.defaultdict(list) # fingerprint -> movie clips
+        self.owners = {} # (checksum, file size) -> {(implementation, key) : number of clips}
+        self.fingerprint_owners = {} # fingerprint -> {(implementation, key) : number of clips}
+        self.filepaths = collections.defaultdict(list) # file path -> movie clips
+        for movieclip in self:
+            self.index_movieclip(movieclip)
+
+    def index_movieclip(self, movieclip):
+        self.checksums[movieclip.checksum].append(movieclip)
+        self.filesizes[movieclip.filesize].append(movieclip)
+
+        owner = movieclip.identifier.items()[0]
+        owners = self.owners.setdefault((movieclip.checksum, movieclip.filesize), {})
+        owners[owner] = owners.get(owner, 0) + 1
+        self.filepaths[movieclip.filepath].append(movieclip)
+
+        if movieclip.fingerprint is not None:
+            self.fingerprints[movieclip.fingerprint].append(movieclip)
+            owners = self.fingerprint_owners.setdefault(movieclip.fingerprint, {})
+            owners[owner] = owners.get(owner, 0) + 1
+
+    def unindex_movieclip(self, movieclip):
+        for table, value in ((self.checksums, movieclip.checksum), (self.filesizes, movieclip.filesize), (self.fingerprints, movieclip.fingerprint),
+                             (self.filepaths, movieclip.filepath)):
+            bucket = table.get(value, [])
+            for index, existing_movieclip in enumerate(bucket):
+                if existing_movieclip is movieclip:
+                    del bucket[index]
+                    break
+            if not bucket:
+                table.pop(value, None)
+
+        owner = movieclip.identifier.items()[0]
+        for table, value in ((self.owners, (movieclip.checksum, movieclip.filesize)), (self.fingerprint_owners, movieclip.fingerprint)):
+            owners = table.get(value, {})
+            if owners.get(owner, 0) > 1:
+                owners[owner] -= 1
+            else:
+                owners.pop(owner, None)
+                if not owners:
+                    table.pop(value, None)
 
     def __iter__(self):
+        # Copies are iterated, the manager might be changed while it is saved in the background
         flattened_movieclips = []
-        for implementation in self.dictionary:
-            for identifier in self.dictionary[implementation]:
-                for movieclip in self.dictionary[implementation][identifier]:
-                    flattened_movieclips.append(movieclip)
+        for implementation, buckets in self.dictionary.items():
+            for identifier, movieclips in buckets.items():
+                flattened_movieclips.extend(movieclips)
         return flattened_movieclips.__iter__()
 
     def reset(self):
@@ -698,7 +2475,451 @@ class MovieClipManager(object):
 
 
 
-dummy_settings = Settings()
-settings = dummy_settings.load_settings()
-series_list = dummy_settings.load_series()
-movieclips = dummy_settings.load_movieclips()
+class IdentifierIndex(object):
+    ''' Maps the (implementation, key) identifiers of the series and episodes in the library
+        to the objects, so they can be looked up without walking through the series_list.
+    '''
+
+    def __init__(self, series_list = None):
+        self.series = {} # (implementation, key) -> series
+        self.episodes = {} # (implementation, key) -> (episode, series)
+        self.registered_keys = {} # id(series) -> keys of the series and of its episodes
+
+        if series_list is not None:
+            self.rebuild(series_list)
+
+    def rebuild(self, series_list):
+        self.clear()
+        for series in series_list:
+            self.add_series(series)
+
+    def clear(self):
+        self.series.clear()
+        self.episodes.clear()
+        self.registered_keys.clear()
+
+    def add_series(self, series):
+        ''' Adds the series and all of its episodes, replacing the entries of an earlier call '''
+        self.remove_series(series)
+        series_keys, episode_keys = self.registered_keys[id(series)] = ((series.identifier or {}).items(), [])
+        for item in series_keys:
+            self.series[item] = series
+        # The episodes of a series which hasn't been loaded yet are added once they are loaded
+        if series.is_loaded():
+            for episode in series.episodes:
+                self.add_episode(episode, series)
+
+    def add_episode(self, episode, series):
+        try:
+            series_keys, episode_keys = self.registered_keys[id(series)]
+        except KeyError:
+            self.add_series(series)
+            return
+
+        for item in (episode.identifier or {}).items():
+            self.episodes[item] = (episode, series)
+            episode_keys.append(item)
+
+    def remove_series(self, series):
+        try:
+            series_keys, episode_keys = self.registered_keys.pop(id(series))
+        except KeyError:
+            return
+
+        for item in series_keys:
+            if self.series.get(item) is series:
+                del self.series[item]
+        for item in episode_keys:
+            if self.episodes.get(item, (None, None))[1] is series:
+                del self.episodes[item]
+
+    def get_series(self, identifier):
+        ''' Returns the series with the given identifier dictionary '''
+        for item in (identifier or {}).items():
+            series = self.series.get(item)
+            if series is not None and series.identifier == identifier:
+                return series
+
+    def get_episode(self, identifier):
+        ''' Returns the episode with the given identifier dictionary '''
+        for item in (identifier or {}).items():
+            episode, series = self.episodes.get(item, (None, None))
+            if episode is not None and episode.identifier == identifier:
+                return episode
+
+    def get_series_of_episode(self, episode):
+        for item in (episode.identifier or {}).items():
+            indexed_episode, series = self.episodes.get(item, (None, None))
+            if indexed_episode is episode:
+                return series
+
+
+def normalize_title(text):
+    ''' Returns the lower case words of the text separated by single spaces '''
+    return " ".join(re.findall(r"\w+", text.lower(), re.UNICODE))
+
+
+def get_trigrams(text):
+    ''' Returns the set of three letter sequences of the lower case words of the text '''
+    text = " %s " % normalize_title(text)
+    return set(text[index:index+3] for index in xrange(len(text) - 2))
+
+
+class ReleaseName(collections.namedtuple("ReleaseName", "series_name year season episodes")):
+    ''' The series and episodes a file name like "Show.Name.S03E07.720p" refers to. The season
+        is None if the episodes are numbered through the whole series.
+    '''
+
+    def get_series_names(self):
+        if self.year is None:
+            return [self.series_name]
+        return [self.series_name + " " + str(self.year), self.series_name]
+
+    def get_keys(self):
+        return [(self.season, number) for number in self.episodes]
+
+
+RELEASE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in
+                    (r"^(?P<name>.*?)\bs(?P<season>\d{1,2}) ?e(?P<episode>\d{1,3})(?P<more>(?: ?- ?(?:s\d{1,2} ?)?e?\d{1,3}| ?e\d{1,3})*)\b",
+                     r"^(?P<name>.*?)\b(?P<season>\d{1,2})x(?P<episode>\d{2,3})(?P<more>(?: ?- ?(?:\d{1,2}x)?\d{2,3})*)\b",
+                     r"^(?P<name>.*?)\bseason ?(?P<season>\d{1,2}) ?(?:episode|ep) ?(?P<episode>\d{1,3})\b",
+                     r"^(?P<name>.*?)(?: - |\bep ?)(?P<episode>\d{1,4})(?:v\d)?\b")]
+RELEASE_YEAR = re.compile(r"^(?P<name>.+) (?P<year>(?:19|20)\d\d)$")
+RELEASE_GROUPS = re.compile(r"\[[^\]]*\]")
+RELEASE_SEPARATORS = re.compile(r"[._()]")
+RELEASE_RANGE = re.compile(r"(-)? ?(?:s(\d{1,2}) ?e|(\d{1,2})x|e)?(\d+)", re.IGNORECASE)
+# Quality and source tags which may precede the season and episode, matched on the normalized name
+RELEASE_TAGS = re.compile(r"(?: (?:480p|576p|720p|1080p|2160p|4k|uhd|hdtv|hdrip|web|web dl|webrip|bluray|blu ray|brrip|bdrip|dvdrip|"
+                          r"x264|x265|h 264|h 265|hevc|xvid|10bit|hdr|proper|repack|internal))+$")
+# Resolutions and codecs which follow a title like an absolute number, e.g. "Movie - 1080"
+RELEASE_TECHNICAL_NUMBERS = frozenset([264, 265, 480, 576, 720, 1080, 2160])
+
+def parse_release_name(filename):
+    ''' Returns the ReleaseName of a file name without extension, or None if neither a season
+        and episode (S03E07, 3x07, Season 3 Episode 7) nor an absolute number ("Show - 107")
+        can be found in it. Anything after the episode, like quality tags, is ignored, quality
+        tags in front of it are removed from the series name.
+    '''
+    text = RELEASE_SEPARATORS.sub(" ", RELEASE_GROUPS.sub(" ", filename))
+    for pattern in RELEASE_PATTERNS:
+        match = pattern.search(text)
+        if match is None:
+            continue
+        groups = match.groupdict()
+        season = int(groups["season"]) if "season" in groups else None
+        if season is None and (1900 <= int(groups["episode"]) < 2100 or int(groups["episode"]) in RELEASE_TECHNICAL_NUMBERS):
+            # A year, a resolution or a codec, not an episode
+            continue
+
+        episodes = [int(groups["episode"])]
+        for is_range, s_season, x_season, number in RELEASE_RANGE.findall(groups.get("more") or ""):
+            if (s_season or x_season) and int(s_season or x_season) != season:
+                # e.g. S01E09-S02E02, which can't be expanded without the length of the season
+                break
+            if is_range:
+                episodes.extend(range(episodes[-1] + 1, int(number) + 1))
+            else:
+                episodes.append(int(number))
+
+        name, year = RELEASE_TAGS.sub("", normalize_title(match.group("name"))), None
+        year_match = RELEASE_YEAR.match(name)
+        if year_match is not None:
+            name, year = year_match.group("name"), int(year_match.group("year"))
+        return ReleaseName(name, year, season, episodes)
+
+
+def get_release_keys(episode):
+    ''' Returns the keys of ReleaseName.get_keys which refer to the episode '''
+    return [(episode.descriptor[0], episode.descriptor[1]), (None, episode.number)]
+
+
+class TitleIndex(object):
+    ''' Maps the trigrams of the episode titles to the episodes, so the few episodes which share
+        the most trigrams with a file name can be found without comparing it to every title.
+        Episodes can also be looked up by the series name and descriptor of a ReleaseName.
+        The index is built on first use and discarded whenever episodes are changed or removed.
+    '''
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.episodes = None
+        self.postings = {} # trigram -> positions in self.episodes
+        self.releases = {} # (normalized series title, season or None, number) -> episode
+
+    def is_built(self):
+        return self.episodes is not None
+
+    def build(self, series_list):
+        self.invalidate()
+        self.episodes = []
+        for series in series_list:
+            for episode in series.episodes:
+                self.add_episode(episode)
+
+    def add_episode(self, episode):
+        # Episodes added before the index is built are picked up by build
+        if self.episodes is None:
+            return
+        position = len(self.episodes)
+        self.episodes.append(episode)
+        trigrams = set()
+        for title in episode.get_alternative_titles() + [episode.get_normalized_name()]:
+            trigrams.update(get_trigrams(title))
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, []).append(position)
+
+        series_name = normalize_title(episode.series[0])
+        year_match = RELEASE_YEAR.match(series_name)
+        for name in [series_name] + ([year_match.group("name")] if year_match is not None else []):
+            for key in get_release_keys(episode):
+                self.releases.setdefault((name,) + key, episode)
+
+    def get_candidate_positions(self, filename, count):
+        ''' Returns the positions in self.episodes of the count episodes sharing the most trigrams
+            with the file name, in library order. If fewer episodes share a trigram with it, the
+            first episodes of the library make up the rest, so there are always candidates.
+        '''
+        overlaps = collections.defaultdict(int)
+        for trigram in get_trigrams(filename):
+            for position in self.postings.get(trigram, ()):
+                overlaps[position] += 1
+        positions = set(position for position, overlap in heapq.nlargest(count, overlaps.iteritems(), key = lambda item: item[1]))
+        for position in xrange(len(self.episodes)):
+            if len(positions) >= count:
+                break
+            positions.add(position)
+        return sorted(positions)
+
+    def get_candidates(self, filename, count):
+        return [self.episodes[position] for position in self.get_candidate_positions(filename, count)]
+
+    def get_episodes(self, release_name):
+        ''' Returns the episodes the release name refers to, or an empty list if one of them is unknown '''
+        for name in release_name.get_series_names():
+            episodes = [self.releases.get((name,) + key) for key in release_name.get_keys()]
+            if all(episode is not None for episode in episodes):
+                return episodes
+        return []
+
+
+series_journal = ChangeJournal("series.journal")
+movieclips_journal = ChangeJournal("movieclips.journal")
+identifier_index = IdentifierIndex()
+title_index = TitleIndex()
+blob_store = BlobStore()
+
+SeriesOrganizerEncoder.dispatch.update({Episode : SeriesOrganizerEncoder.encode_episode,
+                                        datetime.date : SeriesOrganizerEncoder.encode_date,
+                                        Series : SeriesOrganizerEncoder.encode_series,
+                                        MovieClip : SeriesOrganizerEncoder.encode_movieclip,
+                                        Settings : SeriesOrganizerEncoder.encode_settings,
+                                        MovieClipManager : SeriesOrganizerEncoder.encode_movieclips,
+                                        set : SeriesOrganizerEncoder.encode_set,
+                                        QtCore.QString : SeriesOrganizerEncoder.encode_string})
+
+
+class LibraryContext(object):
+    ''' Holds the settings, the series and the movie clips of the library. Nothing is read
+        until one of them is accessed for the first time, so importing this module is cheap.
+        Processes which must never load the library, e.g. the workers of the process pool,
+        call opt_out.
+    '''
+
+    LAZY_ATTRIBUTES = ("settings", "series_list", "movieclips")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.loading = False # the series are still being read, see load_incrementally
+        self.replay = None # the IncrementalReplay of the series which are being read
+        self.opted_out = False
+        self.load_duration = None
+
+    def __getattr__(self, name):
+        # Only called as long as the attribute hasn't been loaded
+        if name in self.LAZY_ATTRIBUTES:
+            self.load()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def load(self):
+        with self.lock:
+            if self.loaded or self.loading:
+                return
+            if self.opted_out:
+                raise LibraryNotAvailable("The library is not available in this process")
+
+            start = time.time()
+            clear_interned_values()
+            settings = Settings().load_settings()
+            blob_store.open(settings.get_blob_directory())
+            series_list = settings.load_series()
+            movieclips = settings.load_movieclips()
+            identifier_index.rebuild(series_list)
+            title_index.invalidate()
+
+            self.settings, self.series_list, self.movieclips = settings, series_list, movieclips
+            self.loaded = True
+            self.load_duration = time.time() - start
+
+    def load_incrementally(self):
+        ''' Loads the settings and the movie clips and returns an iterator which reads the series
+            one at a time, so the library can be shown before it has been read completely. The
+            iterator can be consumed by any thread, but the series have to be passed to
+            add_loaded_series and finish_loading has to be called by the thread which uses
+            the library.
+        '''
+        with self.lock:
+            if self.loaded or self.loading:
+                return iter([])
+            if self.opted_out:
+                raise LibraryNotAvailable("The library is not available in this process")
+
+            start = time.time()
+            clear_interned_values()
+            self.settings = Settings().load_settings()
+            blob_store.open(self.settings.get_blob_directory())
+            self.movieclips = self.settings.load_movieclips()
+            self.series_list = []
+            identifier_index.clear()
+            title_index.invalidate()
+            series_iterator, self.replay = self.settings.iter_series()
+            self.loading = True
+            self.load_start = start
+            return series_iterator
+
+    def add_loaded_series(self, series):
+        ''' Applies the journal to a series read by the iterator of load_incrementally and adds it
+            to the library. Returns the series which have been added.
+        '''
+        return self.add_series(self.replay.apply(series))
+
+    def finish_loading(self):
+        ''' Adds the series which have been added since the last snapshot and returns them. Until
+            then the series list is incomplete and never written as a whole.
+        '''
+        if not self.loading:
+            return []
+        series_list = self.add_series(self.replay.finish())
+        self.replay = None
+        self.loading = False
+        self.loaded = True
+        self.load_duration = time.time() - self.load_start
+        return series_list
+
+    def add_series(self, series_list):
+        for series in series_list:
+            self.series_list.append(series)
+            identifier_index.add_series(series)
+        return series_list
+
+    def opt_out(self):
+        ''' Prevents the library from being loaded in the current process '''
+        self.opted_out = True
+
+
+context = LibraryContext()
+
+
+class AutosaveThread(threading.Thread):
+    ''' Saves the library in the background. Bursts of changes are coalesced into a single
+        save, which happens once nothing has been changed for QUIET_PERIOD seconds, but at
+        the latest MAXIMUM_DELAY seconds after the first unsaved change. The thread which
+        changes the library takes a snapshot of the changes by calling poll periodically,
+        the autosave thread encodes and writes them.
+    '''
+
+    QUIET_PERIOD = 2
+    MAXIMUM_DELAY = 30
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, settings, journals = None, clock = time.time):
+        threading.Thread.__init__(self, name = "Autosave")
+        self.clock = clock
+        self.daemon = True
+        self.settings = settings
+        if journals is None:
+            journals = [series_journal, movieclips_journal]
+        self.journals = journals
+        self.condition = threading.Condition()
+        self.requested_revision = 0 # incremented by every explicit save request
+        self.saved_revision = 0
+        self.snapshots = collections.deque() # (revision, function writing the snapshot) tuples
+        self.stopping = False
+        self.retry_time = None # set after a failed save
+        self.error = None
+
+    def request_save(self):
+        ''' Takes a snapshot of the changes and asks for it to be written as soon as possible
+            without waiting for it
+        '''
+        write = self.settings.prepare_save()
+        with self.condition:
+            self.retry_time = None
+            self.requested_revision += 1
+            self.snapshots.append((self.requested_revision, write))
+            self.condition.notify_all()
+            return self.requested_revision
+
+    def poll(self):
+        ''' Requests a save if one is due '''
+        if self.is_due():
+            self.request_save()
+
+    def flush(self):
+        ''' Saves the library and waits until it has been written '''
+        if not self.is_alive():
+            self.settings.save_configs()
+            return
+        revision = self.request_save()
+        with self.condition:
+            while self.saved_revision < revision and self.is_alive():
+                self.condition.wait(self.POLL_INTERVAL)
+
+    def stop(self):
+        ''' Writes the pending changes and ends the thread, e.g. when the application exits '''
+        self.flush()
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join()
+
+    def is_due(self):
+        now = self.clock()
+        if self.retry_time is not None:
+            return now >= self.retry_time
+        for journal in self.journals:
+            change_times = journal.get_change_times()
+            if change_times is not None:
+                first_change, last_change = change_times
+                if now - last_change >= self.QUIET_PERIOD or now - first_change >= self.MAXIMUM_DELAY:
+                    return True
+        return False
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.snapshots) == 0:
+                    if self.stopping:
+                        return
+                    self.condition.wait(self.POLL_INTERVAL)
+                revision, write = self.snapshots.popleft()
+
+            try:
+                write()
+                self.error = None
+            except SAVE_ERRORS, e:
+                # Try again later, the journals make sure the next save writes everything
+                self.retry_time = self.clock() + self.MAXIMUM_DELAY
+                self.error = e
+
+            with self.condition:
+                self.saved_revision = revision
+                self.condition.notify_all()
+
+def opt_out_of_library():
+    ''' Can be used as initializer of a multiprocessing.Pool, unlike the bound method '''
+    context.opt_out()
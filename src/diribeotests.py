@@ -1,9 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import tempfile
+import shutil
+import os
+import json
+import datetime
+import random
+import sqlite3
+import threading
+import hashlib
+import io
 
 
+import diribeomodel
 from diribeoutils import programme_available
+from diribeomodel import ChangeJournal, Series, Episode, MergePolicy, SeriesCodec, SeriesOrganizerEncoder, SeriesOrganizerDecoder
+from diribeomodel import SQLiteStorage, SeriesShardStorage, ChecksumCache, Settings, AutosaveThread, LibraryContext, MovieClipCodec, PlacementPolicy, copy_and_hash, context, MovieClip, MovieClipManager, identifier_index
+from diribeomodel import intern_series_reference, interned_values, compress, get_compressions, open_library_file, write_atomically, blob_store, TitleIndex, parse_release_name
+from diribeoworkers import WorkerThread, HashingPipeline, MultipleAssignerThread, scoring_pool, calculate_digests, calculate_fingerprint, dameraulevenshtein, compile_pattern, osa_distance, EpisodeMatcher, ScoreStatistics, STATISTICS_INTERVAL
 
 class ProcessAvailability(unittest.TestCase):
     
@@ -14,6 +29,912 @@ class ProcessAvailability(unittest.TestCase):
     def test_process_available(self):
         self.assertTrue(programme_available("ffmpeg"))
 
+
+def create_series(number_of_episodes):
+    series = Series("Test Series", identifier = {"imdb" : "0"})
+    for number in range(1, number_of_episodes+1):
+        series.episodes.append(Episode(title = "Episode %s" % number, descriptor = [1, number], series = (series.title, series.identifier), identifier = {"imdb" : str(number)}, number = number))
+    return series
+
+
+class ChangeJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = ChangeJournal("series.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay_coalesced_changes(self):
+        series = create_series(3)
+        episode = series.episodes[1]
+        episode.seen_it = True
+        self.journal.record("episode", episode, "key")
+        episode.plot = "Changed plot"
+        self.journal.record("episode", episode, "key")
+        self.journal.flush(self.directory)
+        self.assertEqual(self.journal.length, 1)
+
+        series_list = [create_series(3)]
+        self.journal.replay(series_list, self.directory)
+        self.assertTrue(series_list[0].episodes[1].seen_it)
+        self.assertEqual(series_list[0].episodes[1].plot, "Changed plot")
+
+    def test_replay_delete_series(self):
+        series = create_series(1)
+        self.journal.record("delete_series", series.identifier, "key")
+        self.journal.flush(self.directory)
+
+        series_list = [create_series(1)]
+        self.journal.replay(series_list, self.directory)
+        self.assertEqual(series_list, [])
+
+    def test_other_threads_are_recorded_while_replaying(self):
+        def replay_episode(series_list, episode):
+            thread = threading.Thread(target = self.journal.record, args = ("episode", episode, "other thread"))
+            thread.start()
+            thread.join()
+            self.journal.record("episode", episode, "replaying thread")
+
+        self.journal.replay_episode = replay_episode
+        series = create_series(1)
+        self.journal.apply_records([series], [("episode", series.episodes[0])])
+        self.assertEqual([key for (operation, key), movie in self.journal.take_pending()], ["other thread"])
+
+
+class InternedValuesTest(unittest.TestCase):
+
+    def test_deleted_series_is_forgotten(self):
+        series = create_series(1)
+        reference = intern_series_reference((series.title, {"imdb" : "0"}))
+        self.assertTrue(intern_series_reference((series.title, {"imdb" : "0"})) is reference)
+        self.assertTrue(("series", series.title, (("imdb", "0"),)) in interned_values)
+
+        series.deleted()
+        self.assertFalse(("series", series.title, (("imdb", "0"),)) in interned_values)
+
+
+class IdentifierIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        identifier_index.clear()
+
+    def tearDown(self):
+        identifier_index.clear()
+
+    def test_lookups_after_add_merge_and_remove(self):
+        series = create_series(2)
+        identifier_index.add_series(series)
+        self.assertTrue(identifier_index.get_series({"imdb" : "0"}) is series)
+        self.assertTrue(identifier_index.get_episode({"imdb" : "2"}) is series.episodes[1])
+        self.assertTrue(identifier_index.get_series_of_episode(series.episodes[0]) is series)
+        self.assertEqual(identifier_index.get_episode({"imdb" : "3"}), None)
+
+        episode = Episode(title = "Episode 3", descriptor = [1, 3], series = (series.title, series.identifier), identifier = {"imdb" : "3"}, number = 3)
+        series.add_episode(episode)
+        self.assertTrue(identifier_index.get_episode({"imdb" : "3"}) is episode)
+
+        new_series = create_series(2)
+        special = Episode(title = "Special", descriptor = [0, 1], series = (series.title, series.identifier), identifier = {"imdb" : "special"})
+        new_series.episodes.append(special)
+        series.merge(new_series)
+        self.assertTrue(identifier_index.get_episode({"imdb" : "special"}) is special)
+        self.assertTrue(identifier_index.get_series_of_episode(special) is series)
+
+        identifier_index.remove_series(series)
+        self.assertEqual(identifier_index.get_series({"imdb" : "0"}), None)
+        self.assertEqual(identifier_index.get_episode({"imdb" : "2"}), None)
+        self.assertEqual(identifier_index.get_series_of_episode(episode), None)
+
+
+class SeasonCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        identifier_index.clear()
+
+    def tearDown(self):
+        identifier_index.clear()
+
+    def test_seasons_follow_changes(self):
+        series = create_series(3)
+        identifier_index.add_series(series)
+        self.assertEqual(sorted(series.get_seasons()), [1])
+        self.assertEqual(len(series.get_seasons()[1].episodes), 3)
+
+        series.add_episode(Episode(title = "Episode 4", descriptor = [2, 1], series = (series.title, series.identifier), identifier = {"imdb" : "4"}, number = 4))
+        self.assertEqual(sorted(series.get_seasons()), [1, 2])
+        self.assertEqual(series.accumulate_episode_count(2), 3)
+
+        # A descriptor changed by an update moves the episode into another season
+        new_episode = Episode(title = "Episode 3", descriptor = [2, 0], series = (series.title, series.identifier), identifier = {"imdb" : "3"}, number = 3)
+        self.assertTrue(series.episodes[2].merge(new_episode, merge_policy = MergePolicy.OVERWRITE))
+        self.assertEqual(len(series.get_seasons()[1].episodes), 2)
+        self.assertEqual(len(series.get_seasons()[2].episodes), 2)
+
+
+class MovieClipIndexTest(unittest.TestCase):
+
+    def test_lookups_after_add_and_remove(self):
+        manager = MovieClipManager()
+        first = MovieClip("/first.avi", identifier = {"imdb" : "1"}, filesize = 10, checksum = "abc")
+        copy = MovieClip("/copy.avi", identifier = {"imdb" : "1"}, filesize = 10, checksum = "abc")
+        other = MovieClip("/other.avi", identifier = {"imdb" : "2"}, filesize = 10, checksum = "def")
+        for movieclip in (first, copy, other):
+            manager.add(movieclip)
+
+        probe = MovieClip("/probe.avi", filesize = 10, checksum = "abc")
+        self.assertEqual(manager.get_matching_movieclips(probe), [first, copy])
+        self.assertTrue(manager.check_unique(probe, ("imdb", "1")))
+        self.assertFalse(manager.check_unique(probe, ("imdb", "2")))
+
+        # The owner stays registered as long as one of its clips is left
+        manager.remove(first)
+        self.assertEqual(manager.get_matching_movieclips(probe), [copy])
+        self.assertFalse(manager.check_unique(probe, ("imdb", "2")))
+
+        manager.remove(copy)
+        self.assertEqual(manager.get_matching_movieclips(probe), [])
+        self.assertTrue(manager.check_unique(probe, ("imdb", "2")))
+        self.assertEqual(manager.get_matching_movieclips(MovieClip("/probe.avi", filesize = 10, checksum = "def")), [other])
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_fingerprint(self, filecontents):
+        filepath = os.path.join(self.directory, "movieclip.avi")
+        with open(filepath, "wb") as f:
+            f.write(filecontents)
+        return calculate_fingerprint(filepath, chunk_size = 100)
+
+    def test_first_middle_and_last_chunk(self):
+        filecontents = "".join(chr(index % 251) for index in range(1000))
+        fingerprint = self.get_fingerprint(filecontents)
+        self.assertEqual(self.get_fingerprint(filecontents), fingerprint)
+
+        # Only the chunks at 0, 450 and 900 are read
+        self.assertEqual(self.get_fingerprint(filecontents[:200] + "x" + filecontents[201:]), fingerprint)
+        for offset in (50, 500, 950):
+            self.assertNotEqual(self.get_fingerprint(filecontents[:offset] + "x" + filecontents[offset + 1:]), fingerprint)
+        self.assertNotEqual(self.get_fingerprint(filecontents + "x"), fingerprint)
+
+        # Small files are read completely
+        self.assertNotEqual(self.get_fingerprint(filecontents[:300]), self.get_fingerprint(filecontents[:150] + "x" + filecontents[151:300]))
+
+    def test_unconfirmed_matches(self):
+        manager = MovieClipManager()
+        hashed = MovieClip("/hashed.avi", identifier = {"imdb" : "1"}, filesize = 10, checksum = "abc", fingerprint = "first")
+        legacy = MovieClip("/legacy.avi", identifier = {"imdb" : "2"}, filesize = 10, checksum = "def")
+        other = MovieClip("/other.avi", identifier = {"imdb" : "3"}, filesize = 10, fingerprint = "second")
+        larger = MovieClip("/larger.avi", identifier = {"imdb" : "4"}, filesize = 11, checksum = "ghi")
+        for movieclip in (hashed, legacy, other, larger):
+            manager.add(movieclip)
+
+        # Only the full checksum can tell clips of the same size apart which have no fingerprint
+        probe = MovieClip("/probe.avi", filesize = 10, fingerprint = "first")
+        self.assertEqual(manager.get_unconfirmed_matches(probe), [hashed, legacy])
+
+        # Without checksum the owners of the fingerprint decide
+        self.assertTrue(manager.check_unique(probe, ("imdb", "1")))
+        self.assertFalse(manager.check_unique(probe, ("imdb", "5")))
+        manager.remove(hashed)
+        self.assertTrue(manager.check_unique(probe, ("imdb", "5")))
+        self.assertEqual(manager.get_unconfirmed_matches(probe), [legacy])
+
+
+class ChecksumCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ChecksumCache(os.path.join(self.directory, "checksums.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_file(self, name):
+        filepath = os.path.join(self.directory, name)
+        with open(filepath, "wb") as f:
+            f.write(name)
+        return filepath
+
+    def test_concurrent_threads(self):
+        filepaths = [self.create_file("movieclip%s.avi" % number) for number in range(8)]
+
+        def put_and_get(filepath):
+            file_key = self.cache.get_file_key(filepath)
+            for kind in ("md5", "sha224", "fingerprint"):
+                self.cache.put(filepath, kind, kind + filepath, file_key)
+                results.append(self.cache.get(filepath, kind) == kind + filepath)
+
+        results = []
+        threads = [threading.Thread(target = put_and_get, args = (filepath,)) for filepath in filepaths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 24)
+
+        # The entries of changed files aren't used anymore
+        with open(filepaths[0], "ab") as f:
+            f.write("changed")
+        self.assertEqual(self.cache.get(filepaths[0], "md5"), None)
+
+    def test_locked_cache_is_a_miss(self):
+        filepath = self.create_file("movieclip.avi")
+        self.cache.get(filepath, "md5")
+        self.cache.TIMEOUT = 0.1
+        errors = []
+
+        def put():
+            try:
+                self.cache.put(filepath, "md5", "digest", self.cache.get_file_key(filepath))
+            except sqlite3.Error, e:
+                errors.append(e)
+
+        connection = sqlite3.connect(self.cache.filepath)
+        connection.execute("BEGIN EXCLUSIVE")
+        try:
+            thread = threading.Thread(target = put)
+            thread.start()
+            thread.join()
+        finally:
+            connection.rollback()
+            connection.close()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.cache.get(filepath, "md5"), None)
+
+    def test_evict_in_background(self):
+        kept, changed, removed = [self.create_file(name) for name in ("kept.avi", "changed.avi", "removed.avi")]
+        for filepath in (kept, changed, removed):
+            self.cache.put(filepath, "md5", "digest", self.cache.get_file_key(filepath))
+        with open(changed, "ab") as f:
+            f.write("changed")
+        os.remove(removed)
+
+        self.cache.evict_in_background().join()
+        connection = sqlite3.connect(self.cache.filepath)
+        try:
+            self.assertEqual([row[0] for row in connection.execute("SELECT filepath FROM checksums")], [kept])
+        finally:
+            connection.close()
+
+
+class FakeDevicePipeline(HashingPipeline):
+    ''' Puts the files whose name starts with "a" on device 1 and all others on device 2 '''
+
+    def stat(self, filepath):
+        if filepath.startswith("missing"):
+            raise OSError(2, "No such file or directory")
+        return os.stat_result((0, 0, 1 if filepath.startswith("a") else 2, 0, 0, 0, 10, 0, 0, 0))
+
+    def get_device_limit(self, device):
+        return 1
+
+
+class HashingPipelineTest(unittest.TestCase):
+
+    def test_devices_are_read_in_parallel(self):
+        # Each device has a single thread, so a file of one device can only wait for the other device
+        events = {"a" : threading.Event(), "b" : threading.Event()}
+
+        def calculate(filepath, add_bytes):
+            if filepath == "broken":
+                raise IOError(5, "Input/output error")
+            events[filepath[0]].set()
+            self.assertTrue(events["b" if filepath[0] == "a" else "a"].wait(5))
+            add_bytes(10)
+            return filepath.upper()
+
+        pipeline = FakeDevicePipeline()
+        results = pipeline.run(["a1", "a2", "b1", "broken", "missing"], calculate)
+        self.assertEqual(results, {"a1" : "A1", "a2" : "A2", "b1" : "B1"})
+        self.assertEqual(sorted(pipeline.errors), ["broken", "missing"])
+        self.assertEqual(pipeline.byte_count, 30)
+
+    def test_unexpected_errors_are_raised(self):
+        def calculate(filepath, add_bytes):
+            raise ValueError(filepath)
+        self.assertRaises(ValueError, FakeDevicePipeline().run, ["a1", "b1"], calculate)
+
+
+class TemporaryLibraryTest(unittest.TestCase):
+    ''' Replaces the library of the context by an empty one in a temporary settings directory '''
+
+    def setUp(self):
+        self.directory = directory = tempfile.mkdtemp()
+
+        class TemporarySettings(Settings):
+            def get_settings_dir(self, platform = None, appname = None):
+                return directory
+
+        self.settings = TemporarySettings()
+        context.__dict__.update(settings = self.settings, series_list = [], movieclips = MovieClipManager())
+
+    def tearDown(self):
+        for name in context.LAZY_ATTRIBUTES:
+            context.__dict__.pop(name, None)
+        shutil.rmtree(self.directory)
+
+    def create_file(self, name, filecontents):
+        filepath = os.path.join(self.directory, name)
+        with open(filepath, "wb") as f:
+            f.write(filecontents)
+        return filepath
+
+
+class MultipleAssignerThreadTest(TemporaryLibraryTest):
+
+    def setUp(self):
+        TemporaryLibraryTest.setUp(self)
+        context.series_list.append(create_series(30))
+        diribeomodel.title_index.invalidate()
+
+    def tearDown(self):
+        diribeomodel.title_index.invalidate()
+        TemporaryLibraryTest.tearDown(self)
+
+    def test_unrelated_file_names_get_candidates(self):
+        episodes, results = MultipleAssignerThread([], None).score_filenames(["zzz", "qwerty", "Test.Series.S01E12"])
+        self.assertEqual([len(scores) for scores, mean, median in results], [MultipleAssignerThread.CANDIDATE_COUNT] * 3)
+        self.assertEqual(episodes[results[2][0][0][0]], context.series_list[0].episodes[11])
+
+    def test_scoring_in_pool(self):
+        filenames = ["Test.Series.S01E12", "Episode 3", "zzz"]
+        thread = MultipleAssignerThread([], None)
+        expected = thread.score_filenames(filenames)
+        thread.POOL_MINIMUM = 0
+        try:
+            self.assertEqual(thread.score_filenames(filenames), expected)
+            pool = scoring_pool.pool
+            self.assertEqual(thread.score_filenames(filenames[:1]), (expected[0], expected[1][:1]))
+            self.assertTrue(scoring_pool.pool is pool)
+
+            # A changed library needs processes with the new title table
+            context.series_list[0].episodes[11].title = "Renamed"
+            diribeomodel.title_index.invalidate()
+            episodes, results = thread.score_filenames(filenames[:1])
+            self.assertFalse(scoring_pool.pool is pool)
+            self.assertEqual(episodes[results[0][0][0][0]].title, "Renamed")
+        finally:
+            scoring_pool.close()
+
+
+class ChecksumAlgorithmTest(TemporaryLibraryTest):
+
+    def test_setting(self):
+        self.assertEqual(self.settings.get_checksum_algorithm(), "md5")
+        self.settings["checksum_algorithm"] = "sha256"
+        self.assertEqual(self.settings.get_checksum_algorithm(), "sha256")
+        self.settings["checksum_algorithm"] = "unknown"
+        self.assertEqual(self.settings.get_checksum_algorithm(), "md5")
+        self.assertEqual(diribeomodel.get_checksum_algorithms(), ["md5", "sha1", "sha224", "sha256", "sha512"])
+
+        # Settings of a former version keep hashing new movie clips like before
+        del self.settings.settings["checksum_algorithm"]
+        self.assertEqual(self.settings.get_checksum_algorithm(), "sha224")
+
+        # The checksums of movie clips which have been stored without algorithm are SHA-224
+        movieclip = MovieClipCodec().parse_record(["/legacy.avi", None, {"imdb" : "1"}, 10, "abc", [], None, None, None])
+        self.assertEqual((movieclip.checksum_algorithm, movieclip.get_checksum_algorithm()), (None, "sha224"))
+
+    def test_legacy_checksums_stay_valid(self):
+        self.settings["hash_movieclips"] = True
+        filecontents = "movie clip " * 100
+        legacy = MovieClip(self.create_file("legacy.avi", filecontents), identifier = {"imdb" : "1"}, checksum = hashlib.sha224(filecontents).hexdigest())
+        context.movieclips.add(legacy)
+
+        # A copy of the legacy movie clip keeps its checksum, so both are found by it
+        movieclip = WorkerThread().create_movieclip(self.create_file("copy.avi", filecontents))
+        self.assertEqual((movieclip.checksum, movieclip.get_checksum_algorithm()), (legacy.checksum, "sha224"))
+        self.assertEqual(context.movieclips.get_matching_movieclips(movieclip), [legacy])
+        self.assertFalse(context.movieclips.check_unique(movieclip, ("imdb", "2")))
+
+        # Other files are hashed with the chosen algorithm
+        other_filecontents = filecontents.upper()
+        movieclip = WorkerThread().create_movieclip(self.create_file("other.avi", other_filecontents))
+        self.assertEqual((movieclip.checksum, movieclip.checksum_algorithm), (hashlib.md5(other_filecontents).hexdigest(), "md5"))
+        self.assertEqual(context.movieclips.get_matching_movieclips(movieclip), [])
+        self.assertTrue(context.movieclips.check_unique(movieclip, ("imdb", "2")))
+
+
+class CopyAndHashTest(TemporaryLibraryTest):
+
+    def setUp(self):
+        TemporaryLibraryTest.setUp(self)
+        self.filecontents = "".join(chr(index % 251) for index in range(2500))
+        self.source = self.create_file("source.avi", self.filecontents)
+        self.destination = os.path.join(self.directory, "destination.avi")
+
+    def test_checksums_of_the_copy(self):
+        for verify in (False, True):
+            checksums = copy_and_hash(self.source, self.destination, ["md5", "sha224"], verify = verify, blocksize = 1000)
+            self.assertEqual(checksums, {"md5" : hashlib.md5(self.filecontents).hexdigest(), "sha224" : hashlib.sha224(self.filecontents).hexdigest()})
+            self.assertEqual(checksums, calculate_digests(self.destination, ["md5", "sha224"]))
+            with open(self.destination, "rb") as f:
+                self.assertEqual(f.read(), self.filecontents)
+
+        empty = self.create_file("empty.avi", "")
+        self.assertEqual(copy_and_hash(empty, self.destination, ["md5"], verify = True), {"md5" : hashlib.md5("").hexdigest()})
+        self.assertEqual(os.path.getsize(self.destination), 0)
+
+    def test_damaged_copy_is_removed(self):
+        def open_damaged(filepath, mode = "r"):
+            with open(filepath, mode) as f:
+                filecontents = f.read() if mode == "rb" else None
+            if filepath == self.destination and mode == "rb":
+                return io.BytesIO(filecontents[:-1] + "x")
+            return open(filepath, mode)
+
+        diribeomodel.open = open_damaged
+        try:
+            self.assertRaises(IOError, copy_and_hash, self.source, self.destination, ["md5"], verify = True)
+        finally:
+            del diribeomodel.open
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_copy_into_folder_structure(self):
+        self.settings["deployment_folder"] = os.path.join(self.directory, "deployment")
+        episode = create_series(1).episodes[0]
+        checksums = self.settings.move_file_to_folder_structure(episode, self.source, PlacementPolicy.COPY, algorithms = ["md5"])
+        self.assertEqual(checksums, {"md5" : hashlib.md5(self.filecontents).hexdigest()})
+        self.assertEqual(calculate_digests(self.settings.calculate_filepath(episode, "source.avi", normalize = False), ["md5"]), checksums)
+        self.assertTrue(os.path.isfile(self.source))
+
+
+class MovieClipJournalTest(unittest.TestCase):
+
+    def test_replay_clips_sharing_a_filepath(self):
+        first = MovieClip("/shared.avi", identifier = {"imdb" : "1"}, filesize = 10, checksum = "abc")
+        second = MovieClip("/shared.avi", identifier = {"imdb" : "2"}, filesize = 10, checksum = "abc")
+        manager = MovieClipManager({"imdb" : {"1" : [first], "2" : [second]}})
+
+        manager.remove(second)
+        self.assertEqual(manager.get_owner_by_filepath("/shared.avi"), ("imdb", "1"))
+
+        # Removing the remaining clip from the journal must find it
+        journal = ChangeJournal("movieclips.journal")
+        journal.replay_remove_movieclip(manager, first)
+        self.assertEqual(list(manager), [])
+        self.assertEqual(manager.get_owner_by_filepath("/shared.avi"), None)
+
+
+class SeriesMergeTest(unittest.TestCase):
+
+    def test_merge_inserted_episode(self):
+        series = create_series(3)
+        new_series = create_series(3)
+        special = Episode(title = "Special", descriptor = [0, 1], series = (series.title, series.identifier), identifier = {"imdb" : "special"})
+        new_series.episodes.insert(1, special)
+        new_series.episodes[2].title = "Renamed"
+
+        diff = series.merge(new_series, merge_policy = MergePolicy.OVERWRITE)
+        self.assertEqual(diff.inserted, [special])
+        self.assertEqual(diff.changed, [series.episodes[2]])
+        self.assertEqual(diff.removed, [])
+        self.assertEqual([episode.title for episode in series.episodes], ["Episode 1", "Special", "Renamed", "Episode 3"])
+        self.assertEqual([episode.number for episode in series.episodes], [1, 2, 3, 4])
+
+    def test_only_episodes_after_the_insertion_are_renumbered(self):
+        series = create_series(3)
+        for episode in series.episodes:
+            episode.number += 10
+        new_series = create_series(3)
+        new_series.episodes.insert(2, Episode(title = "Special", descriptor = [0, 1], series = (series.title, series.identifier), identifier = {"imdb" : "special"}))
+
+        series.merge(new_series)
+        self.assertEqual([episode.title for episode in series.episodes], ["Episode 1", "Episode 2", "Special", "Episode 3"])
+        self.assertEqual([episode.number for episode in series.episodes], [11, 12, 13, 14])
+
+
+class LibraryCodecTest(unittest.TestCase):
+
+    def test_series_round_trip(self):
+        series = create_series(3)
+        series.date = datetime.date(2001, 2, 3)
+        series.episodes[0].date = datetime.date(2001, 2, 3)
+        series.episodes[0].rating = {"imdb" : [8.5, 100]}
+        series.episodes[2].series = ("Former Title", series.identifier)
+
+        # The former format is read and the compact one written
+        legacy = json.loads(json.dumps([series], cls = SeriesOrganizerEncoder), object_hook = SeriesOrganizerDecoder)
+        codec = SeriesCodec()
+        filecontents = codec.dumps(legacy)
+        self.assertTrue(codec.accepts(filecontents))
+
+        loaded = codec.loads(filecontents)[0]
+        self.assertEqual(json.dumps(loaded, cls = SeriesOrganizerEncoder, sort_keys = True),
+                         json.dumps(series, cls = SeriesOrganizerEncoder, sort_keys = True))
+
+    def test_compressed_snapshots(self):
+        codec = SeriesCodec()
+        filecontents = codec.dumps([create_series(3)])
+        directory = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(directory, "series.json")
+            for compression in ["none"] + get_compressions():
+                write_atomically(filepath, compress(filecontents, compression))
+                with open_library_file(filepath) as f:
+                    self.assertEqual(f.read(), filecontents)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_plots_in_blob_store(self):
+        series = create_series(2)
+        series.episodes[0].plot = u"A plot which is long enough to be stored out of line. " * 4
+        directory = tempfile.mkdtemp()
+        former_directory = blob_store.directory
+        blob_store.open(directory)
+        try:
+            codec = SeriesCodec()
+            loaded = codec.loads(codec.dumps([series]))[0]
+            self.assertEqual(loaded.episodes[0].plot_text, None)
+            self.assertEqual(loaded.episodes[0].plot, series.episodes[0].plot)
+            self.assertEqual(loaded.episodes[1].plot, series.episodes[1].plot)
+        finally:
+            blob_store.open(former_directory)
+            shutil.rmtree(directory)
+
+    def test_missing_blob_keeps_its_reference(self):
+        series = create_series(1)
+        series.episodes[0].plot = u"A plot which is long enough to be stored out of line. " * 4
+        directory = tempfile.mkdtemp()
+        former_directory = blob_store.directory
+        blob_store.open(directory)
+        try:
+            codec = SeriesCodec()
+            series = codec.loads(codec.dumps([series]))[0]
+            episode = series.episodes[0]
+            key = episode.plot_key
+            shutil.rmtree(os.path.join(directory, key[:2]))
+            blob_store.open(directory)
+
+            self.assertEqual(episode.plot, u"")
+            self.assertRaises(IOError, Episode.plot.read, episode)
+            self.assertEqual(codec.loads(codec.dumps([series]))[0].episodes[0].plot_key, key)
+            # e.g. the records of the journal
+            encoded = json.dumps(episode, cls = SeriesOrganizerEncoder)
+            self.assertEqual(json.loads(encoded, object_hook = SeriesOrganizerDecoder).plot_key, key)
+        finally:
+            blob_store.open(former_directory)
+            shutil.rmtree(directory)
+
+
+class SeriesShardStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_damaged_shard_is_kept(self):
+        SeriesShardStorage(self.directory).save_series([create_series(2), create_series(3)])
+        storage = SeriesShardStorage(self.directory)
+        series_list = storage.load_series()
+        filepath = os.path.join(self.directory, series_list[0].shard)
+        with open(filepath, "wb") as f:
+            f.write("damaged")
+
+        self.assertEqual(series_list[0].episodes, [])
+        self.assertFalse(series_list[0].is_loaded())
+        self.assertEqual(len(series_list[1].episodes), 3)
+        storage.save_series(series_list)
+        with open(filepath, "rb") as f:
+            self.assertEqual(f.read(), "damaged")
+
+    def test_rewrite_with_other_compression(self):
+        SeriesShardStorage(self.directory).save_series([create_series(2), create_series(3)])
+        series_list = SeriesShardStorage(self.directory).load_series()
+        for series in series_list:
+            series.dirty = True
+        SeriesShardStorage(self.directory, "bz2").save_series(series_list)
+
+        for series in series_list:
+            with open(os.path.join(self.directory, series.shard), "rb") as f:
+                self.assertTrue(f.read().startswith("BZh"))
+        self.assertEqual([len(series.episodes) for series in SeriesShardStorage(self.directory).load_series()], [2, 3])
+
+
+class SQLiteStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = SQLiteStorage(os.path.join(self.directory, "library.sqlite"))
+        self.journal = ChangeJournal("series.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_series_round_trip(self):
+        self.assertEqual(self.storage.load_series(), None)
+        self.storage.save_series([create_series(3), create_series(2)], self.journal, complete = True)
+
+        series_list = self.storage.load_series()
+        self.assertEqual(len(series_list), 2)
+        # The episodes are only read when they are accessed
+        self.assertFalse(series_list[0].is_loaded())
+        self.assertEqual([episode.title for episode in series_list[0].episodes], ["Episode 1", "Episode 2", "Episode 3"])
+        self.assertFalse(series_list[1].is_loaded())
+
+        # Single changes are written row by row
+        series_list[0].episodes[1].seen_it = True
+        self.journal.record("episode", series_list[0].episodes[1], "key")
+        self.storage.save_series(series_list, self.journal)
+        self.assertTrue(self.storage.load_series()[0].episodes[1].seen_it)
+
+        # A complete save reads the episodes which haven't been loaded before deleting them
+        self.storage.save_series(series_list, self.journal, complete = True)
+        self.assertEqual([len(series) for series in self.storage.load_series()], [3, 2])
+
+    def test_changes_are_copied_when_prepared(self):
+        series_list = [create_series(3)]
+        self.storage.save_series(series_list, self.journal, complete = True)
+
+        # Changes made while the prepared snapshot is being written aren't part of it
+        series_list[0].episodes[0].title = "Renamed"
+        self.journal.record("episode", series_list[0].episodes[0], "key")
+        write = self.storage.prepare_series(series_list, self.journal)
+        series_list[0].episodes[0].title = "Renamed again"
+        write()
+        self.assertEqual(self.storage.load_series()[0].episodes[0].title, "Renamed")
+
+        self.journal.compaction_required = True
+        write = self.storage.prepare_series(series_list, self.journal)
+        series_list[0].episodes.pop()
+        write()
+        self.assertEqual(len(self.storage.load_series()[0].episodes), 3)
+
+    def test_migrate_movieclips(self):
+        # The movie clips table as it was before fingerprints and checksum algorithms were stored
+        connection = sqlite3.connect(self.storage.filepath)
+        connection.executescript('''
+            CREATE TABLE library_info (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE movieclips (id INTEGER PRIMARY KEY, implementation TEXT, key TEXT, identifier TEXT,
+                                     filepath TEXT, old_filepath TEXT, filesize INTEGER, checksum TEXT,
+                                     thumbnails TEXT, duration REAL, dimensions TEXT);
+            INSERT INTO library_info VALUES ('movieclips', '1');
+            INSERT INTO movieclips VALUES (1, 'imdb', '1', '{"imdb": "1"}', '/clip.avi', NULL, 3, 'abc', '[]', NULL, 'null');
+        ''')
+        connection.commit()
+        connection.close()
+
+        movieclip, = self.storage.load_movieclips()
+        self.assertEqual((movieclip.filepath, movieclip.checksum, movieclip.fingerprint, movieclip.checksum_algorithm), ("/clip.avi", "abc", None, None))
+        movieclip.fingerprint = "fingerprint"
+        self.storage.save_movieclips(MovieClipManager({"imdb" : {"1" : [movieclip]}}), ChangeJournal("movieclips.journal"), complete = True)
+        self.assertEqual(list(self.storage.load_movieclips())[0].fingerprint, "fingerprint")
+
+
+class IncrementalLoadTest(TemporaryLibraryTest):
+
+    def setUp(self):
+        TemporaryLibraryTest.setUp(self)
+        self.settings.get_series_shards().save_series([create_series(2), self.create_series("b")])
+        self.settings.prepare_settings()()
+
+        journal = ChangeJournal(diribeomodel.series_journal.filename)
+        changed = create_series(2)
+        changed.episodes[1].seen_it = True
+        journal.record("episode", changed.episodes[1], 1)
+        journal.record("delete_series", {"imdb" : "b"}, 2)
+        added = self.create_series("c")
+        journal.record("series", added, 3)
+        added.episodes[0].title = "Changed after adding"
+        journal.record("episode", added.episodes[0], 4)
+        journal.flush(self.directory)
+
+        # The context reads the settings from the temporary directory
+        self.original_settings = diribeomodel.Settings
+        diribeomodel.Settings = type(self.settings)
+
+    def tearDown(self):
+        diribeomodel.Settings = self.original_settings
+        identifier_index.clear()
+        TemporaryLibraryTest.tearDown(self)
+
+    def create_series(self, key):
+        series = Series("Series " + key, identifier = {"imdb" : key})
+        series.episodes.append(Episode(title = "Episode", descriptor = [1, 1], series = (series.title, series.identifier), identifier = {"imdb" : key + "1"}, number = 1))
+        return series
+
+    def test_series_are_added_by_the_receiving_thread(self):
+        library = LibraryContext()
+        series_iterator = library.load_incrementally()
+        self.assertTrue(library.loading)
+        self.assertFalse(library.loaded)
+
+        loaded_series = []
+        thread = threading.Thread(target = lambda: loaded_series.extend(series_iterator))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(loaded_series), 2)
+        self.assertEqual(library.series_list, [])
+
+        added = [series for loaded in loaded_series for series in library.add_loaded_series(loaded)]
+        self.assertEqual([series.title for series in added], ["Test Series"])
+        self.assertTrue(added[0].episodes[1].seen_it)
+        self.assertFalse(library.loaded)
+
+        # The series added after the snapshot gets the records which follow it
+        added, = library.finish_loading()
+        self.assertEqual(added.episodes[0].title, "Changed after adding")
+        self.assertEqual([series.title for series in library.series_list], ["Test Series", "Series c"])
+        self.assertTrue(identifier_index.get_series({"imdb" : "c"}) is added)
+        self.assertTrue(library.loaded)
+        self.assertFalse(library.loading)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class AutosaveThreadTest(TemporaryLibraryTest):
+
+    def setUp(self):
+        TemporaryLibraryTest.setUp(self)
+        self.clock = FakeClock()
+        self.journal = ChangeJournal("series.journal")
+        self.journal.clock = self.clock
+        self.saves = []
+        self.settings.prepare_save = self.prepare_save
+        self.autosave = AutosaveThread(self.settings, journals = [self.journal], clock = self.clock)
+
+    def prepare_save(self):
+        changes = [key for (operation, key), movie in self.journal.take_pending()]
+        return lambda: self.saves.append(changes)
+
+    def change(self, key, now):
+        self.clock.now = now
+        self.journal.record("episode", None, key)
+
+    def poll(self, now):
+        ''' Polls without running the thread and writes what it would write '''
+        self.clock.now = now
+        self.autosave.poll()
+        while self.autosave.snapshots:
+            revision, write = self.autosave.snapshots.popleft()
+            write()
+
+    def test_changes_are_coalesced(self):
+        self.change("first", 0)
+        self.poll(1)
+        self.change("second", 1.5)
+        self.poll(3)
+        self.assertEqual(self.saves, [])
+        self.poll(3.5)
+        self.assertEqual(self.saves, [["first", "second"]])
+        self.poll(10)
+        self.assertEqual(len(self.saves), 1)
+
+    def test_maximum_delay(self):
+        for second in range(30):
+            self.change(second, second)
+            self.poll(second + 0.5)
+        self.assertEqual(self.saves, [])
+        self.poll(30)
+        self.assertEqual(self.saves, [range(30)])
+
+    def test_stop_writes_pending_changes(self):
+        self.autosave.start()
+        self.change("first", 0)
+        self.autosave.stop()
+        self.assertEqual(self.saves, [["first"]])
+        self.assertFalse(self.autosave.is_alive())
+
+    def test_settings_are_only_written_when_changed(self):
+        filepath = os.path.join(self.directory, "settings.json")
+        Settings.prepare_settings(self.settings)()
+        os.remove(filepath)
+        Settings.prepare_settings(self.settings)()
+        self.assertFalse(os.path.exists(filepath))
+
+        self.settings["verify_copies"] = True
+        Settings.prepare_settings(self.settings)()
+        self.assertTrue(json.load(open(filepath))["settings"]["verify_copies"])
+
+    def test_snapshot_is_taken_when_prepared(self):
+        series = create_series(2)
+        context.series_list.append(series)
+        self.settings["journal_changes"] = False
+        write = Settings.prepare_save(self.settings)
+        series.title = "Renamed"
+        series.episodes[0].title = "Renamed"
+        write()
+
+        series, = self.settings.get_series_shards().load_series()
+        self.assertEqual(series.title, "Test Series")
+        self.assertEqual(series.episodes[0].title, "Episode 1")
+
+
+class EditDistanceTest(unittest.TestCase):
+
+    def test_bit_parallel_distance(self):
+        random_generator = random.Random(0)
+        def random_string():
+            return "".join(random_generator.choice("abc .") for index in range(random_generator.randint(0, 12)))
+        for index in range(2000):
+            pattern, text = random_string(), random_string()
+            self.assertEqual(osa_distance(compile_pattern(pattern), text), dameraulevenshtein(pattern, text))
+
+            # With a limit, distances above it are only known to be above it
+            distance = osa_distance(compile_pattern(pattern), text, 3)
+            self.assertEqual(min(distance, 4), min(dameraulevenshtein(pattern, text), 4))
+
+    def test_best_candidates(self):
+        series = create_series(30)
+        matcher = EpisodeMatcher(series.episodes)
+        statistics = ScoreStatistics()
+        episode_score_list = sorted(matcher.score("Test Series S01E12"), key = lambda episode_score: episode_score[1])
+        self.assertEqual(matcher.best("Test Series S01E12", 5, statistics), episode_score_list[:5])
+        self.assertEqual(episode_score_list[0][0], series.episodes[11])
+        self.assertEqual(statistics.count, len(range(0, 30, STATISTICS_INTERVAL)))
+        self.assertEqual(matcher.best("Test Series S01E12", 0), [])
+
+    def test_title_index(self):
+        series = create_series(30)
+        other_series = Series("Another Show", identifier = {"imdb" : "1"})
+        title_index = TitleIndex()
+        title_index.build([series, other_series])
+        other_series.episodes.append(Episode(title = "Pilot", descriptor = [1, 1], series = (other_series.title, other_series.identifier), identifier = {"imdb" : "pilot"}))
+        title_index.add_episode(other_series.episodes[0])
+        self.assertEqual(title_index.get_candidates("another.show.s01e01.pilot.720p", 1), other_series.episodes)
+        self.assertTrue(series.episodes[11] in title_index.get_candidates("Test.Series.S01E12.Episode.12", 3))
+
+        # File names which share no trigram with the library still get candidates
+        self.assertEqual(title_index.get_candidates("zzz", 3), series.episodes[:3])
+        self.assertEqual(len(title_index.get_candidates("qwerty", 100)), 31)
+        self.assertEqual(len(title_index.get_candidates("another", 5)), 5)
+
+
+RELEASE_NAMES = [("Show.Name.S03E07.720p.HDTV.x264-GRP", ("show name", None, 3, [7])),
+                 ("show - 3x07", ("show", None, 3, [7])),
+                 ("Show Name S01E01E02", ("show name", None, 1, [1, 2])),
+                 ("Show.S01E01-E03.1080p.BluRay", ("show", None, 1, [1, 2, 3])),
+                 ("Show 1x01-1x03", ("show", None, 1, [1, 2, 3])),
+                 ("Show.S01E01-S01E03.720p", ("show", None, 1, [1, 2, 3])),
+                 ("Show S02E04 - S02E05", ("show", None, 2, [4, 5])),
+                 ("Show.S01E01-S02E03", ("show", None, 1, [1])),
+                 ("Show 1x09-2x01", ("show", None, 1, [9])),
+                 ("Show.Name.1080p.S01E02", ("show name", None, 1, [2])),
+                 ("Show.Name.2010.720p.WEB-DL.x264.S01E02", ("show name", 2010, 1, [2])),
+                 ("Show Season 2 Episode 3", ("show", None, 2, [3])),
+                 ("Doctor.Who.2005.S01E01.Rose", ("doctor who", 2005, 1, [1])),
+                 ("The.4400.S02E05", ("the 4400", None, 2, [5])),
+                 ("[Group] Anime Show - 107 [720p][ABCD1234]", ("anime show", None, None, [107])),
+                 ("Show (2010) - 05v2", ("show", 2010, None, [5])),
+                 ("Show.Name.720p.HDTV", None),
+                 ("Show.2012.720p", None),
+                 ("Movie - 1080", None),
+                 ("Movie - 720 [x264]", None)]
+
+
+class ReleaseNameTest(unittest.TestCase):
+
+    def test_parse_release_names(self):
+        for filename, expected in RELEASE_NAMES:
+            self.assertEqual(parse_release_name(filename), expected, filename)
+
+    def test_look_up_release_name(self):
+        series = create_series(3)
+        title_index = TitleIndex()
+        title_index.build([series])
+        self.assertEqual(title_index.get_episodes(parse_release_name("Test.Series.S01E02.720p")), [series.episodes[1]])
+        self.assertEqual(title_index.get_episodes(parse_release_name("Test Series - 1x02-1x03")), series.episodes[1:])
+        self.assertEqual(title_index.get_episodes(parse_release_name("Test.Series.S01E01-S01E03")), series.episodes)
+        self.assertEqual(title_index.get_episodes(parse_release_name("Test.Series.S01E04")), [])
+        self.assertEqual(title_index.get_episodes(parse_release_name("Other.Series.S01E02")), [])
+
         
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -9,10 +9,15 @@ import os
 import json
 import diribeomessageboxes
 import collections
+import itertools
+import heapq
+import threading
+import multiprocessing
+import time
 
-from diribeomodel import settings, movieclips, series_list, MovieClip, NoInternetConnectionAvailable, DownloadError, MovieClipAssociation, PlacementPolicy
+from diribeomodel import context, MovieClip, NoInternetConnectionAvailable, DownloadError, MovieClipAssociation, PlacementPolicy, SeriesDiff, title_index
+from diribeomodel import parse_release_name, get_release_keys, opt_out_of_library
 from diribeowrapper import library
-from operator import itemgetter
 from pyffmpegwrapper.video_inspector import VideoInspector
 from pyffmpegwrapper.video_encoder import VideoEncoder
 from pyffmpegwrapper.errors import FFMpegException
@@ -20,6 +25,7 @@ from pyffmpegwrapper.errors import FFMpegException
 from PyQt4 import QtCore
 
 HOMEPAGE_URL = "http://www.diribeo.de"
+BLOCKSIZE = 1024 * 1024 # the size of the reads when hashing files
 
 class WorkerThread(QtCore.QThread):
     
@@ -35,33 +41,250 @@ class WorkerThread(QtCore.QThread):
         self.additional_descriptions = collections.defaultdict(lambda : str()) 
 
 
-    def hash_file(self, file_obj,
-                  hasher,
-                  callback=lambda byte_count: None,
-                  blocksize=4096):
-        
-        byte_count = 0
-        for block in iter(functools.partial(file_obj.read, blocksize), ''):
-            hasher.update(block)
-            byte_count += len(block)
-            # The next line is very important! If you use progress.emit as callback it prevents a deadlock under some conditions
-            if byte_count % blocksize ** 2 == 0:                  
-                callback(byte_count, self.filesize)
-        return hasher.hexdigest()  
-    
-    
-    def calculate_checksum(self, filepath):
+    def calculate_checksums(self, filepath, algorithms):
+        ''' Returns {algorithm : checksum} for the given algorithms, the file is read only once '''
         self.filesize = os.path.getsize(filepath)
-    
-        # For debugging purposes
-        def print_progress(byte_count, filesize):
-            print '\r%d/%d %6.2f' % (byte_count,
-                                 filesize,
-                                 100.0 * byte_count / filesize),
-    
-        with open(filepath, "rb") as iso_file:
-            checksum = self.hash_file(iso_file, hashlib.sha224(), self.progress.emit)
-            return checksum
+        byte_counts = [0]
+
+        def callback(byte_count):
+            byte_counts[0] += byte_count
+            # The next line is very important! Emitting progress after every block prevents a deadlock under some conditions
+            if byte_counts[0] % (16 * BLOCKSIZE) == 0:
+                self.progress.emit(byte_counts[0], self.filesize)
+
+        return get_cached_checksums(filepath, algorithms, callback)
+
+    def calculate_checksum(self, filepath):
+        algorithm = context.settings.get_checksum_algorithm()
+        return self.calculate_checksums(filepath, [algorithm])[algorithm]
+
+    def prepare_checksums(self, filepaths):
+        ''' Calculates the fingerprints of the given files and the checksums create_movieclip will
+            need in parallel. create_movieclip finds them in the checksum cache afterwards.
+        '''
+        self.additional_descriptions["hash"] = "Calculating fingerprints"
+        # Files which can't be read are reported by create_movieclip
+        fingerprints = HashingPipeline().run(filepaths, get_cached_fingerprint)
+
+        # file path -> the algorithms its checksums are needed for
+        algorithm = context.settings.get_checksum_algorithm()
+        required = collections.defaultdict(set)
+        for filepath, fingerprint in fingerprints.items():
+            candidates = context.movieclips.get_unconfirmed_matches(MovieClip(filepath, fingerprint = fingerprint))
+            if candidates:
+                required[filepath].add(algorithm)
+                for candidate in candidates:
+                    if candidate.checksum is not None:
+                        required[filepath].add(candidate.get_checksum_algorithm())
+                    elif os.path.isfile(candidate.filepath):
+                        required[candidate.filepath].add(algorithm)
+
+        checksums = HashingPipeline().run(required, lambda filepath, callback: get_cached_checksums(filepath, required[filepath], callback), self.report_throughput)
+        self.additional_descriptions["hash"] = ""
+        return checksums
+
+    def report_throughput(self, byte_count, total, elapsed):
+        self.additional_descriptions["hash"] = "Calculating hash (%.1f MB/s)" % (byte_count / max(elapsed, 0.001) / 1e6)
+        self.progress.emit(byte_count, total)
+
+    def create_movieclip(self, filepath):
+        ''' Creates the movie clip for the given file. If movie clips are hashed, only the fingerprint
+            is calculated at first. The full checksum is only calculated if the fingerprint can't tell
+            the file apart from another movie clip, the others get theirs in the background later on.
+        '''
+        movieclip = MovieClip(filepath)
+        if context.settings.get("hash_movieclips"):
+            self.additional_descriptions["hash"] = "Calculating hash"
+            movieclip.fingerprint = get_cached_fingerprint(filepath)
+            candidates = context.movieclips.get_unconfirmed_matches(movieclip)
+            if candidates:
+                algorithm = context.settings.get_checksum_algorithm()
+                # Movie clips which have been hashed with another algorithm are compared with a checksum of the same kind
+                algorithms = set([algorithm] + [candidate.get_checksum_algorithm() for candidate in candidates if candidate.checksum is not None])
+                checksums = self.calculate_checksums(filepath, algorithms)
+                movieclip.checksum, movieclip.checksum_algorithm = checksums[algorithm], algorithm
+                for candidate in candidates:
+                    if candidate.checksum is None:
+                        if os.path.isfile(candidate.filepath):
+                            context.movieclips.set_checksum(candidate, self.calculate_checksum(candidate.filepath), algorithm)
+                    elif checksums[candidate.get_checksum_algorithm()] == candidate.checksum:
+                        # Use the checksum the identical movie clip has been stored with, so both can be found by it
+                        movieclip.checksum, movieclip.checksum_algorithm = candidate.checksum, candidate.get_checksum_algorithm()
+            self.additional_descriptions["hash"] = ""
+        return movieclip
+
+
+def calculate_cached(filepath, kinds, calculate):
+    ''' Returns {kind : checksum} for the given kinds of checksums, taken from the checksum cache.
+        calculate is called with the kinds which aren't in the cache or whose file has changed
+        since and returns them the same way.
+    '''
+    cache = context.settings.get_checksum_cache()
+    file_key = cache.get_file_key(filepath)
+    digests = {}
+    for kind in kinds:
+        digest = cache.get(filepath, kind, file_key)
+        if digest is not None:
+            digests[kind] = digest
+
+    missing = [kind for kind in kinds if kind not in digests]
+    if missing:
+        calculated = calculate(missing)
+        # The file might have been changed while it was read
+        if cache.get_file_key(filepath) == file_key:
+            for kind, digest in calculated.items():
+                cache.put(filepath, kind, digest, file_key)
+        digests.update(calculated)
+    return digests
+
+
+def store_cached(filepath, digests):
+    ''' Puts checksums which have been calculated elsewhere, e.g. while copying, into the checksum cache '''
+    cache = context.settings.get_checksum_cache()
+    file_key = cache.get_file_key(filepath)
+    for kind, digest in digests.items():
+        cache.put(filepath, kind, digest, file_key)
+
+
+def calculate_digests(filepath, algorithms, callback = lambda byte_count: None, blocksize = BLOCKSIZE):
+    ''' Hashes the whole file with all the given algorithms in a single pass and returns {algorithm : checksum}.
+        callback is called with the number of bytes after every read.
+    '''
+    hashers = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    with open(filepath, "rb") as f:
+        for block in iter(functools.partial(f.read, blocksize), ''):
+            for algorithm, hasher in hashers:
+                hasher.update(block)
+            callback(len(block))
+    return dict((algorithm, hasher.hexdigest()) for algorithm, hasher in hashers)
+
+
+def calculate_digest(filepath, algorithm = "sha224", callback = lambda byte_count: None, blocksize = BLOCKSIZE):
+    return calculate_digests(filepath, [algorithm], callback, blocksize)[algorithm]
+
+
+def get_cached_checksums(filepath, algorithms, callback = lambda byte_count: None):
+    return calculate_cached(filepath, algorithms, lambda missing: calculate_digests(filepath, missing, callback))
+
+
+def get_cached_checksum(filepath, callback = lambda byte_count: None):
+    algorithm = context.settings.get_checksum_algorithm()
+    return get_cached_checksums(filepath, [algorithm], callback)[algorithm]
+
+
+def get_cached_fingerprint(filepath, callback = lambda byte_count: None):
+    return calculate_cached(filepath, ["fingerprint"], lambda missing: {"fingerprint" : calculate_fingerprint(filepath)})["fingerprint"]
+
+
+class HashingPipeline(object):
+    ''' Hashes several files at once. Every device gets threads of its own, so files on different
+        disks or network shares are read in parallel, but only a single thread reads from a
+        spinning disk, which would otherwise waste its time seeking between the files.
+    '''
+
+    DEVICE_LIMIT = 4 # threads per device which isn't a spinning disk
+    ROTATIONAL_DEVICE_LIMIT = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.byte_count = 0
+        self.results = {}
+        self.errors = {} # file path -> the error which kept it from being read
+
+    def get_device_limit(self, device):
+        ''' Returns the number of threads for the given device. Spinning disks are only
+            recognized on Linux, everything else is treated like a SSD or a network share.
+        '''
+        if not hasattr(os, "major"):
+            # e.g. Windows
+            return self.DEVICE_LIMIT
+        for path in ("/sys/dev/block/%d:%d/queue/rotational", "/sys/dev/block/%d:%d/../queue/rotational"):
+            try:
+                with open(path % (os.major(device), os.minor(device))) as f:
+                    if f.read().strip() == "1":
+                        return self.ROTATIONAL_DEVICE_LIMIT
+                    return self.DEVICE_LIMIT
+            except (IOError, OSError):
+                pass
+        return self.DEVICE_LIMIT
+
+    def stat(self, filepath):
+        return os.stat(filepath)
+
+    def add_bytes(self, byte_count):
+        with self.lock:
+            self.byte_count += byte_count
+
+    def run(self, filepaths, calculate, callback = None, interval = 0.5):
+        ''' Returns a dictionary which maps the file paths to the results of calculate(filepath, add_bytes).
+            Files which can't be read are left out, their errors are kept in errors. Any other exception
+            of calculate is raised once all threads are done. callback(byte_count, total, elapsed) is
+            called regularly in the calling thread, so it may e.g. emit Qt signals.
+        '''
+        devices = collections.defaultdict(collections.deque)
+        total = 0
+        for filepath in filepaths:
+            try:
+                stat = self.stat(filepath)
+            except OSError, e:
+                self.errors[filepath] = e
+                continue
+            devices[stat.st_dev].append(filepath)
+            total += stat.st_size
+
+        threads = []
+        for device, pending in devices.items():
+            for number in range(min(self.get_device_limit(device), len(pending))):
+                thread = threading.Thread(target = self.work, args = (pending, calculate))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        start = time.time()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(interval)
+                if callback is not None:
+                    callback(self.byte_count, total, time.time() - start)
+        if callback is not None:
+            callback(total, total, time.time() - start)
+
+        for error in self.errors.values():
+            if not isinstance(error, EnvironmentError):
+                raise error
+        return self.results
+
+    def work(self, pending, calculate):
+        while True:
+            try:
+                filepath = pending.popleft()
+            except IndexError:
+                return
+            try:
+                result = calculate(filepath, self.add_bytes)
+            except Exception, e:
+                with self.lock:
+                    self.errors[filepath] = e
+            else:
+                with self.lock:
+                    self.results[filepath] = result
+
+
+def calculate_fingerprint(filepath, chunk_size = 65536):
+    ''' Returns a hash of the file size and the first, middle and last chunk of the file. Unlike the
+        checksum it only reads a few chunks, so it is cheap even for huge files on a network share.
+    '''
+    filesize = os.path.getsize(filepath)
+    hasher = hashlib.sha1(str(filesize))
+    with open(filepath, "rb") as f:
+        if filesize <= 3 * chunk_size:
+            hasher.update(f.read())
+        else:
+            for offset in (0, (filesize - chunk_size) / 2, filesize - chunk_size):
+                f.seek(offset)
+                hasher.update(f.read(chunk_size))
+    return hasher.hexdigest()
+
 
 def dameraulevenshtein(seq1, seq2):
         """Calculate the Damerau-Levenshtein distance between sequences.
@@ -109,6 +332,222 @@ def dameraulevenshtein(seq1, seq2):
         return thisrow[len(seq2) - 1]
 
 
+def compile_pattern(pattern):
+    ''' Returns the bit masks of the characters of the pattern, which osa_distance works with '''
+    masks = {}
+    for index, character in enumerate(pattern):
+        masks[character] = masks.get(character, 0) | (1 << index)
+    return masks, len(pattern)
+
+
+def osa_distance(compiled_pattern, text, limit = None):
+    ''' Returns the same distance as dameraulevenshtein(pattern, text), but calculates a whole
+        column of the matrix at once with bit vectors (Hyyroe 2003). The time it takes only
+        depends on the length of the text as long as the pattern fits into a machine word.
+        
+        If a limit is given, the calculation stops as soon as the distance is known to exceed it
+        and a lower bound of the distance, which is greater than the limit, is returned.
+    '''
+    masks, length = compiled_pattern
+    if length == 0:
+        return len(text)
+    if limit is None:
+        limit = length + len(text)
+    elif abs(length - len(text)) > limit:
+        return abs(length - len(text))
+
+    full = (1 << length) - 1
+    last = 1 << (length - 1)
+    positive, negative = full, 0 # vertical deltas of the current column
+    diagonal, previous_equal = 0, 0
+    distance = length
+    threshold = limit + len(text) # each remaining character lowers the distance by one at most
+    for character in text:
+        equal = masks.get(character, 0)
+        transposition = (((~diagonal) & equal) << 1) & previous_equal
+        diagonal = ((((equal & positive) + positive) ^ positive) | equal | negative | transposition) & full
+        horizontal_positive = negative | (~(diagonal | positive) & full)
+        horizontal_negative = diagonal & positive
+        if horizontal_positive & last:
+            distance += 1
+        elif horizontal_negative & last:
+            distance -= 1
+        horizontal_positive = ((horizontal_positive << 1) | 1) & full
+        horizontal_negative = (horizontal_negative << 1) & full
+        positive = horizontal_negative | (~(diagonal | horizontal_positive) & full)
+        negative = horizontal_positive & diagonal
+        previous_equal = equal
+        threshold -= 1
+        if distance > threshold:
+            return distance - threshold + limit
+    return distance
+
+
+def get_title_table(episodes):
+    ''' Returns a tuple with the titles of each episode which file names are compared with.
+        Unlike the episodes themselves, the table is cheap to hand to other processes.
+    '''
+    return tuple(tuple(episode.get_alternative_titles() + [episode.get_normalized_name()]) for episode in episodes)
+
+
+class CompiledTitleTable(object):
+    ''' The compiled patterns of a title table. The titles of an episode are compiled the first
+        time they are needed, so a shortlist of a large table only compiles the shortlisted titles.
+    '''
+
+    def __init__(self, title_table):
+        self.title_table = title_table
+        self.patterns = [None] * len(title_table)
+
+    def __len__(self):
+        return len(self.title_table)
+
+    def __getitem__(self, position):
+        patterns = self.patterns[position]
+        if patterns is None:
+            patterns = self.patterns[position] = [compile_pattern(title) for title in self.title_table[position]]
+        return patterns
+
+
+STATISTICS_INTERVAL = 8 # every that many episodes one is scored completely for the statistics
+
+def get_best_scores(compiled_table, filename, count, statistics = None, positions = None):
+    ''' Returns the count best [position, score] pairs of the table (or of the given positions of
+        it) sorted by score, the same as the beginning of the sorted score list. Once count
+        candidates are found, the distance calculation of an episode stops as soon as it can't
+        beat the worst of them. Only the dropped episodes have inexact scores, so the
+        statistics receive a sample of episodes which are always scored completely.
+    '''
+    if count <= 0:
+        return []
+    if positions is None:
+        positions = xrange(len(compiled_table))
+    heap = [] # (-score, -position) of the best candidates, the worst one first
+    for number, position in enumerate(positions):
+        patterns = compiled_table[position]
+        sampled = statistics is not None and number % STATISTICS_INTERVAL == 0
+        limit = -heap[0][0] - 1 if len(heap) == count and not sampled else None
+        score = None
+        for pattern in patterns:
+            distance = osa_distance(pattern, filename, limit)
+            if score is None or distance < score:
+                score = distance
+                if limit is None or score <= limit:
+                    limit = score - 1
+        if sampled:
+            statistics.add(score)
+        if len(heap) < count:
+            heapq.heappush(heap, (-score, -position))
+        elif score < -heap[0][0]:
+            heapq.heapreplace(heap, (-score, -position))
+    return [[-position, -score] for score, position in sorted(heap, reverse = True)]
+
+
+class EpisodeMatcher(object):
+    ''' Scores file names against the titles of many episodes. The titles are compiled once,
+        so scoring another file name only costs the bit-parallel distance calculations.
+    '''
+
+    def __init__(self, episodes):
+        self.episodes = episodes
+        self.patterns = CompiledTitleTable(get_title_table(episodes))
+
+    def score(self, filename):
+        ''' Returns [episode, score] for every episode '''
+        return [[episode, min(osa_distance(pattern, filename) for pattern in self.patterns[position])]
+                for position, episode in enumerate(self.episodes)]
+
+    def best(self, filename, count, statistics = None):
+        ''' Returns the count best [episode, score] pairs sorted by score, see get_best_scores '''
+        return [[self.episodes[position], score] for position, score in get_best_scores(self.patterns, filename, count, statistics)]
+
+
+def score_filename(compiled_table, filename, positions, count):
+    ''' Returns the best [position, score] pairs, the mean and the median score of a file name '''
+    statistics = ScoreStatistics()
+    return get_best_scores(compiled_table, filename, count, statistics, positions), statistics.mean(), statistics.median()
+
+
+pool_title_table = None # the compiled title table of the batch in a pool process
+
+def install_title_table(title_table):
+    ''' The initializer of the processes which score the file names of a batch '''
+    global pool_title_table
+    opt_out_of_library()
+    pool_title_table = CompiledTitleTable(title_table)
+
+
+def score_filename_in_pool(arguments):
+    return score_filename(pool_title_table, *arguments)
+
+
+class ScoringPool(object):
+    ''' Keeps the processes which score file names alive between batches. Handing the title
+        table to every process is what makes starting them expensive, so they are only started
+        again once the title table has changed.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.title_table = None
+
+    def map(self, title_table, tasks):
+        with self.lock:
+            if self.pool is None or title_table != self.title_table:
+                self.close()
+                self.pool = multiprocessing.Pool(initializer = install_title_table, initargs = (title_table,))
+                self.title_table = title_table
+            return self.pool.map(score_filename_in_pool, tasks)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.title_table = None
+
+
+scoring_pool = ScoringPool()
+
+
+class ScoreStatistics(object):
+    ''' Mean and median of a stream of scores, which are small non-negative integers.
+        Only a histogram of the scores is kept.
+    '''
+
+    def __init__(self):
+        self.histogram = []
+        self.count = 0
+        self.total = 0
+
+    def add(self, score):
+        if score >= len(self.histogram):
+            self.histogram.extend([0] * (score + 1 - len(self.histogram)))
+        self.histogram[score] += 1
+        self.count += 1
+        self.total += score
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return float(self.total) / self.count
+
+    def get_score(self, position):
+        ''' Returns the score at the given position of the sorted scores '''
+        for score, frequency in enumerate(self.histogram):
+            if position < frequency:
+                return score
+            position -= frequency
+
+    def median(self):
+        if self.count == 0:
+            return 0
+        if self.count % 2 == 1:
+            return self.get_score(self.count / 2)
+        return float(self.get_score(self.count / 2 - 1) + self.get_score(self.count / 2)) / 2
+
+
 class AssignerThread(WorkerThread):
     no_association_found = QtCore.pyqtSignal()
     already_exists = QtCore.pyqtSignal("PyQt_PyObject", "PyQt_PyObject") # This signal is emitted when the movieclip is already in the dict and in the folder
@@ -125,11 +564,15 @@ class MultipleAssignerThread(WorkerThread):
     
     result = QtCore.pyqtSignal("PyQt_PyObject")    
     
-    def __init__(self, filepath_dir_list, series, pool):
+    CANDIDATE_COUNT = 20 # the number of guesses offered for a file
+    SHORTLIST_SIZE = 300 # the number of episodes of the library a file is compared to
+    POOL_MINIMUM = 10000 # from this number of comparisons on, the file names are scored in other processes
+    
+    def __init__(self, filepath_dir_list, series):
         WorkerThread.__init__(self)
         self.filepath_dir_list = filepath_dir_list
         self.series = series
-        self.pool = pool
+        self.episodes_by_key = None # the episodes of the hinted series by ReleaseName key
 
         hint = ""
         if self.series is not None:
@@ -137,19 +580,55 @@ class MultipleAssignerThread(WorkerThread):
             
         self.description = "Assigning multiple clips " + hint
     
-    def create_episode_list(self, series, filename):                
-        episode_list = []
-        if self.series is None:        
-            for series in series_list:
-                for episode in series.episodes:
-                    episode.filename = filename
-                    episode_list.append(episode)
+    def prepare_title_index(self):
+        if not title_index.is_built():
+            context.settings.load_all_series(context.series_list)
+            title_index.build(context.series_list)
+    
+    
+    def score_filenames(self, filenames):
+        ''' Returns the episodes the file names are compared with and for each file name the best
+            [position, score] pairs, the mean and the median score. Without a hint, a file name
+            is only compared with the shortlist of the whole library the title index returns.
+        '''
+        if self.series is None:
+            self.prepare_title_index()
+            episodes = list(title_index.episodes)
+            tasks = [(filename, title_index.get_candidate_positions(filename, self.SHORTLIST_SIZE), self.CANDIDATE_COUNT) for filename in filenames]
         else:
-            for episode in self.series:
-                episode.filename = filename
-                episode_list.append(episode)
+            episodes = list(self.series)
+            tasks = [(filename, None, self.CANDIDATE_COUNT) for filename in filenames]
+        title_table = get_title_table(episodes)
+        
+        comparisons = sum(len(positions) if positions is not None else len(episodes) for filename, positions, count in tasks)
+        if comparisons < self.POOL_MINIMUM:
+            compiled_table = CompiledTitleTable(title_table)
+            return episodes, [score_filename(compiled_table, *task) for task in tasks]
         
-        return episode_list
+        # The title table is handed to each process once, afterwards only the file names are sent
+        return episodes, scoring_pool.map(title_table, tasks)
+    
+    
+    def get_parsed_episodes(self, filename):
+        ''' Returns the episodes named in the file name, looked up by series name and descriptor.
+            With a hint only the descriptor has to match an episode of the given series.
+        '''
+        release_name = parse_release_name(filename)
+        if release_name is None:
+            return []
+        if self.series is None:
+            self.prepare_title_index()
+            return title_index.get_episodes(release_name)
+        
+        if self.episodes_by_key is None:
+            self.episodes_by_key = {}
+            for episode in self.series:
+                for key in get_release_keys(episode):
+                    self.episodes_by_key.setdefault(key, episode)
+        episodes = [self.episodes_by_key.get(key) for key in release_name.get_keys()]
+        if all(episode is not None for episode in episodes):
+            return episodes
+        return []
     
     
     def create_filepath_list(self, filepath_dir_list):
@@ -179,7 +658,9 @@ class MultipleAssignerThread(WorkerThread):
             
                 b) generate hash of file and look if an association exists, remember result
                 
-                c) if no association exists, generate levenshtein, remember result
+                c) if no association exists, look up the episode named in the file name
+                
+                d) if the file name can't be parsed, generate levenshtein, remember result
             
             emit result into appropiate editor
         
@@ -187,6 +668,10 @@ class MultipleAssignerThread(WorkerThread):
         
         movieclip_associations = []
         
+        if context.settings.get("hash_movieclips"):
+            self.prepare_checksums([filepath for filepath in self.filepath_list if os.path.isfile(filepath) and context.settings.is_valid_file_extension(filepath)])
+        
+        guesses = [] # (movieclip association, filename) of the files whose episode has to be guessed
         filepath_list_length = len(self.filepath_list)
         for index, filepath in enumerate(self.filepath_list):
             self.progress.emit(index, filepath_list_length)
@@ -197,70 +682,73 @@ class MultipleAssignerThread(WorkerThread):
             self.additional_descriptions["progress"] = "%s from %s" % (index+1, filepath_list_length)
             filename, ext = os.path.splitext(os.path.basename(filepath))
             
-            if not os.path.isfile(filepath) or not settings.is_valid_file_extension(filepath):
+            if not os.path.isfile(filepath) or not context.settings.is_valid_file_extension(filepath):
                 # a)
                 movieclip_association.message = movieclip_association.INVALID_FILE
                 movieclip_association.skip = True
             else:
                 # b)
-                checksum = None
-                if settings.get("hash_movieclips"):
-                    self.additional_descriptions["hash"] = "Calculating hash"
-                    checksum = self.calculate_checksum(filepath)
-                    self.additional_descriptions["hash"] = ""
-                    
-                movieclip = MovieClip(filepath, checksum = checksum)
+                movieclip = self.create_movieclip(filepath)
                 
-                if settings.get("hash_movieclips"):        
-                    episode_dict = movieclips.get_episode_dict_with_matching_checksums(movieclip.checksum)
+                if context.settings.get("hash_movieclips"):        
+                    if movieclip.checksum is not None:
+                        episode_dict = context.movieclips.get_episode_dict_with_matching_checksums(movieclip.checksum)
+                    else:
+                        # The fingerprint doesn't match any other movie clip
+                        episode_dict = context.movieclips.get_episode_dict_with_matching_fingerprints(movieclip.fingerprint)
                 
-                if not (not settings.get("hash_movieclips") or len(episode_dict.items()) == 0 or episode_dict.items()[0][0] is None):
+                parsed_episodes = self.get_parsed_episodes(filename)
+                
+                if not (not context.settings.get("hash_movieclips") or len(episode_dict.items()) == 0 or episode_dict.items()[0][0] is None):
                     episode = episode_dict.items()[0][0]                        
                     found_movieclip = episode_dict.items()[0][1]
                     movieclip_association.episode_scores_list = [(episode, 0)]
                     movieclip_association.movieclip = found_movieclip
                     movieclip_association.message = movieclip_association.ASSOCIATION_FOUND
+                elif parsed_episodes:
+                    # c) the file name contains the series name and the season and episode number
+                    movieclip_association.movieclip = movieclip
+                    movieclip_association.episode_scores_list = [[episode, 0] for episode in parsed_episodes]
+                    movieclip_association.message = movieclip_association.ASSOCIATION_PARSED
                 else:
-                    # c)
-                    self.additional_descriptions["guess"] = "Guessing episode"
-                    episode_list = self.create_episode_list(self.series, filename)
-                    
-                    result = self.pool.map_async(generate_episode_score_list, episode_list)
-                    episode_score_list = result.get(timeout=100)
-                    
-                    episode_score_list.sort(key=itemgetter(1))
-                    total_score = sum([score for episode, score in episode_score_list])
-                    counter = len(episode_score_list)
-                    
+                    # d)
                     movieclip_association.movieclip = movieclip
-                    movieclip_association.episode_scores_list = episode_score_list
                     movieclip_association.message = movieclip_association.ASSOCIATION_GUESSED
-                    movieclip_association.episode_score_information["mean"] = float(total_score) / float(counter)
-                    movieclip_association.episode_score_information["median"] = self.get_median([score for episode, score in episode_score_list])
-                    
-                    self.additional_descriptions["guess"] = ""
+                    guesses.append((movieclip_association, filename))
+        
+        if guesses:
+            self.additional_descriptions["guess"] = "Guessing %s episodes" % len(guesses)
+            episodes, results = self.score_filenames([filename for movieclip_association, filename in guesses])
+            for (movieclip_association, filename), (best_scores, mean, median) in itertools.izip(guesses, results):
+                movieclip_association.episode_scores_list = [[episodes[position], score] for position, score in best_scores]
+                movieclip_association.episode_score_information["mean"] = mean
+                movieclip_association.episode_score_information["median"] = median
+            self.additional_descriptions["guess"] = ""
         
         self.result.emit(movieclip_associations)
         self.finished.emit()
 
 
+class ChecksumCalculator(WorkerThread):
+    ''' Calculates the checksums which have been skipped because the fingerprint was sufficient '''
 
-    def get_median(self, values):
-        ''' Calculates the median of a sorted list of numbers
-        '''
-        count = len(values)
-        if count % 2 == 1:
-            return values[(count+1)/2-1]
-        else:
-            lower = values[count/2-1]
-            upper = values[count/2]
-            return (float(lower + upper)) / 2
-
+    hashing_error = QtCore.pyqtSignal("PyQt_PyObject")
 
+    def __init__(self):
+        WorkerThread.__init__(self)
+        self.description = "Calculating checksums"
 
-def generate_episode_score_list(episode):
-    score = min([dameraulevenshtein(title, episode.filename) for title in episode.get_alternative_titles() + [episode.get_normalized_name()]])
-    return [episode, score]
+    def run(self):
+        movieclips = [movieclip for movieclip in context.movieclips if movieclip.checksum is None and movieclip.fingerprint is not None]
+        algorithm = context.settings.get_checksum_algorithm()
+        pipeline = HashingPipeline()
+        checksums = pipeline.run([movieclip.filepath for movieclip in movieclips], get_cached_checksum, self.report_throughput)
+        for movieclip in movieclips:
+            if movieclip.filepath in checksums:
+                context.movieclips.set_checksum(movieclip, checksums[movieclip.filepath], algorithm)
+        if pipeline.errors:
+            self.hashing_error.emit(pipeline.errors)
+        self.finished.emit()
 
 
 class ThumbnailGatherer(WorkerThread):
@@ -271,7 +759,7 @@ class ThumbnailGatherer(WorkerThread):
         self.description = "Loading Pixmaps"
 
     def run(self):
-        for movieclip in movieclips:
+        for movieclip in context.movieclips:
             for filepath, timecode in movieclip.thumbnails:
                     self.pixmap_cache.get_pixmap(filepath)
         self.finished.emit()
@@ -325,18 +813,12 @@ class MultipleMovieClipAssociator(AssignerThread):
                 episode = movieclip_association.get_associated_episode_score()[0]
                 
                 if movieclip_association.movieclip is None:
-                    checksum = None
-                    if settings.get("hash_movieclips"):
-                        self.additional_descriptions["hash"] = "Calculating hash"
-                        checksum = self.calculate_checksum(filepath)
-                        self.additional_descriptions["hash"] = ""
-                        
-                    movieclip_association.movieclip = MovieClip(filepath, checksum=checksum)
+                    movieclip_association.movieclip = self.create_movieclip(filepath)
                 movieclip_association.movieclip.identifier = episode.identifier
                 
-                if not os.path.isfile(filepath) or not settings.is_valid_file_extension(filepath):
+                if not os.path.isfile(filepath) or not context.settings.is_valid_file_extension(filepath):
                     self.filesystem_error.emit(filepath)
-                elif settings.get("hash_movieclips") and not movieclips.check_unique(movieclip_association.movieclip, episode.get_identifier()):
+                elif context.settings.get("hash_movieclips") and not context.movieclips.check_unique(movieclip_association.movieclip, episode.get_identifier()):
                     self.already_exists_in_another.emit()
                 else:
                     self.assign(movieclip_association)
@@ -356,10 +838,10 @@ class MultipleMovieClipAssociator(AssignerThread):
         episode, score = movieclip_association.get_associated_episode_score()
         
         # Calculate hypothetical filepath
-        destination = settings.calculate_filepath(episode, filename)
+        destination = context.settings.calculate_filepath(episode, filename)
         directory = os.path.dirname(destination)
         
-        if movieclip_association.movieclip in movieclips[episode.get_identifier()]:
+        if movieclip_association.movieclip in context.movieclips[episode.get_identifier()]:
             
             if os.path.isfile(destination):
                 # a)
@@ -384,26 +866,47 @@ class MultipleMovieClipAssociator(AssignerThread):
         
         if move_to_folder and (movieclip_association.placement_policy != PlacementPolicy.DONT_TOUCH):
             # Check if there is already a file with the same name, normalizes file name if set to do so
-            filename = settings.get_unique_filename(destination, episode)
+            filename = context.settings.get_unique_filename(destination, episode)
             
             # Move the file to the actual folder
             copy_move = "Moving"
-            if settings.get("placement_policy") == PlacementPolicy.COPY:
+            if context.settings.get("placement_policy") == PlacementPolicy.COPY:
                 copy_move = "Copying"
             self.additional_descriptions["moving"] = "%s movie clip to destination" % copy_move
-            settings.move_file_to_folder_structure(episode, movieclip_association.filepath, movieclip_association.placement_policy, new_filename=filename)
-            self.additional_descriptions["moving"] = ""
+            
+            # A copied clip which hasn't got a checksum yet is hashed while it is copied
+            algorithms = None
+            if context.settings.get("hash_movieclips") and movieclip_association.movieclip.checksum is None:
+                algorithms = [context.settings.get_checksum_algorithm()]
+            try:
+                checksums = context.settings.move_file_to_folder_structure(episode, movieclip_association.filepath, movieclip_association.placement_policy, new_filename=filename, algorithms=algorithms)
+            except IOError:
+                self.filesystem_error.emit(movieclip_association.filepath)
+                return
+            finally:
+                self.additional_descriptions["moving"] = ""
             
             
             # Set the old file path to the current one
             movieclip_association.movieclip.old_filepath = movieclip_association.movieclip.filepath
             
             # Update the filepath of the clip        
-            movieclip_association.movieclip.filepath = os.path.join(directory, filename)
+            if add_to_movieclips:
+                movieclip_association.movieclip.filepath = os.path.join(directory, filename)
+            else:
+                context.movieclips.set_filepath(movieclip_association.movieclip, os.path.join(directory, filename))
+            
+            if checksums:
+                store_cached(movieclip_association.movieclip.filepath, checksums)
+                if add_to_movieclips:
+                    movieclip_association.movieclip.checksum, movieclip_association.movieclip.checksum_algorithm = checksums[algorithms[0]], algorithms[0]
+                else:
+                    context.movieclips.set_checksum(movieclip_association.movieclip, checksums[algorithms[0]], algorithms[0])
+            movieclip_association.movieclip.changed()
     
         if add_to_movieclips:
             # Add the clips to the movie clips manager
-            movieclips.add(movieclip_association.movieclip)                  
+            context.movieclips.add(movieclip_association.movieclip)                  
                     
         self.load_information.emit(episode)
         
@@ -420,7 +923,7 @@ class ThumbnailGenerator(WorkerThread):
         self.image_list = []  
         self.timecode = []  
         self.description = "Generating thumbnails"       
-        self.number_of_thumbnails = settings.get("number_of_thumbnails")  
+        self.number_of_thumbnails = context.settings.get("number_of_thumbnails")  
 
 
     def run(self):
@@ -446,13 +949,13 @@ class ThumbnailGenerator(WorkerThread):
         
         interval = duration/self.number_of_thumbnails
         unique_identifier = str(uuid.uuid4())
-        self.prefix = os.path.join(settings.get_thumbnail_folder(), unique_identifier)
+        self.prefix = os.path.join(context.settings.get_thumbnail_folder(), unique_identifier)
         video_encoder = VideoEncoder(self.filepath)
         
         for index in range(1, self.number_of_thumbnails+1):
             time = index*interval
             self.timecode.append(time)
-            destination = os.path.join(settings.get_thumbnail_folder(), unique_identifier + "-%03d" % index + ".png")
+            destination = os.path.join(context.settings.get_thumbnail_folder(), unique_identifier + "-%03d" % index + ".png")
             video_encoder.execute(
                 '%(ffmpeg_bin)s -ss '+ str(time) +' -y -i "%(input_file)s" -vframes 1 -vcodec png -f image2 "%(output_file)s"',
                 destination,
@@ -463,6 +966,7 @@ class ThumbnailGenerator(WorkerThread):
         
         if len(self.image_list) > 0:
             self.movieclip.thumbnails = zip(self.image_list, self.timecode)            
+            self.movieclip.changed()
             self.thumbnails_created.emit(self.episode)
         else:
             self.error_in_thumbnail_creation.emit()
@@ -479,6 +983,7 @@ class ThumbnailGenerator(WorkerThread):
 
 class MovieUpdater(WorkerThread):
     download_error = QtCore.pyqtSignal("PyQt_PyObject")
+    updated = QtCore.pyqtSignal("PyQt_PyObject") # Is emitted with the SeriesDiff of an updated series or None
     
     def __init__(self, movie):
         WorkerThread.__init__(self)
@@ -488,7 +993,8 @@ class MovieUpdater(WorkerThread):
     def run(self):
         self.waiting.emit()
         try:
-            library.update_movie(self.movie)
+            result = library.update_movie(self.movie)
+            self.updated.emit(result if isinstance(result, SeriesDiff) else None)
         except DownloadError:
             self.download_error.emit(self.movie)
         self.finished.emit()
@@ -510,7 +1016,7 @@ class SeriesSearchWorker(WorkerThread):
         self.waiting.emit()
         
         try:
-            result = library.search_movie(self.searchfield.text(), settings.settings["sources"])
+            result = library.search_movie(self.searchfield.text(), context.settings.settings["sources"])
             if result:
                 self.results.emit(result)
             else:                
@@ -520,6 +1026,23 @@ class SeriesSearchWorker(WorkerThread):
         
         self.finished.emit()
 
+class LibraryLoader(WorkerThread):
+    
+    series_loaded = QtCore.pyqtSignal("PyQt_PyObject")
+    
+    def __init__(self, series_iterator):
+        WorkerThread.__init__(self)
+        self.series_iterator = series_iterator
+        self.description = "Loading library"
+
+    def run(self):
+        self.waiting.emit()
+        # The series are only read here, the receiver adds them to the library
+        for series in self.series_iterator:
+            self.series_loaded.emit(series)
+        self.finished.emit()
+        
+
 class ModelFiller(WorkerThread):
     
     # Initialize various signals.
@@ -558,6 +1081,7 @@ class ModelFiller(WorkerThread):
             self.download_error.emit(self.series)
         
         self.model.filled = True          
+        self.series.changed()
         self.finished.emit()
         self.update_tree.emit(self.series)
         self.update_tableview.emit(self.model)
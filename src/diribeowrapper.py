@@ -4,7 +4,7 @@ import datetime
 from time import strptime
 import tvrage.api
 
-from diribeomodel import Episode, Series, NoInternetConnectionAvailable, series_list, DownloadedSeries, settings, DownloadError
+from diribeomodel import Episode, Series, NoInternetConnectionAvailable, DownloadedSeries, DownloadError, identifier_index, context
 
 class LibraryWrapper(object):
     def __init__(self):
@@ -28,7 +28,11 @@ class LibraryWrapper(object):
         return output
 
     def get_series_from_identifier(self, identifier):
-        for series in series_list:
+        series = identifier_index.get_series(identifier)
+        if series is not None:
+            return series
+
+        for series in context.series_list:
             try:
                 if series.identifier == identifier:
                     return series
@@ -62,9 +66,9 @@ class SourceWrapper(object):
     
     def update_movie(self, movie):
         if isinstance(movie, Series):
-            self.update_series(movie, merge_policy=settings.get("merge_policy_series"))
+            return self.update_series(movie, merge_policy=context.settings.get("merge_policy_series"))
         else:
-            self.update_episode(movie, merge_policy=settings.get("merge_policy_episode"))
+            return self.update_episode(movie, merge_policy=context.settings.get("merge_policy_episode"))
     
     def update_episode(self, episode, merge_policy=None):
         raise NotImplementedError
@@ -202,12 +206,12 @@ class IMDBWrapper(SourceWrapper):
         
         for episode, episode_count in self.get_episodes(imdb_series):
             new_series.episodes.append(episode) 
-        old_series.merge(new_series, merge_policy=merge_policy)
+        return old_series.merge(new_series, merge_policy=merge_policy)
     
     def update_episode(self, old_episode, merge_policy=None):
         imdb_episode = self.ia.get_movie(old_episode.get_identifier()[1])
         new_episode = self.__imdb_episode_to_episode(imdb_episode)
-        old_episode.merge(new_episode, merge_policy=merge_policy)
+        return old_episode.merge(new_episode, merge_policy=merge_policy)
         
     
     def __imdb_episode_to_episode(self, imdb_episode, imdb_series = None, ratings = None, counter = None):